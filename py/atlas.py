@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import argparse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# transparent gap between sheets, in pixels
+PADDING = 1
+
+class Page(object):
+    # shelf packer: sheets are placed left to right on shelves as high as
+    # their tallest sheet, and shelves are stacked top to bottom.
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.placed   = []
+        self.shelf_x  = 0
+        self.shelf_y  = 0
+        self.shelf_h  = 0
+
+    def place(self, name, img):
+        w, h = img.size
+
+        if self.shelf_x + w > self.max_size:
+            self.shelf_y += self.shelf_h + PADDING
+            self.shelf_x  = 0
+            self.shelf_h  = 0
+
+        if self.shelf_y + h > self.max_size:
+            return None
+
+        pos = (self.shelf_x, self.shelf_y)
+        self.placed.append((name, img, pos))
+
+        self.shelf_x += w + PADDING
+        self.shelf_h  = max(self.shelf_h, h)
+        return pos
+
+    def render(self):
+        width  = max(pos[0] + img.size[0] for _, img, pos in self.placed)
+        height = max(pos[1] + img.size[1] for _, img, pos in self.placed)
+
+        atlas = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        for _, img, pos in self.placed:
+            atlas.paste(img, pos)
+
+        return atlas
+
+def atlas_entry(metadata, name, img_src, x, y):
+    # manifest entry of a tilesheet placed at (x, y) in an atlas. sprite
+    # rectangles are moved by (x, y); grid sheets keep their grid, and the
+    # viewer adds their offset itself.
+    entry = {
+            'src':     metadata.get('src', name),
+            'img_src': img_src
+        }
+
+    if 'sprites' in metadata:
+        entry['sprites'] = [[x + sx, y + sy, w, h] for sx, sy, w, h in metadata['sprites']]
+    else:
+        entry['sheet_size'] = metadata['sheet_size']
+        entry['offset']     = [x, y]
+
+    # still needed for tileSize overrides and grass variants
+    if 'tile_size' in metadata:
+        entry['tile_size'] = metadata['tile_size']
+
+    return entry
+
+def pack(manifest, assets_dir, prefix, max_size):
+    # returns the rewritten manifest and the atlas images keyed by img_src.
+    # sheets that are missing or too large are left as they are.
+    images = []
+    for name, metadata in manifest.items():
+        filename = os.path.join(assets_dir, metadata['img_src'])
+        try:
+            img = Image.open(filename).convert('RGBA')
+        except OSError:
+            print("Cannot load '{:s}', not adding it to an atlas".format(filename))
+            continue
+
+        if img.size[0] > max_size or img.size[1] > max_size:
+            print("'{:s}' is larger than {:d}px, not adding it to an atlas".format(filename, max_size))
+            continue
+
+        images.append((name, img))
+
+    # tallest sheets first keeps the shelves tight
+    images.sort(key=lambda item: (-item[1].size[1], item[0]))
+
+    pages = [Page(max_size)]
+    for name, img in images:
+        if pages[-1].place(name, img) is None:
+            pages.append(Page(max_size))
+            pages[-1].place(name, img)
+
+    output = dict(manifest)
+    atlases = {}
+    for page_num, page in enumerate(pages):
+        if len(page.placed) == 0:
+            continue
+
+        img_src = '{:s}{:d}.png'.format(prefix, page_num)
+        atlases[img_src] = page.render()
+
+        for name, img, (x, y) in page.placed:
+            output[name] = atlas_entry(manifest[name], name, img_src, x, y)
+
+    return output, atlases
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the tilesheets in a tilesheet manifest into atlas images.")
+    parser.add_argument('manifest', help="tilesheet manifest written by json_save.py/json_map.py --manifest")
+    parser.add_argument('output_manifest')
+    parser.add_argument('assets_dir', help="directory the viewer loads tilesheet images from")
+    parser.add_argument('--prefix', default='atlas',
+            help="atlas image name prefix, relative to the assets directory (default: %(default)s)")
+    parser.add_argument('--max-size', type=int, default=4096,
+            help="maximum atlas width and height in pixels (default: %(default)s)")
+    args = parser.parse_args()
+
+    if Image is None:
+        print("Packing atlases requires Pillow")
+        sys.exit(1)
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    print("Packing tilesheets...")
+    output, atlases = pack(manifest, args.assets_dir, args.prefix, args.max_size)
+
+    print("Writing atlases...")
+    for img_src, atlas in atlases.items():
+        print('\t{:s}'.format(img_src))
+        filename = os.path.join(args.assets_dir, img_src)
+        if os.path.dirname(filename) != '':
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        atlas.save(filename, optimize=True)
+
+    print("Writing manifest...")
+    with open(args.output_manifest, 'w') as f:
+        json.dump(output, f, separators=(',',':'))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+import os
+import io
+import sys
+import gc
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import importlib.util
+
+import saves
+import extract
+import parallel
+import shards
+import synthetic
+import encoders
+
+def json_bytes(obj):
+    return json.dumps(obj, separators=(',',':')).encode('utf-8')
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+class Results(object):
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = []
+        self.checks = []
+
+    def measure(self, name, fn, memory=True):
+        # one untimed run first, so lazy imports and first-call setup (e.g.
+        # numpy's import on the first vectorized call) are not timed. then the
+        # best of repeat runs for time, and one run under tracemalloc for the
+        # peak, since tracing skews the timings
+        fn()
+
+        times = []
+        for _ in range(self.repeat):
+            gc.collect()
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+
+        peak = None
+        if memory:
+            gc.collect()
+            tracemalloc.start()
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        self.stages.append({'stage': name, 'seconds': min(times), 'peak_bytes': peak})
+        print("{:<36s} {:9.3f} s {:>12s}".format(name, min(times),
+            '' if peak is None else '{:.1f} MB'.format(peak / 1e6)))
+        return result
+
+    def check(self, name, expected, actual):
+        ok = expected == actual
+        self.checks.append({'check': name, 'ok': ok})
+        print("{:<36s} {:s}".format(name, 'ok' if ok else 'MISMATCH'))
+        return ok
+
+class scalar_connectables(object):
+    # forces calculateConnectables onto the pure Python path
+    def __enter__(self):
+        self.numpy = saves.numpy
+        saves.numpy = None
+
+    def __exit__(self, *exc):
+        saves.numpy = self.numpy
+
+def dump_serial(filename):
+    return json_bytes(saves.Save.load(filename).dump())
+
+def dump_instanced(filename):
+    save = saves.Save.load(filename)
+    save.instanced = True
+    return json_bytes(save.dump())
+
+def instances_match(instanced, serial):
+    # instances must expand to the same features, in the same order
+    for a, b in zip(json.loads(instanced.decode('utf-8'))['locations'], json.loads(serial.decode('utf-8'))['locations']):
+        if saves.expandInstances(a['instances']) != [f for f in b['features'] if f is not None]:
+            return False
+    return True
+
+def dump_stream(filename, format='json'):
+    save = saves.Save.loadHeader(filename)
+    f = io.BytesIO()
+    save.dumpStream(encoders.writer(format, f), (l.dump(save) for l in saves.iterLocations(filename)))
+    return f.getvalue()
+
+def dump_parallel(filename, jobs):
+    save = saves.Save.loadHeader(filename)
+    return json_bytes(save.dump(parallel.dumpLocations(save, filename, jobs)))
+
+def dump_shards(filename, directory):
+    save = saves.Save.loadHeader(filename)
+    writer = shards.ShardWriter(directory)
+    save.dumpShards(writer, (l.dump(save) for l in saves.iterLocations(filename)))
+    return writer
+
+def shards_match(writer, serial):
+    # every shard must hold exactly the serial dump of its location
+    save_dump = json.loads(serial.decode('utf-8'))
+    for location in save_dump['locations']:
+        with open(os.path.join(writer.directory, writer.shards[location['name']]), 'rb') as f:
+            if f.read() != json_bytes(location):
+                return False
+    return True
+
+def bench_save(results, filename, args):
+    print("Save: {:s} ({:.1f} MB)".format(filename, os.path.getsize(filename) / 1e6))
+
+    save = results.measure('parse', lambda: saves.Save.load(filename))
+
+    connectables = [l.connectables for l in save.locations]
+    results.measure('connectables', lambda: [saves.calculateConnectables(c) for c in connectables])
+    with scalar_connectables():
+        results.measure('connectables (scalar)', lambda: [saves.calculateConnectables(c) for c in connectables])
+
+    save_dump = results.measure('dump', save.dump)
+    results.measure('serialize', lambda: json_bytes(save_dump))
+    results.measure('serialize (msgpack)', lambda: encoders.dumps('msgpack', save_dump))
+
+    results.measure('end to end', lambda: dump_serial(filename))
+    results.measure('end to end --stream', lambda: dump_stream(filename))
+    if args.jobs is not None:
+        results.measure('end to end -j {:d}'.format(args.jobs), lambda: dump_parallel(filename, args.jobs or None), memory=False)
+
+    # golden output checks against the plain serial conversion
+    serial = dump_serial(filename)
+    results.check('stream == serial', serial, dump_stream(filename))
+    msgpack = encoders.dumps('msgpack', json.loads(serial.decode('utf-8')))
+    results.check('msgpack stream == msgpack', msgpack, dump_stream(filename, 'msgpack'))
+    if encoders.msgpack is not None:
+        results.check('pure msgpack == msgpack', msgpack, encoders.packb(json.loads(serial.decode('utf-8'))))
+    print("{:<36s} {:9.1f} MB {:9.1f} MB".format('size json, msgpack', len(serial) / 1e6, len(msgpack) / 1e6))
+
+    instanced = results.measure('end to end --instanced', lambda: dump_instanced(filename))
+    results.check('instanced == serial', True, instances_match(instanced, serial))
+    print("{:<36s} {:9.1f} MB".format('size json --instanced', len(instanced) / 1e6))
+
+    results.check('parallel == serial', serial, dump_parallel(filename, args.jobs or None))
+
+    with tempfile.TemporaryDirectory() as directory:
+        results.check('shards == serial', True, shards_match(dump_shards(filename, directory), serial))
+
+    with scalar_connectables():
+        results.check('scalar connectables == serial', serial, dump_serial(filename))
+
+    for name in sorted(extract.BACKENDS):
+        if name == extract.backend.name:
+            continue
+        try:
+            backend = extract.getBackend(name)
+        except ValueError:
+            print("{:<36s} skipped, not installed".format(name + ' == serial'))
+            continue
+
+        previous = extract.backend.name
+        extract.setBackend(backend.name)
+        try:
+            results.measure('parse ({:s})'.format(name), lambda: saves.Save.load(filename))
+            results.check('{:s} == serial'.format(name), serial, dump_serial(filename))
+        finally:
+            extract.setBackend(previous)
+
+    return {'save': digest(serial)}
+
+def bench_maps(results, args):
+    try:
+        import maps
+    except ImportError as e:
+        print("Skipping maps: {}".format(e))
+        return {}
+
+    m = synthetic.make_map(args.map_size, args.map_size, args.layers, args.seed)
+    print("Map: {:d}x{:d}, {:d} layers".format(args.map_size, args.map_size, args.layers))
+
+    rle = results.measure('dump_map', lambda: maps.dump_map(m))
+    results.measure('serialize map', lambda: json_bytes(rle))
+
+    packed = results.measure('dump_map packed', lambda: maps.dump_map(m, packed=True))
+    packed_json = results.measure('serialize map packed',
+            lambda: encoders.dumps('json', packed))
+
+    return {'map': digest(json_bytes(rle)), 'map_packed': digest(packed_json)}
+
+# modules the save converter must not import at startup
+COLD_START_HEAVY = ['numpy', 'xnb', 'maps', 'PIL', 'lxml', 'parallel', 'shards']
+
+def bench_cold_start(results, args):
+    # a converter run as thousands of short jobs pays interpreter startup and
+    # imports every time, so these are timed in fresh processes and the save
+    # converter's overhead over a bare interpreter held to a budget
+    directory = os.path.dirname(os.path.abspath(__file__))
+    run = lambda command: subprocess.run(command, cwd=directory, stdout=subprocess.DEVNULL, check=True)
+
+    results.measure('cold start python', lambda: run([sys.executable, '-c', 'pass']), memory=False)
+    python = results.stages[-1]['seconds']
+
+    results.measure('cold start sv_render save',
+            lambda: run([sys.executable, 'sv_render.py', 'save', '--help']), memory=False)
+    save = results.stages[-1]['seconds']
+
+    if importlib.util.find_spec('xnb') is None:
+        print("Skipping cold start sv_render maps: No module named 'xnb'")
+    else:
+        results.measure('cold start sv_render maps',
+                lambda: run([sys.executable, 'sv_render.py', 'maps', '--help']), memory=False)
+
+    print("{:<36s} {:9.3f} s {:>12s}".format('save over python, budget', save - python, '{:.3f} s'.format(args.cold_start_budget)))
+    results.check('cold start save within budget', True, save - python <= args.cold_start_budget)
+
+    imported = subprocess.run([sys.executable, '-c', 'import sys, json_save; print(" ".join(m for m in {!r} if m in sys.modules))'.format(COLD_START_HEAVY)],
+            cwd=directory, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.split()
+    results.check('cold start save imports', [], imported)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the converters on synthetic saves and maps.")
+    parser.add_argument('--save', help="benchmark this save instead of a synthetic one")
+    parser.add_argument('--locations', type=int, default=4)
+    for key, count in sorted(synthetic.DEFAULT_COUNTS.items()):
+        parser.add_argument('--' + key, type=int, default=count,
+                help="{:s} per synthetic location (default: %(default)s)".format(key))
+    parser.add_argument('--map-size', type=int, default=150, help="width and height of the synthetic map in tiles")
+    parser.add_argument('--layers', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage; the best time is reported")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help="also time the process pool with JOBS workers (0 for one per core)")
+    extract.add_arguments(parser)
+    parser.add_argument('--skip-maps', action='store_true')
+    parser.add_argument('--skip-cold-start', action='store_true')
+    parser.add_argument('--cold-start-budget', type=float, default=0.1,
+            help="seconds that starting the save converter may take over starting python (default: %(default)s)")
+    parser.add_argument('--golden',
+            help="JSON file of output digests to compare against, written if it does not exist")
+    parser.add_argument('--update-golden', action='store_true', help="overwrite the golden file")
+    parser.add_argument('--output', help="write timings and check results to this JSON file")
+    args = parser.parse_args()
+
+    extract.setBackend(args.xml)
+    results = Results(args.repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = args.save
+        if filename is None:
+            filename = os.path.join(directory, 'save.xml')
+            counts = dict((key, getattr(args, key)) for key in synthetic.DEFAULT_COUNTS)
+            with open(filename, 'w', encoding='utf-8') as f:
+                synthetic.write_save(f, args.locations, counts, seed=args.seed)
+
+        digests = bench_save(results, filename, args)
+
+    if not args.skip_maps:
+        digests.update(bench_maps(results, args))
+
+    if not args.skip_cold_start:
+        bench_cold_start(results, args)
+
+    if args.golden is not None:
+        # digests only mean something for the same input
+        params = dict((key, value) for key, value in vars(args).items()
+                if key not in ('repeat', 'jobs', 'xml', 'golden', 'update_golden', 'output', 'skip_cold_start', 'cold_start_budget'))
+        digests['params'] = params
+
+        if args.update_golden or not os.path.exists(args.golden):
+            print("Writing golden digests...")
+            with open(args.golden, 'w') as f:
+                json.dump(digests, f, indent=4, sort_keys=True)
+        else:
+            with open(args.golden) as f:
+                golden = json.load(f)
+            if golden.get('params') != params:
+                sys.exit("{:s} was written for different parameters: {}".format(args.golden, golden.get('params')))
+            for key in sorted(golden):
+                if key == 'params':
+                    continue
+                results.check('golden ' + key, golden[key], digests.get(key))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'stages': results.stages, 'checks': results.checks, 'digests': digests}, f, indent=4)
+
+    if not all(c['ok'] for c in results.checks):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+import re
+import argparse
+
+import encoders
+import tilesheets
+
+# viewer data files, as named in www/index.html
+DATA_DIR        = 'data'
+SAVE_NAME       = 'save'
+MAPS_NAME       = 'maps'
+TILESHEETS_FILE = 'tilesheets.json'
+INDEX_FILE      = 'index.html'
+
+def location_names(save_filename):
+    save_dump = encoders.load(save_filename)
+    return [location['name'] for location in save_dump['locations']]
+
+def point_viewer(viewer_dir, extension):
+    # index.html names the .json data files; other formats need their own
+    # extension there, or the viewer fetches files that were never written
+    filename = os.path.join(viewer_dir, INDEX_FILE)
+    if not os.path.exists(filename):
+        print("No {:s} in {:s} to point at the data".format(INDEX_FILE, viewer_dir))
+        return
+
+    with open(filename, encoding='utf-8') as f:
+        html = f.read()
+    for attribute, name in [('data-save', SAVE_NAME), ('data-maps', MAPS_NAME)]:
+        html = re.sub(r'{:s}="[^"]*"'.format(attribute), '{:s}="{:s}/{:s}{:s}"'.format(attribute, DATA_DIR, name, extension), html)
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(html)
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Convert a Stardew Valley save and the maps of its locations into the data directory of a viewer.")
+    parser.add_argument('save_file')
+    parser.add_argument('map_dir', help="directory containing the map files, named after the locations")
+    parser.add_argument('viewer_dir', help="viewer directory; files are written to its {:s} directory".format(DATA_DIR))
+    parser.add_argument('--format', choices=sorted(encoders.WRITERS), default='json',
+            help="format of the save and maps (default: %(default)s)")
+    parser.add_argument('--tiles', choices=['rle', 'packed'], default='rle',
+            help="layer tile format (default: %(default)s)")
+    parser.add_argument('--buckets', type=int, nargs='?', const=32, metavar='SIZE',
+            help="index each location's objects by SIZE x SIZE tile chunks")
+    parser.add_argument('--instanced', action='store_true',
+            help="write terrain features as instance groups")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help="convert locations and maps in a pool of JOBS worker processes (0 for one per core)")
+    parser.add_argument('--cache', help="directory to cache converted maps in")
+    parser.add_argument('--tilesheet-dir', default=tilesheets.DEFAULT_DIR,
+            help="directory containing the tilesheet metadata files (default: %(default)s)")
+    parser.add_argument('--publish', action='store_true',
+            help="also publish the data directory under content-hashed names")
+    args = parser.parse_args(argv)
+
+    data_dir = os.path.join(args.viewer_dir, DATA_DIR)
+    os.makedirs(data_dir, exist_ok=True)
+
+    extension = encoders.EXTENSIONS[args.format]
+    save_filename = os.path.join(data_dir, SAVE_NAME + extension)
+    maps_filename = os.path.join(data_dir, MAPS_NAME + extension)
+    manifest = os.path.join(data_dir, TILESHEETS_FILE)
+
+    # the manifest is written from scratch, so it only has what these use
+    if os.path.exists(manifest):
+        os.remove(manifest)
+
+    options = ['--tilesheet-dir', args.tilesheet_dir, '--manifest', manifest]
+    if args.jobs is not None:
+        options += ['--jobs', str(args.jobs)]
+
+    import json_save
+    save_options = list(options)
+    if args.buckets is not None:
+        save_options += ['--buckets', str(args.buckets)]
+    if args.instanced:
+        save_options.append('--instanced')
+    json_save.main([args.save_file, save_filename] + save_options)
+
+    names = []
+    for name in location_names(save_filename):
+        if os.path.exists(os.path.join(args.map_dir, name + '.xnb')):
+            names.append(name)
+        else:
+            print("No map for location '{:s}'".format(name))
+
+    import json_map
+    map_options = options + ['--map-dir', args.map_dir, '--tiles', args.tiles]
+    if args.cache is not None:
+        map_options += ['--cache', args.cache]
+    json_map.main([maps_filename] + names + map_options)
+
+    point_viewer(args.viewer_dir, extension)
+
+    if args.publish:
+        import publish
+        manifest, written = publish.publish(args.viewer_dir, [DATA_DIR], args.viewer_dir)
+        print("Published {:d} new files, {:d} in manifest".format(written, len(manifest)))
+
+if __name__ == '__main__':
+    main()
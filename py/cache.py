@@ -0,0 +1,103 @@
+import os
+import time
+import pickle
+import hashlib
+
+# put evicts each time this fraction of max_bytes has been written since the
+# last eviction, so a long run cannot grow the cache far beyond it
+EVICT_FRACTION = 0.1
+
+# temporary files older than this were left behind by a put that died
+STALE_TMP_SECONDS = 60 * 60
+
+class ConversionCache(object):
+    # on-disk cache of converter output, keyed by a hash of the input file
+    # contents and the converter settings. entries are evicted least recently
+    # used first once the cache grows beyond max_bytes. with evict_on_put
+    # false, the caller runs evict itself.
+    def __init__(self, directory, max_bytes, evict_on_put=True):
+        self.directory    = directory
+        self.max_bytes    = max_bytes
+        self.evict_on_put = evict_on_put
+        self.written      = 0
+
+    def key(self, data, *params):
+        h = hashlib.sha256()
+        for param in params:
+            h.update(repr(param).encode('utf-8'))
+            h.update(b'\0')
+        h.update(data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+
+            # mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # missing, or evicted by another run since it was opened
+            return None
+        except (EOFError, pickle.UnpicklingError):
+            # partially written or corrupt entry
+            return None
+
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first, so concurrent readers never see a
+        # partial entry
+        tmp_path = '{:s}.{:d}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(tmp_path, path)
+
+        if self.evict_on_put:
+            self.written += size
+            if self.written >= EVICT_FRACTION * self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        self.written = 0
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                # another put may still be writing this one
+                if filename.endswith('.tmp'):
+                    if time.time() - st.st_mtime > STALE_TMP_SECONDS:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,366 @@
+import os
+import sys
+import math
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import saves
+import encoders
+import tilesheets
+import layers
+
+# same as in render.js
+TILE_WIDTH  = 16
+TILE_HEIGHT = 16
+EMPTY_TILE  = layers.EMPTY_TILE
+
+GRASS_OFFSETS = [(-TILE_WIDTH // 2, 0), (0, -TILE_HEIGHT // 2), (TILE_WIDTH // 2, 0), (0, TILE_WIDTH // 2)]
+
+# pyramid tile size in pixels
+PYRAMID_TILE = 256
+
+DZI = '''<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile:d}" Overlap="{overlap:d}" Format="{format:s}">
+    <Size Width="{width:d}" Height="{height:d}"/>
+</Image>
+'''
+
+def hash_random(x, y, n):
+    # deterministic stand-in for Math.random() in [0, 1), so that grass looks
+    # the same on every render
+    h = (x * 374761393 + y * 668265263 + n * 2246822519) & 0xffffffff
+    h = ((h ^ (h >> 13)) * 1274126177) & 0xffffffff
+    h ^= h >> 16
+    return h / 4294967296.0
+
+def premultiply(img):
+    # compositing is done on premultiplied float RGBA
+    pixels = numpy.asarray(img.convert('RGBA'), dtype=numpy.float32) / 255
+    pixels[..., :3] *= pixels[..., 3:]
+    return pixels
+
+def unpremultiply(pixels):
+    alpha = pixels[..., 3:]
+    rgb = numpy.divide(pixels[..., :3], alpha, out=numpy.zeros_like(pixels[..., :3]), where=alpha > 0)
+    rgba = numpy.concatenate([rgb, alpha], axis=-1)
+    return Image.fromarray(numpy.round(numpy.clip(rgba, 0, 1) * 255).astype(numpy.uint8), 'RGBA')
+
+def blit(canvas, sprite, x, y):
+    # source-over, clipped to the canvas
+    h, w = sprite.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, canvas.shape[1]), min(y + h, canvas.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    src = sprite[y0 - y:y1 - y, x0 - x:x1 - x]
+    dst = canvas[y0:y1, x0:x1]
+    dst *= 1 - src[..., 3:]
+    dst += src
+
+class Sheets(object):
+    # tilesheet metadata and images, loaded on first use. metadata comes from
+    # the manifest if it has the sheet, as in the viewer.
+    def __init__(self, manifest, tilesheet_dir, assets_dir):
+        self.manifest      = manifest
+        self.tilesheet_dir = tilesheet_dir
+        self.assets_dir    = assets_dir
+        self.metadata      = {}
+        self.images        = {}
+        self.sprites       = {}
+
+    def meta(self, name):
+        if name not in self.metadata:
+            if name in self.manifest:
+                self.metadata[name] = self.manifest[name]
+            else:
+                try:
+                    self.metadata[name] = tilesheets.load_metadata(name, self.tilesheet_dir)
+                except FileNotFoundError:
+                    print("No metadata for tilesheet '{:s}'".format(name))
+                    self.metadata[name] = None
+        return self.metadata[name]
+
+    def image(self, img_src):
+        if img_src not in self.images:
+            filename = os.path.join(self.assets_dir, img_src)
+            try:
+                self.images[img_src] = premultiply(Image.open(filename))
+            except OSError:
+                print("Cannot load '{:s}'".format(filename))
+                self.images[img_src] = None
+        return self.images[img_src]
+
+    def rect(self, name, idx):
+        # source rectangle of tile idx, as in drawTile
+        meta = self.meta(name)
+        if meta is None:
+            return None
+        if 'sprites' in meta:
+            return meta['sprites'][idx]
+
+        # grid sheets packed into an atlas are offset within it
+        cols = meta['sheet_size'][0]
+        w, h = meta['tile_size']
+        x, y = meta.get('offset', (0, 0))
+        return [x + (idx % cols) * w, y + (idx // cols) * h, w, h]
+
+    def sprite(self, name, sx, sy, w, h):
+        key = (name, sx, sy, w, h)
+        if key not in self.sprites:
+            img = self.image(self.meta(name)['img_src'])
+            if img is None:
+                self.sprites[key] = None
+            else:
+                # pad parts outside the image with transparency, like drawImage
+                sprite = numpy.zeros((h, w, 4), dtype=numpy.float32)
+                part = img[max(sy, 0):sy + h, max(sx, 0):sx + w]
+                sprite[:part.shape[0], :part.shape[1]] = part
+                self.sprites[key] = sprite
+        return self.sprites[key]
+
+def draw_layer(canvas, r_layer, names, sheets):
+    width, height = r_layer['size']
+    idx, ts = layers.decode_tiles(r_layer['tiles'], r_layer['size'])
+
+    # draw every grid-sized tile at once: gather the distinct tiles into one
+    # array and index it with the layer. other sizes are drawn one at a time.
+    keys = ts.astype(numpy.int32) * 0x10000 + idx
+    keys[idx == EMPTY_TILE] = -1
+    unique, inverse = numpy.unique(keys, return_inverse=True)
+
+    tiles = numpy.zeros((len(unique), TILE_HEIGHT, TILE_WIDTH, 4), dtype=numpy.float32)
+    others = []
+    for n, key in enumerate(unique):
+        if key < 0:
+            continue
+        name = names[key >> 16]
+        rect = sheets.rect(name, key & 0xffff)
+        if rect is None:
+            continue
+        sprite = sheets.sprite(name, *rect)
+        if sprite is None:
+            continue
+        if sprite.shape[:2] == (TILE_HEIGHT, TILE_WIDTH):
+            tiles[n] = sprite
+        else:
+            others.append(n)
+
+    layer = tiles[inverse.reshape(height, width)]
+    layer = layer.transpose(0, 2, 1, 3, 4).reshape(height * TILE_HEIGHT, width * TILE_WIDTH, 4)
+    blit(canvas, layer, 0, 0)
+
+    inverse = inverse.reshape(height, width)
+    for n in others:
+        key = unique[n]
+        name = names[key >> 16]
+        rect = sheets.rect(name, key & 0xffff)
+        sprite = sheets.sprite(name, *rect)
+        for row, col in zip(*numpy.nonzero(inverse == n)):
+            blit(canvas, sprite, col * TILE_WIDTH, row * TILE_HEIGHT - (rect[3] - TILE_HEIGHT))
+
+def location_objects(save_dump, location_dump):
+    # the objects the viewer draws, in the same order (see locationLoaded)
+    names = save_dump['tilesheets']
+    objects = []
+
+    def ts_name(ts):
+        # the farm house and greenhouse have their id wrapped in a list
+        if isinstance(ts, (list, tuple)):
+            ts = ts[0]
+        return names[ts]
+
+    for item in location_dump['items']:
+        objects.append({'ts': ts_name(item['ts']), 'idx': item['idx'], 'pos': item['pos']})
+
+    for building in location_dump['buildings']:
+        objects.append({
+                'ts':  ts_name(building['ts']),
+                'idx': building['idx'],
+                'pos': [building['pos'][0], building['pos'][1] + building['size'][1] - 1]
+            })
+
+    if 'instances' in location_dump:
+        features = saves.expandInstances(location_dump['instances'])
+    else:
+        features = location_dump['features']
+
+    for feature in features:
+        if feature is None:
+            continue
+        obj = {'ts': ts_name(feature['ts']), 'idx': feature['idx'], 'pos': feature['pos']}
+        for key in ['tileSize', 'offset', 'isGrass', 'isStump']:
+            if key in feature:
+                obj[key] = feature[key]
+        objects.append(obj)
+
+    order = sorted(range(len(objects)), key=lambda i: saves.drawKey(objects[i]['pos'][1], i, objects[i]))
+    return [objects[i] for i in order]
+
+def draw_object(canvas, obj, sheets):
+    rect = sheets.rect(obj['ts'], obj['idx'])
+    if rect is None:
+        return
+    sx, sy, w, h = rect
+
+    if 'tileSize' in obj:
+        w, h = obj['tileSize']
+
+    off_x, off_y = obj.get('offset', (0, 0))
+    col, row = obj['pos']
+
+    dx = col * TILE_WIDTH + off_x
+    dy = row * TILE_HEIGHT - (h - TILE_HEIGHT) + off_y
+
+    sprite = sheets.sprite(obj['ts'], sx, sy, w, h)
+    if sprite is None:
+        return
+    blit(canvas, sprite, dx, dy)
+
+    if obj.get('isGrass'):
+        # four more tufts around the tile
+        tile_w = sheets.meta(obj['ts'])['tile_size'][0]
+        for i, (gx, gy) in enumerate(GRASS_OFFSETS):
+            variant = int(hash_random(col, row, i * 3) * 3)
+            ox = gx + int(math.floor(hash_random(col, row, i * 3 + 1) * TILE_WIDTH / 2 - TILE_WIDTH / 4))
+            oy = gy + int(math.floor(hash_random(col, row, i * 3 + 2) * TILE_WIDTH / 2 - TILE_WIDTH / 4))
+            grass = sheets.sprite(obj['ts'], sx + variant * tile_w, sy, w, h)
+            blit(canvas, grass, dx + ox, dy + oy)
+
+def compose(map_dump, sheets, save_dump=None, location_dump=None):
+    # the location as drawMap draws it at zoom 1, premultiplied
+    width  = max(l['size'][0] * l['tile_size'][0] for l in map_dump['layers'])
+    height = max(l['size'][1] * l['tile_size'][1] for l in map_dump['layers'])
+    canvas = numpy.zeros((height, width, 4), dtype=numpy.float32)
+
+    names = map_dump['tilesheets']
+    for r_layer in map_dump['layers']:
+        if r_layer.get('vis', True) and r_layer['depth'] <= 0:
+            draw_layer(canvas, r_layer, names, sheets)
+
+    if location_dump is not None:
+        # objects have their own canvas in the viewer, the size of the layers
+        objects = numpy.zeros_like(canvas)
+        for obj in location_objects(save_dump, location_dump):
+            draw_object(objects, obj, sheets)
+        blit(canvas, objects, 0, 0)
+
+    for r_layer in map_dump['layers']:
+        if r_layer.get('vis', True) and r_layer['depth'] > 0:
+            draw_layer(canvas, r_layer, names, sheets)
+
+    return canvas
+
+def downsample(pixels):
+    # halves the size, averaging 2x2 blocks; odd edges are padded with
+    # transparency
+    h, w = pixels.shape[:2]
+    if h % 2 or w % 2:
+        pixels = numpy.pad(pixels, ((0, h % 2), (0, w % 2), (0, 0)))
+    return (pixels[0::2, 0::2] + pixels[1::2, 0::2] + pixels[0::2, 1::2] + pixels[1::2, 1::2]) / 4
+
+def write_pyramid(pixels, output_dir, name, tile=PYRAMID_TILE, overlap=0, format='png'):
+    # a Deep Zoom image: name.dzi, and name_files/<level>/<col>_<row>.<format>
+    # where level 0 is 1x1 and the last level is full size
+    height, width = pixels.shape[:2]
+    max_level = int(math.ceil(math.log2(max(width, height, 1))))
+
+    files_dir = os.path.join(output_dir, name + '_files')
+    for level in range(max_level, -1, -1):
+        level_dir = os.path.join(files_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+
+        h, w = pixels.shape[:2]
+        for row in range(int(math.ceil(h / tile))):
+            for col in range(int(math.ceil(w / tile))):
+                x0, y0 = max(col * tile - overlap, 0), max(row * tile - overlap, 0)
+                x1, y1 = min((col + 1) * tile + overlap, w), min((row + 1) * tile + overlap, h)
+                img = unpremultiply(pixels[y0:y1, x0:x1])
+                if format == 'jpg':
+                    img = img.convert('RGB')
+                img.save(os.path.join(level_dir, '{:d}_{:d}.{:s}'.format(col, row, format)))
+
+        if level > 0:
+            pixels = downsample(pixels)
+
+    with open(os.path.join(output_dir, name + '.dzi'), 'w') as f:
+        f.write(DZI.format(tile=tile, overlap=overlap, format=format, width=width, height=height))
+
+def find_sharded(data, filename, name, key):
+    # the object called name in data, an export or a shard index loaded from
+    # filename
+    if 'shards' in data:
+        shard = data['shards'].get(name)
+        if shard is None:
+            return None
+        return encoders.load(os.path.join(os.path.dirname(filename), shard))
+
+    return key(data, name)
+
+def map_by_name(maps_dump, name):
+    return maps_dump.get(name)
+
+def location_by_name(save_dump, name):
+    for location_dump in save_dump['locations']:
+        if location_dump['name'] == name:
+            return location_dump
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Render locations to Deep Zoom image pyramids.")
+    parser.add_argument('maps', help="output of json_map.py, or its shard index")
+    parser.add_argument('output_dir')
+    parser.add_argument('locations', nargs='+', metavar='location')
+    parser.add_argument('--save', help="output of json_save.py, or its shard index, to draw the objects of")
+    parser.add_argument('--manifest', help="tilesheet manifest, e.g. with atlases")
+    parser.add_argument('--tilesheet-dir', default=tilesheets.DEFAULT_DIR,
+            help="directory containing the tilesheet metadata files (default: %(default)s)")
+    parser.add_argument('--assets-dir', required=True,
+            help="directory the viewer loads tilesheet images from, i.e. the assets directory next to its index.html. "
+                 "the repository does not ship it; it holds the game's unpacked images")
+    parser.add_argument('--tile-size', type=int, default=PYRAMID_TILE)
+    parser.add_argument('--overlap', type=int, default=0)
+    parser.add_argument('--format', choices=['png', 'jpg'], default='png')
+    args = parser.parse_args()
+
+    if numpy is None or Image is None:
+        print("Rendering requires numpy and Pillow")
+        sys.exit(1)
+
+    if not os.path.isdir(args.assets_dir):
+        print("No tilesheet image directory '{:s}'".format(args.assets_dir))
+        sys.exit(1)
+
+    manifest = encoders.load(args.manifest) if args.manifest is not None else {}
+    sheets = Sheets(manifest, args.tilesheet_dir, args.assets_dir)
+
+    maps_data = encoders.load(args.maps)
+    save_dump = encoders.load(args.save) if args.save is not None else None
+
+    print("Rendering locations...")
+    for name in args.locations:
+        print('\t{:s}'.format(name))
+
+        map_dump = find_sharded(maps_data, args.maps, name, map_by_name)
+        if map_dump is None:
+            print("No map '{:s}'".format(name))
+            continue
+
+        location_dump = None
+        if save_dump is not None:
+            location_dump = find_sharded(save_dump, args.save, name, location_by_name)
+
+        pixels = compose(map_dump, sheets, save_dump, location_dump)
+        write_pyramid(pixels, args.output_dir, name, args.tile_size, args.overlap, args.format)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import io
+import json
+import base64
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# output formats by file extension
+EXTENSIONS = {
+        'json':    '.json',
+        'msgpack': '.msgpack'
+    }
+
+# for progress messages
+NAMES = {
+        'json':    'JSON',
+        'msgpack': 'MessagePack'
+    }
+
+def format_for(filename, default='json'):
+    for name, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return name
+    return default
+
+def json_default(o):
+    # bytes (e.g. packed tile arrays) are written to JSON as base64 strings
+    if isinstance(o, bytes):
+        return base64.b64encode(o).decode('ascii')
+
+    raise TypeError("Object of type {} is not JSON serializable".format(type(o).__name__))
+
+class Writer(object):
+    # streams one document to the binary file f. containers are opened with
+    # begin_map or begin_array, given their number of items, and closed with
+    # end. map items are a key followed by a value or container; value writes
+    # a whole object at once.
+    def __init__(self, f):
+        self.f     = f
+        self.stack = []
+
+    def begin(self, is_map, n):
+        self.stack.append([is_map, n, 0])
+
+    def item(self):
+        if len(self.stack) > 0:
+            self.stack[-1][2] += 1
+
+    def end(self):
+        is_map, n, count = self.stack.pop()
+        if count != n:
+            raise ValueError("Container declared with {:d} items has {:d}".format(n, count))
+
+    def dump(self, obj):
+        # writes obj as the whole document
+        self.value(obj)
+
+class JSONWriter(Writer):
+    # writes the same bytes as json.dump(obj, f, separators=(',',':'))
+    def __init__(self, f, default=json_default):
+        Writer.__init__(self, f)
+        self.default = default
+        self.after_key = False
+
+    def write(self, s):
+        self.f.write(s.encode('utf-8'))
+
+    def separate(self):
+        # maps count their keys, arrays their values
+        if self.after_key:
+            self.after_key = False
+        elif len(self.stack) > 0:
+            if self.stack[-1][2] > 0:
+                self.write(',')
+            self.item()
+
+    def begin_map(self, n):
+        self.separate()
+        self.write('{')
+        self.begin(True, n)
+
+    def begin_array(self, n):
+        self.separate()
+        self.write('[')
+        self.begin(False, n)
+
+    def key(self, k):
+        self.separate()
+        self.write(json.dumps(k))
+        self.write(':')
+        self.after_key = True
+
+    def value(self, obj):
+        self.separate()
+        self.write(json.dumps(obj, separators=(',',':'), default=self.default))
+
+    def end(self):
+        is_map = self.stack[-1][0]
+        Writer.end(self)
+        self.write('}' if is_map else ']')
+
+def pack_header(n, fix, fix_max, code16, code32):
+    if n <= fix_max:
+        return struct.pack('B', fix | n)
+    elif n <= 0xffff:
+        return struct.pack('>BH', code16, n)
+    return struct.pack('>BI', code32, n)
+
+def pack_array_header(n):
+    return pack_header(n, 0x90, 15, 0xdc, 0xdd)
+
+def pack_map_header(n):
+    return pack_header(n, 0x80, 15, 0xde, 0xdf)
+
+def pack_int(i):
+    if 0 <= i < 0x80:
+        return struct.pack('B', i)
+    elif -32 <= i < 0:
+        return struct.pack('b', i)
+    elif i >= 0:
+        for code, fmt, limit in [(0xcc, '>BB', 8), (0xcd, '>BH', 16), (0xce, '>BI', 32), (0xcf, '>BQ', 64)]:
+            if i < 1 << limit:
+                return struct.pack(fmt, code, i)
+    else:
+        for code, fmt, limit in [(0xd0, '>Bb', 7), (0xd1, '>Bh', 15), (0xd2, '>Bi', 31), (0xd3, '>Bq', 63)]:
+            if i >= -(1 << limit):
+                return struct.pack(fmt, code, i)
+    raise OverflowError("Integer {:d} does not fit in MessagePack".format(i))
+
+def pack_raw(data, fix, fix_max, code8, code16, code32):
+    n = len(data)
+    if fix is not None and n <= fix_max:
+        header = struct.pack('B', fix | n)
+    elif n <= 0xff:
+        header = struct.pack('>BB', code8, n)
+    elif n <= 0xffff:
+        header = struct.pack('>BH', code16, n)
+    else:
+        header = struct.pack('>BI', code32, n)
+    return header + data
+
+def pack(obj, out):
+    # appends the MessagePack encoding of obj to the list out; matches
+    # msgpack.packb(obj, use_bin_type=True)
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, int):
+        out.append(pack_int(obj))
+    elif isinstance(obj, float):
+        out.append(struct.pack('>Bd', 0xcb, obj))
+    elif isinstance(obj, str):
+        out.append(pack_raw(obj.encode('utf-8'), 0xa0, 31, 0xd9, 0xda, 0xdb))
+    elif isinstance(obj, bytes):
+        out.append(pack_raw(obj, None, None, 0xc4, 0xc5, 0xc6))
+    elif isinstance(obj, (list, tuple)):
+        out.append(pack_array_header(len(obj)))
+        for item in obj:
+            pack(item, out)
+    elif isinstance(obj, dict):
+        out.append(pack_map_header(len(obj)))
+        for k, v in obj.items():
+            pack(k, out)
+            pack(v, out)
+    else:
+        raise TypeError("Object of type {} is not MessagePack serializable".format(type(obj).__name__))
+
+class MsgpackWriter(Writer):
+    # uses the msgpack package if it is installed, and a pure Python packer
+    # with the same output otherwise. bytes are written as bin.
+    def __init__(self, f):
+        Writer.__init__(self, f)
+        if msgpack is not None:
+            packer = msgpack.Packer(use_bin_type=True)
+            self.packb             = packer.pack
+            self.pack_array_header = packer.pack_array_header
+            self.pack_map_header   = packer.pack_map_header
+        else:
+            self.packb             = packb
+            self.pack_array_header = pack_array_header
+            self.pack_map_header   = pack_map_header
+
+    def begin_map(self, n):
+        self.item()
+        self.f.write(self.pack_map_header(n))
+        self.begin(True, n)
+
+    def begin_array(self, n):
+        self.item()
+        self.f.write(self.pack_array_header(n))
+        self.begin(False, n)
+
+    def key(self, k):
+        self.f.write(self.packb(k))
+
+    def value(self, obj):
+        self.item()
+        self.f.write(self.packb(obj))
+
+def packb(obj):
+    out = []
+    pack(obj, out)
+    return b''.join(out)
+
+WRITERS = {
+        'json':    JSONWriter,
+        'msgpack': MsgpackWriter
+    }
+
+def writer(name, f):
+    return WRITERS[name](f)
+
+def dump(name, obj, f):
+    writer(name, f).dump(obj)
+
+def dumps(name, obj):
+    f = io.BytesIO()
+    dump(name, obj, f)
+    return f.getvalue()
+
+def load(filename):
+    # reads a file written by dump, in the format given by its extension.
+    # bytes come back as base64 strings from JSON.
+    if format_for(filename) == 'msgpack':
+        if msgpack is None:
+            raise ImportError("Reading MessagePack requires the msgpack package")
+        with open(filename, 'rb') as f:
+            return msgpack.unpackb(f.read(), raw=False)
+
+    with open(filename) as f:
+        return json.load(f)
@@ -0,0 +1,158 @@
+import xml.etree.ElementTree
+
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+# field converters; they take the field's element
+def text(el):
+    return el.text
+
+def integer(el):
+    return int(el.text)
+
+def boolean(el):
+    return el.text == 'true'
+
+def element(el):
+    return el
+
+# source for the converters above, inlined into compiled extractors
+INLINE = {
+        text:    '{}.text',
+        integer: 'int({}.text)',
+        boolean: "({}.text == 'true')",
+        element: '{}'
+    }
+
+class EtreeBackend(object):
+    name   = 'etree'
+    module = xml.etree.ElementTree
+    ParseError = xml.etree.ElementTree.ParseError
+
+    @staticmethod
+    def collect(tags):
+        # Element.find with a plain tag never leaves C
+        lines = ['find = el.find']
+        for idx, tag in enumerate(tags):
+            lines.append('c{:d} = find({!r})'.format(idx, tag))
+        return lines
+
+    @staticmethod
+    def child(expr, tag):
+        return '{:s}.find({!r})'.format(expr, tag)
+
+class LxmlBackend(object):
+    # module and ParseError are filled in by getBackend, so lxml is only
+    # imported when asked for
+    name   = 'lxml'
+    module = None
+    ParseError = None
+
+    @staticmethod
+    def collect(tags):
+        # iterchildren filters by tag in C, so only the wanted children get a
+        # Python proxy; find goes through lxml's Python ElementPath instead
+        lines = [
+                'found = {}',
+                'for child in el.iterchildren(*TAGS):',
+                '    if child.tag not in found:',
+                '        found[child.tag] = child'
+            ]
+        for idx, tag in enumerate(tags):
+            lines.append('c{:d} = found.get({!r})'.format(idx, tag))
+        return lines
+
+    @staticmethod
+    def child(expr, tag):
+        return 'next({:s}.iterchildren({!r}), None)'.format(expr, tag)
+
+BACKENDS = {
+        'etree': EtreeBackend,
+        'lxml':  LxmlBackend
+    }
+
+# all schemas, so they can be recompiled when the backend changes
+schemas = []
+
+def importLxml():
+    if LxmlBackend.module is not None:
+        return True
+
+    try:
+        import lxml.etree
+    except ImportError:
+        return False
+
+    LxmlBackend.module     = lxml.etree
+    LxmlBackend.ParseError = lxml.etree.ParseError
+    return True
+
+def getBackend(name='etree'):
+    # lxml parses faster, but building the save model from it is slower, so
+    # it only pays off for saves that are mostly XML the model ignores
+    if name not in BACKENDS:
+        raise ValueError("Unknown XML backend '{:s}'".format(name))
+
+    if name == 'lxml':
+        importLxml()
+
+    if BACKENDS[name].module is None:
+        raise ValueError("XML backend '{:s}' is not installed".format(name))
+
+    return BACKENDS[name]
+
+def add_arguments(parser):
+    # the --xml option of the command line tools; args.xml goes to setBackend
+    parser.add_argument('--xml', choices=sorted(BACKENDS), default='etree',
+            help="XML parser; lxml parses faster but makes the whole conversion slower (default: %(default)s)")
+
+def setBackend(name='etree'):
+    global backend
+    backend = getBackend(name)
+
+    for schema in schemas:
+        schema.compile()
+
+# backend used by Schema.extract and for parsing saves
+backend = getBackend()
+
+class Schema(object):
+    # a list of (path, converter) fields. extract(el) returns a tuple with the
+    # converted value of each field. paths are relative to el, like those
+    # passed to el.find, but only support plain tags separated by '/'.
+    #
+    # each schema is compiled into a function for the current backend that
+    # looks up all first steps in one go, follows any further steps one plain
+    # tag at a time and inlines the standard converters.
+    def __init__(self, *fields):
+        self.fields = fields
+        schemas.append(self)
+        self.compile()
+
+    def compile(self):
+        tags = []
+        for path, convert in self.fields:
+            tag = path.split('/')[0]
+            if tag not in tags:
+                tags.append(tag)
+
+        namespace = {'TAGS': tuple(tags)}
+        values = []
+        for idx, (path, convert) in enumerate(self.fields):
+            steps = path.split('/')
+
+            expr = 'c{:d}'.format(tags.index(steps[0]))
+            for tag in steps[1:]:
+                expr = backend.child(expr, tag)
+
+            if convert in INLINE:
+                values.append(INLINE[convert].format(expr))
+            else:
+                namespace['convert{:d}'.format(idx)] = convert
+                values.append('convert{:d}({:s})'.format(idx, expr))
+
+        lines  = ['def extract(el):']
+        lines += ['    ' + line for line in backend.collect(tags)]
+        lines += ['    return ({:s},)'.format(', '.join(values))]
+
+        exec('\n'.join(lines), namespace)
+        self.extract = namespace['extract']
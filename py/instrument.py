@@ -0,0 +1,154 @@
+import json
+import time
+import cProfile
+import contextlib
+import tracemalloc
+
+class Phase(object):
+    __slots__ = ['name', 'info', 'wall', 'cpu', 'peak']
+
+    def __init__(self, name, info):
+        self.name = name
+        self.info = info
+        self.wall = time.perf_counter()
+        self.cpu  = time.process_time()
+        self.peak = 0
+
+    def dump(self):
+        output = {'phase': self.name}
+        output.update(self.info)
+        output['wall'] = round(self.wall, 6)
+        output['cpu']  = round(self.cpu, 6)
+        if self.peak is not None:
+            output['peak_bytes'] = self.peak
+        return output
+
+class Recorder(object):
+    # collects timings, counts and output sizes for --stats. a disabled
+    # recorder does nothing, so callers don't need to check.
+    def __init__(self, enabled=True, memory=True, encode=None):
+        self.enabled = enabled
+        self.memory  = enabled and memory
+        self.encode  = encode
+        self.phases  = []
+        self.stack   = []
+        self.counts  = {}
+        self.sizes   = {}
+        self.values  = {}
+
+    def start(self):
+        if self.memory:
+            tracemalloc.start()
+
+    def stop(self):
+        if self.memory:
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def phase(self, name, **info):
+        if not self.enabled:
+            yield
+            return
+
+        # the tracemalloc peak is global, so fold it into the enclosing phase
+        # before resetting it for this one
+        if self.memory:
+            if len(self.stack) > 0:
+                self.stack[-1].peak = max(self.stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        p = Phase(name, info)
+        self.stack.append(p)
+        try:
+            yield p
+        finally:
+            self.stack.pop()
+            p.wall = time.perf_counter() - p.wall
+            p.cpu  = time.process_time() - p.cpu
+
+            if self.memory:
+                p.peak = max(p.peak, tracemalloc.get_traced_memory()[1])
+                if len(self.stack) > 0:
+                    self.stack[-1].peak = max(self.stack[-1].peak, p.peak)
+            else:
+                p.peak = None
+
+            self.phases.append(p)
+
+    def timed(self, name, iterable, label=None):
+        # yields the items of iterable, recording each step of the iteration
+        # (e.g. parsing the next location) as a phase. label names the phase
+        # after its item.
+        it = iter(iterable)
+        done = object()
+        while True:
+            with self.phase(name) as p:
+                item = next(it, done)
+                if p is not None and label is not None and item is not done:
+                    p.info['name'] = label(item)
+
+            if item is done:
+                # the last step only found the end of the iteration
+                if self.enabled:
+                    self.phases.pop()
+                return
+
+            yield item
+
+    def count(self, section, key, n=1):
+        if not self.enabled:
+            return
+        counts = self.counts.setdefault(section, {})
+        counts[key] = counts.get(key, 0) + n
+
+    def add_phases(self, phases):
+        # finished phases recorded in another process, e.g. a worker's
+        if self.enabled:
+            self.phases.extend(phases)
+
+    def add_counts(self, counts):
+        # counts is {section: {key: n}}, e.g. from Location.counts
+        for section, section_counts in counts.items():
+            for key, n in section_counts.items():
+                self.count(section, key, n)
+
+    def size(self, section, key, obj):
+        # bytes obj takes up as encoded by self.encode, or in compact JSON
+        if not self.enabled:
+            return
+        if self.encode is None:
+            data = json.dumps(obj, separators=(',',':'))
+        else:
+            data = self.encode(obj)
+        self.sizes.setdefault(section, {})[key] = len(data)
+
+    def set(self, key, value):
+        if self.enabled:
+            self.values[key] = value
+
+    def dump(self):
+        output = dict(self.values)
+        output['phases'] = [p.dump() for p in self.phases]
+        output['counts'] = self.counts
+        output['bytes']  = self.sizes
+        return output
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.dump(), f, indent=4, sort_keys=True)
+
+@contextlib.contextmanager
+def profiled(filename):
+    # runs the block under cProfile and writes the stats to filename, for
+    # pstats or snakeviz. does nothing if filename is None.
+    if filename is None:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
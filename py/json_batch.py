@@ -0,0 +1,233 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import itertools
+import concurrent.futures
+
+import saves
+import extract
+import tilesheets
+import encoders
+import watch
+
+# written to the output directory unless --report is given
+REPORT_FILE = 'batch.json'
+
+# set in each worker process by initWorker
+_format     = None
+_bucketSize = None
+
+def initWorker(backend, format, bucket_size):
+    global _format, _bucketSize
+    _format     = format
+    _bucketSize = bucket_size
+    extract.setBackend(backend)
+
+def convertSave(filename, output_filename):
+    # runs in a worker. errors are returned rather than raised, so a corrupt
+    # save only fails itself; the output is only replaced once it is complete.
+    start = time.perf_counter()
+    tmp_filename = output_filename + '.tmp'
+    try:
+        save_file = saves.Save.load(filename)
+        save_file.bucketSize = _bucketSize
+        save_dump = save_file.dump()
+
+        with open(tmp_filename, 'wb') as f:
+            encoders.dump(_format, save_dump, f)
+        os.replace(tmp_filename, output_filename)
+
+    except Exception as e:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return {
+                'status':  'failed',
+                'error':   '{:s}: {}'.format(type(e).__name__, e),
+                'seconds': time.perf_counter() - start
+            }
+
+    return {
+            'status':     'ok',
+            'seconds':    time.perf_counter() - start,
+            'bytes':      os.path.getsize(output_filename),
+            'tilesheets': save_file.tilesheets.names
+        }
+
+def findSaves(paths):
+    # a path is a save file, a save directory, or a directory of either
+    for path in paths:
+        filename = watch.saveFilename(path)
+        if os.path.isfile(filename):
+            yield filename
+            continue
+
+        if not os.path.isdir(path):
+            print("No save at {:s}".format(path))
+            continue
+
+        for name in sorted(os.listdir(path)):
+            if name.startswith('.'):
+                continue
+            filename = watch.saveFilename(os.path.join(path, name))
+            if os.path.isfile(filename):
+                yield filename
+
+def readList(filename):
+    # one save per line, relative to the list file
+    directory = os.path.dirname(filename)
+    with open(filename) as f:
+        return [os.path.join(directory, line.strip()) for line in f if line.strip() and not line.startswith('#')]
+
+def outputFilenames(filenames, output_dir, extension):
+    # named after the save file, with a suffix for saves of the same name
+    used = set()
+    output = []
+    for filename in filenames:
+        base = re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.splitext(os.path.basename(filename))[0])
+        name = base + extension
+
+        n = 1
+        while name in used:
+            name = '{:s}-{:d}{:s}'.format(base, n, extension)
+            n += 1
+
+        used.add(name)
+        output.append(os.path.join(output_dir, name))
+    return output
+
+def runPool(tasks, jobs, initargs, lost):
+    # yields (task, result) as tasks finish. a worker that dies (e.g. killed
+    # for running out of memory) breaks the whole pool; the tasks in flight
+    # are then added to lost and the rest go to a new pool.
+    tasks = iter(tasks)
+    max_pending = 2 * (jobs or os.cpu_count() or 1)
+
+    while True:
+        broken = False
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initWorker, initargs=initargs) as executor:
+            pending = {}
+
+            def submit(n):
+                for task in itertools.islice(tasks, n):
+                    pending[executor.submit(convertSave, *task)] = task
+
+            submit(max_pending)
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        lost.append(task)
+                        broken = True
+                        continue
+                    yield task, result
+
+                if broken:
+                    lost.extend(pending.values())
+                    break
+                submit(len(done))
+
+        if not broken:
+            return
+
+def convertAll(tasks, jobs, initargs):
+    # there is no telling which of the saves in flight killed a pool, so they
+    # are retried one at a time, each in a pool of its own
+    lost = []
+    for task, result in runPool(tasks, jobs, initargs, lost):
+        yield task, result
+
+    for task in lost:
+        crashed = []
+        for retried, result in runPool([task], 1, initargs, crashed):
+            yield retried, result
+        if len(crashed) > 0:
+            yield task, {'status': 'crashed', 'error': "worker process died", 'seconds': None}
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert many Stardew Valley save files to JSON in a pool of worker processes.")
+    parser.add_argument('saves', nargs='*', metavar='save',
+            help="save file, save directory, or directory of saves")
+    parser.add_argument('output_dir')
+    parser.add_argument('--list', help="file listing saves to convert, one per line")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+            help="number of worker processes (default: one per core)")
+    parser.add_argument('--format', choices=sorted(encoders.WRITERS), default='json',
+            help="output format (default: %(default)s)")
+    parser.add_argument('--buckets', type=int, nargs='?', const=32, metavar='SIZE',
+            help="also index each location's objects by SIZE x SIZE tile chunks, as with json_save.py")
+    parser.add_argument('--report',
+            help="per-save status and timing report (default: {:s} in the output directory)".format(REPORT_FILE))
+    parser.add_argument('--manifest',
+            help="also write the metadata of the tilesheets used by the saves to this file, adding to it if it exists")
+    parser.add_argument('--tilesheet-dir', default=tilesheets.DEFAULT_DIR,
+            help="directory containing the tilesheet metadata files (default: %(default)s)")
+    extract.add_arguments(parser)
+    args = parser.parse_args()
+
+    extract.setBackend(args.xml)
+
+    paths = list(args.saves)
+    if args.list is not None:
+        paths.extend(readList(args.list))
+    filenames = list(findSaves(paths))
+    if len(filenames) == 0:
+        sys.exit("No saves to convert")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    tasks = list(zip(filenames, outputFilenames(filenames, args.output_dir, encoders.EXTENSIONS[args.format])))
+    jobs = args.jobs or os.cpu_count() or 1
+
+    print("Converting {:d} saves with {:d} workers...".format(len(tasks), jobs))
+    start = time.perf_counter()
+
+    results = {}
+    initargs = (extract.backend.name, args.format, args.buckets)
+    for (filename, output_filename), result in convertAll(tasks, jobs, initargs):
+        results[output_filename] = result
+        if result['status'] == 'ok':
+            print("\tok      {:7.2f} s  {:s}".format(result['seconds'], filename))
+        else:
+            print("\t{:7s} {:>9s}  {:s}: {:s}".format(result['status'], '', filename, result['error']))
+
+    seconds = time.perf_counter() - start
+
+    report = []
+    statuses = {}
+    used = tilesheets.Registry()
+    for filename, output_filename in tasks:
+        result = results[output_filename]
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+        for ts in result.pop('tilesheets', []):
+            used.use(ts)
+
+        entry = {'save': filename, 'output': output_filename}
+        entry.update(result)
+        report.append(entry)
+
+    print("Converted {:d} of {:d} saves in {:.2f} s ({:.2f} saves/s)".format(
+        statuses.get('ok', 0), len(tasks), seconds, len(tasks) / seconds))
+
+    report_filename = args.report or os.path.join(args.output_dir, REPORT_FILE)
+    with open(report_filename, 'w') as f:
+        json.dump({
+                'jobs':     jobs,
+                'seconds':  seconds,
+                'statuses': statuses,
+                'saves':    report
+            }, f, indent=4)
+
+    if args.manifest is not None:
+        print("Writing tilesheet manifest...")
+        tilesheets.write_manifest(args.manifest, used.names, args.tilesheet_dir)
+
+    if statuses.get('ok', 0) != len(tasks):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,239 @@
 import sys
 import os
-import json
+import argparse
+import functools
+import concurrent.futures
 
-import xnb
-import maps
-import saves
+import tilesheets
+import cache
+import shards
+import instrument
+import encoders
 
-if len(sys.argv) < 3:
-    print("Usage: {} <output_file> [maps...]".format(sys.argv[0]))
-    sys.exit(1)
+def load_map(location, tiles, conversion_cache=None, recorder=None, directory=''):
+    # the xnb submodule is only needed once there is a map to convert, so
+    # e.g. --help works without it
+    import xnb
+    import maps
 
-_, output_filename = sys.argv[:2]
+    map_filename = os.path.join(directory, location + '.xnb')
 
-print("Loading maps...")
+    # look up map
+    if conversion_cache is not None:
+        with open(map_filename, 'rb') as f:
+            key = conversion_cache.key(f.read(), maps.VERSION, tiles)
 
-output = {}
+        map_dump = conversion_cache.get(key)
+        if map_dump is not None:
+            print('\t{:s} (cached)'.format(location))
+            if recorder is not None:
+                recorder.count('maps', 'cached')
+            return map_dump
 
-for location in sys.argv[2:]:
     print('\t{:s}'.format(location))
 
     # load map
-    map_filename = location + '.xnb'
     map_file = xnb.XNBFile(map_filename)
 
-    assert isinstance(map_file.primaryObject, xnb.xtile.Map), "File does not contain XTile map object"
+    if not isinstance(map_file.primaryObject, xnb.xtile.Map):
+        raise ValueError("File does not contain XTile map object")
 
     # dump map
-    output[location] = maps.dump_map(map_file.primaryObject)
+    map_dump = maps.dump_map(map_file.primaryObject, tiles == 'packed')
 
-# write map
-print("Writing JSON...")
+    if conversion_cache is not None:
+        conversion_cache.put(key, map_dump)
 
-with open(output_filename, 'w') as f:
-    json.dump(output, f, separators=(',',':'))
+    if recorder is not None and recorder.enabled:
+        recorder.count('maps', 'converted')
+        for layer in map_file.primaryObject.layers:
+            recorder.count('tiles', location, sum(t is not None for row in layer.tiles for t in row))
+
+    return map_dump
+
+def load_map_worker(location, tiles, conversion_cache, stats, directory):
+    # runs in a worker process; counts and the conversion time are sent back
+    # to the parent's recorder
+    recorder = instrument.Recorder(stats, memory=False)
+    with recorder.phase('map', map=location):
+        map_dump = load_map(location, tiles, conversion_cache, recorder, directory)
+    return map_dump, recorder.counts, recorder.phases
+
+def error_message(e):
+    return '{:s}: {}'.format(type(e).__name__, e)
+
+def load_maps(locations, tiles, conversion_cache, recorder, jobs=False, directory=''):
+    # yields (location, map_dump, error), map_dump being None for maps that
+    # failed to convert. maps are yielded in the order of locations, or with
+    # jobs (None for one per core) as they are converted in a pool of worker
+    # processes, with a bounded number submitted ahead.
+    if jobs is False:
+        for location in locations:
+            try:
+                with recorder.phase('map', map=location):
+                    map_dump = load_map(location, tiles, conversion_cache, recorder, directory)
+            except Exception as e:
+                yield location, None, error_message(e)
+            else:
+                yield location, map_dump, None
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        max_pending = 2 * (jobs or os.cpu_count() or 1)
+        pending = {}
+
+        def result(future):
+            location = pending.pop(future)
+            try:
+                map_dump, counts, phases = future.result()
+            except Exception as e:
+                return location, None, error_message(e)
+
+            recorder.add_counts(counts)
+            recorder.add_phases(phases)
+            return location, map_dump, None
+
+        for location in locations:
+            pending[executor.submit(load_map_worker, location, tiles, conversion_cache, recorder.enabled, directory)] = location
+
+            if len(pending) >= max_pending:
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield result(future)
+
+        for future in concurrent.futures.as_completed(list(pending)):
+            yield result(future)
+
+def convert(args, recorder):
+    if args.cache is not None:
+        conversion_cache = cache.ConversionCache(args.cache, args.cache_size * 1024 * 1024)
+    else:
+        conversion_cache = None
+
+    # each map is written as soon as it is done, to its shard or as the
+    # next item of the output map, which is keyed by map name so the order
+    # doesn't matter
+    locations = list(dict.fromkeys(args.maps))
+
+    if args.shards:
+        shard_writer = shards.ShardWriter(args.output_file, args.format)
+    else:
+        f = open(args.output_file, 'wb')
+        writer = encoders.writer(args.format, f)
+        writer.begin_map(len(locations))
+
+    print("Loading maps and writing {:s}...".format(encoders.NAMES[args.format]))
+
+    used = tilesheets.Registry()
+    failed = []
+
+    jobs = False if args.jobs is None else args.jobs or None
+    for location, map_dump, error in load_maps(locations, args.tiles, conversion_cache, recorder, jobs, args.map_dir):
+        if map_dump is None:
+            # the output keeps a null entry, as the map count is written first
+            print('\t{:s} failed: {:s}'.format(location, error))
+            failed.append(location)
+            if not args.shards:
+                writer.key(location)
+                writer.value(None)
+            continue
+
+        recorder.size('maps', location, map_dump)
+
+        for ts in map_dump['tilesheets']:
+            used.use(ts)
+
+        if args.shards:
+            shard_writer.write(location, map_dump)
+        else:
+            writer.key(location)
+            writer.value(map_dump)
+
+    if conversion_cache is not None:
+        with recorder.phase('evict'):
+            conversion_cache.evict()
+
+    if args.shards:
+        print("Writing {:s} shard index...".format(encoders.NAMES[args.format]))
+        shard_writer.write_index()
+
+    else:
+        writer.end()
+        f.close()
+
+    if args.manifest is not None:
+        print("Writing tilesheet manifest...")
+        with recorder.phase('manifest'):
+            tilesheets.write_manifest(args.manifest, used.names, args.tilesheet_dir)
+
+    if args.properties is not None:
+        # only imported here, since it imports numpy
+        import tileprops
+        print("Writing tile property tables...")
+        with recorder.phase('properties'):
+            tileprops.write_tables(args.properties, used.names, args.tilesheet_dir)
+
+    if len(failed) > 0:
+        print("{:d} of {:d} maps failed: {:s}".format(len(failed), len(locations), ', '.join(failed)))
+
+    return used, failed
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Convert Stardew Valley XTile maps to JSON.")
+    parser.add_argument('output_file', help="output file, or directory with --shards")
+    parser.add_argument('maps', nargs='*', metavar='map',
+            help="map file name without the .xnb extension, relative to --map-dir")
+    parser.add_argument('--map-dir', default='',
+            help="directory containing the map files; the output uses the names as given")
+    parser.add_argument('--tiles', choices=['rle', 'packed'], default='rle',
+            help="layer tile format: run-length encoded lists, or runs packed into uint16 tile index, uint8 tilesheet and uint16 "
+                 "run length arrays. packed layers are smaller, most of all with --format msgpack, where the arrays are bin rather than base64")
+    parser.add_argument('--format', choices=sorted(encoders.WRITERS),
+            help="output format; by default msgpack if the output file ends in .msgpack, json otherwise. packed tiles are base64 strings in json and bin in msgpack")
+    parser.add_argument('--shards', action='store_true',
+            help="write each map to its own file in the output directory, plus an index")
+    parser.add_argument('--manifest',
+            help="also write the metadata of the tilesheets used by the maps to this file, adding to it if it exists")
+    parser.add_argument('--properties',
+            help="also write per-tilesheet tile property tables, for tileprops.py, to this file")
+    parser.add_argument('--tilesheet-dir', default=tilesheets.DEFAULT_DIR,
+            help="directory containing the tilesheet metadata files (default: %(default)s)")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help="convert maps in a pool of JOBS worker processes (0 for one per core). "
+                 "maps are written as they finish, so their order in the output varies")
+    parser.add_argument('--cache',
+            help="directory to cache converted maps in, keyed by the contents of the map file")
+    parser.add_argument('--cache-size', type=int, default=256,
+            help="maximum size of the cache in megabytes (default: %(default)s)")
+    parser.add_argument('--stats',
+            help="write per-phase and per-map timings, peak memory, tile counts and output sizes to this JSON file")
+    parser.add_argument('--profile',
+            help="run the conversion under cProfile and write the stats to this file")
+    args = parser.parse_args(argv)
+
+    if args.format is None:
+        args.format = encoders.format_for(args.output_file)
+
+    recorder = instrument.Recorder(args.stats is not None, encode=functools.partial(encoders.dumps, args.format))
+    recorder.start()
+
+    with instrument.profiled(args.profile):
+        with recorder.phase('total'):
+            used, failed = convert(args, recorder)
+
+    recorder.stop()
+
+    if args.stats is not None:
+        recorder.set('tilesheets', used.names)
+        if args.shards:
+            recorder.set('output_bytes', sum(os.path.getsize(os.path.join(args.output_file, f)) for f in os.listdir(args.output_file)))
+        else:
+            recorder.set('output_bytes', os.path.getsize(args.output_file))
+        recorder.set('failed', failed)
+        recorder.write(args.stats)
+
+    if len(failed) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
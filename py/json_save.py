@@ -1,27 +1,150 @@
-import sys
 import os
-import json
+import argparse
+import functools
 
-import xnb
-import maps
 import saves
+import extract
+import tilesheets
+import instrument
+import encoders
 
-if len(sys.argv) != 3:
-    print("Usage: {} <save_file> <output_file>".format(sys.argv[0]))
-    sys.exit(1)
+def dumpLocation(location, save_file, recorder):
+    recorder.add_counts(location.counts())
+    with recorder.phase('dump', location=location.name):
+        location_dump = location.dump(save_file)
+    recorder.size('locations', location.name, location_dump)
+    return location_dump
 
-_, save_filename, output_filename = sys.argv
+def recordDump(location_dump, recorder):
+    recorder.size('locations', location_dump['name'], location_dump)
+    return location_dump
 
-# load save
-print("Loading save...")
-save_file = saves.Save.load(save_filename)
+def locationName(obj):
+    return obj.name if isinstance(obj, saves.Location) else obj['name']
 
-# dump save
-print("Dumping save...")
-save_dump = save_file.dump()
+def convert(args, recorder):
+    if args.stream or args.shards or args.jobs is not None:
+        # load everything but the locations
+        print("Loading save header...")
+        with recorder.phase('load header'):
+            save_file = saves.Save.loadHeader(args.save_file)
+        save_file.bucketSize = args.buckets
+        save_file.instanced  = args.instanced
 
-# write save
-print("Writing JSON...")
+        # dump locations as they are parsed. the pool and shard modules are
+        # only imported when used, to keep startup short for one-off runs.
+        if args.jobs is not None:
+            import parallel
+            counts = recorder.add_counts if recorder.enabled else None
+            location_dumps = recorder.timed('location',
+                    parallel.dumpLocations(save_file, args.save_file, args.jobs or None, counts), locationName)
+            location_dumps = (recordDump(d, recorder) for d in location_dumps)
+        else:
+            locations = recorder.timed('parse', saves.iterLocations(args.save_file), locationName)
+            location_dumps = (dumpLocation(l, save_file, recorder) for l in locations)
 
-with open(output_filename, 'w') as f:
-    json.dump(save_dump, f, separators=(',',':'))
+        if args.shards:
+            import shards
+            print("Dumping save and writing {:s} shards...".format(encoders.NAMES[args.format]))
+            with recorder.phase('dump and write'):
+                save_file.dumpShards(shards.ShardWriter(args.output_file, args.format), location_dumps)
+
+        elif args.stream:
+            print("Dumping save and writing {:s}...".format(encoders.NAMES[args.format]))
+            with recorder.phase('dump and write'):
+                with open(args.output_file, 'wb') as f:
+                    save_file.dumpStream(encoders.writer(args.format, f), location_dumps)
+
+        else:
+            print("Dumping save...")
+            with recorder.phase('dump'):
+                save_dump = save_file.dump(location_dumps)
+
+            print("Writing {:s}...".format(encoders.NAMES[args.format]))
+            with recorder.phase('write'):
+                with open(args.output_file, 'wb') as f:
+                    encoders.dump(args.format, save_dump, f)
+
+        return save_file
+
+    # load save
+    print("Loading save...")
+    with recorder.phase('load'):
+        save_file = saves.Save.load(args.save_file)
+    save_file.bucketSize = args.buckets
+    save_file.instanced  = args.instanced
+
+    # dump save
+    print("Dumping save...")
+    with recorder.phase('dump'):
+        save_dump = save_file.dump(dumpLocation(l, save_file, recorder) for l in save_file.locations)
+
+    # write save
+    print("Writing {:s}...".format(encoders.NAMES[args.format]))
+
+    with recorder.phase('write'):
+        with open(args.output_file, 'wb') as f:
+            encoders.dump(args.format, save_dump, f)
+
+    return save_file
+
+def outputSize(filename):
+    if not os.path.isdir(filename):
+        return os.path.getsize(filename)
+    return sum(os.path.getsize(os.path.join(filename, f)) for f in os.listdir(filename))
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Convert a Stardew Valley save file to JSON.")
+    parser.add_argument('save_file')
+    parser.add_argument('output_file', help="output file, or directory with --shards")
+    parser.add_argument('--stream', action='store_true',
+            help="parse, dump and write one location at a time, so memory use depends on the largest location instead of the whole save. "
+                 "The save is parsed twice, since the date that locations need comes after them in the file, so this takes about twice as long")
+    parser.add_argument('--shards', action='store_true',
+            help="write each location to its own file in the output directory, plus an index; implies --stream")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+            help="parse and dump locations in a pool of JOBS worker processes (0 for one per core)")
+    parser.add_argument('--format', choices=sorted(encoders.WRITERS),
+            help="output format; by default msgpack if the output file ends in .msgpack, json otherwise")
+    parser.add_argument('--buckets', type=int, nargs='?', const=32, metavar='SIZE',
+            help="also index each location's objects by SIZE x SIZE tile chunks, in draw order (default SIZE: %(const)s, the viewer's chunk size)")
+    parser.add_argument('--instanced', action='store_true',
+            help="write the terrain features of each location as groups sharing everything but index and position, with the positions in a flat list")
+    parser.add_argument('--manifest',
+            help="also write the metadata of the tilesheets used by the save to this file, adding to it if it exists")
+    parser.add_argument('--tilesheet-dir', default=tilesheets.DEFAULT_DIR,
+            help="directory containing the tilesheet metadata files (default: %(default)s)")
+    extract.add_arguments(parser)
+    parser.add_argument('--stats',
+            help="write per-phase and per-location timings, peak memory, entity counts and output sizes to this JSON file")
+    parser.add_argument('--profile',
+            help="run the conversion under cProfile and write the stats to this file")
+    args = parser.parse_args(argv)
+
+    extract.setBackend(args.xml)
+
+    if args.format is None:
+        args.format = encoders.format_for(args.output_file)
+
+    recorder = instrument.Recorder(args.stats is not None, encode=functools.partial(encoders.dumps, args.format))
+    recorder.start()
+
+    with instrument.profiled(args.profile):
+        with recorder.phase('total'):
+            save_file = convert(args, recorder)
+
+            if args.manifest is not None:
+                print("Writing tilesheet manifest...")
+                with recorder.phase('manifest'):
+                    tilesheets.write_manifest(args.manifest, save_file.tilesheets.names, args.tilesheet_dir)
+
+    recorder.stop()
+
+    if args.stats is not None:
+        recorder.set('save_file', args.save_file)
+        recorder.set('tilesheets', save_file.tilesheets.names)
+        recorder.set('output_bytes', outputSize(args.output_file))
+        recorder.write(args.stats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import base64
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# tile index of empty cells, as in maps.py and render.js
+EMPTY_TILE = 0xffff
+
+def tile_bytes(data):
+    # packed arrays are base64 strings in JSON and bytes in MessagePack
+    if isinstance(data, str):
+        return base64.b64decode(data)
+    return data
+
+def decode_tiles(r_tiles, size):
+    # tile index and tilesheet id arrays of a dumped layer, in either format
+    width, height = size
+    if isinstance(r_tiles, dict):
+        # packed runs, as in unpackTiles
+        run = numpy.frombuffer(tile_bytes(r_tiles['run']), dtype='<u2')
+        idx = numpy.repeat(numpy.frombuffer(tile_bytes(r_tiles['idx']), dtype='<u2'), run).reshape(height, width)
+        ts  = numpy.repeat(numpy.frombuffer(tile_bytes(r_tiles['ts']),  dtype=numpy.uint8), run).reshape(height, width)
+        return idx, ts
+
+    # run-length encoded rows, as in expandTiles
+    idx = numpy.full((height, width), EMPTY_TILE, dtype=numpy.uint16)
+    ts  = numpy.zeros((height, width), dtype=numpy.uint8)
+    cur_ts = 0
+    for row, r_row in enumerate(r_tiles):
+        col = 0
+        prev_idx, prev_ts = EMPTY_TILE, 0
+        for item in r_row:
+            if isinstance(item, int):
+                prev_idx = EMPTY_TILE if item == -1 else item
+                prev_ts  = cur_ts
+                idx[row, col] = prev_idx
+                ts[row, col]  = prev_ts
+                col += 1
+            elif 'rep' in item:
+                idx[row, col:col + item['rep']] = prev_idx
+                ts[row, col:col + item['rep']]  = prev_ts
+                col += item['rep']
+            elif 'ts' in item:
+                cur_ts = item['ts']
+    return idx, ts
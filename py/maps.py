@@ -1,7 +1,18 @@
+import sys
+import array
+
 import xnb
 import xnb.graphics
 import xnb.xtile
 
+import tilesheets
+
+# part of the conversion cache key; bump whenever dump output changes
+VERSION = 3
+
+# tile index of empty cells in packed layers
+EMPTY_TILE = 0xffff
+
 def dump_size(s):
     return [s.width, s.height]
 
@@ -11,13 +22,20 @@ def dump_properties(p):
 def dump_tilesheet(ts, m):
     return ts.image_source
 
-def dump_tile(t, m):
+def tilesheet_registry(m):
+    # ids are positions in m.tilesheets
+    return tilesheets.Registry(m.tilesheets, key=id)
+
+def dump_tile(t, m, registry=None):
     if t is None:
         return None
 
+    if registry is None:
+        registry = tilesheet_registry(m)
+
     if isinstance(t, xnb.xtile.StaticTile):
         output = {
-                'ts': m.tilesheets.index(t.tilesheet),
+                'ts': registry.use(t.tilesheet),
                 'idx': t.index
             }
 
@@ -27,12 +45,13 @@ def dump_tile(t, m):
         return output
 
     elif isinstance(t, xnb.xtile.AnimatedTile):
-        return dump_tile(t.frames[0], m)
+        return dump_tile(t.frames[0], m, registry)
 
     else:
         raise ValueError("Unknown tile type")
 
 def dump_tiles(t, m):
+    registry = tilesheet_registry(m)
     rows = []
     prev_ts = None
 
@@ -40,7 +59,7 @@ def dump_tiles(t, m):
         cols = []
 
         for tile in row:
-            tile_output = dump_tile(tile, m)
+            tile_output = dump_tile(tile, m, registry)
 
             if len(cols)>0 and tile_output == prev_tile:
                 if isinstance(cols[-1], dict) and 'rep' in cols[-1]:
@@ -66,11 +85,74 @@ def dump_tiles(t, m):
 
     return rows
 
-def dump_layer(l, m):
+def packed_tile(tile, registry):
+    # (tile index, tilesheet id) of a cell, checked to fit the packed arrays
+    if tile is None:
+        return EMPTY_TILE, 0
+
+    elif isinstance(tile, xnb.xtile.StaticTile):
+        ts = registry.use(tile.tilesheet)
+        if ts > 0xff:
+            raise ValueError("Packed layers hold at most 256 tilesheets")
+        if not 0 <= tile.index < EMPTY_TILE:
+            raise ValueError("Tile index {:d} does not fit a packed layer".format(tile.index))
+        return tile.index, ts
+
+    else:
+        raise ValueError("Unknown tile type")
+
+def dump_tiles_packed(t, m):
+    # runs of equal cells over the whole layer, row by row, as three arrays
+    # with one entry per run: little-endian uint16 tile index, uint8
+    # tilesheet id and little-endian uint16 run length. empty cells have
+    # index EMPTY_TILE. the few tiles with properties of their own are
+    # listed as [cell, properties] pairs, cell being the position in the
+    # expanded layer.
+    registry = tilesheet_registry(m)
+
+    idx = array.array('H')
+    ts  = array.array('B')
+    run = array.array('H')
+    properties = []
+
+    cell = 0
+    for row in t:
+        for tile in row:
+            while isinstance(tile, xnb.xtile.AnimatedTile):
+                tile = tile.frames[0]
+
+            if isinstance(tile, xnb.xtile.StaticTile) and len(tile.properties) > 0:
+                properties.append([cell, dump_properties(tile.properties)])
+            cell += 1
+
+            tile_idx, tile_ts = packed_tile(tile, registry)
+            if len(run) > 0 and idx[-1] == tile_idx and ts[-1] == tile_ts and run[-1] < 0xffff:
+                run[-1] += 1
+            else:
+                idx.append(tile_idx)
+                ts.append(tile_ts)
+                run.append(1)
+
+    if sys.byteorder == 'big':
+        idx.byteswap()
+        run.byteswap()
+
+    output = {
+            'idx': idx.tobytes(),
+            'ts':  ts.tobytes(),
+            'run': run.tobytes()
+        }
+
+    if len(properties) > 0:
+        output['properties'] = properties
+
+    return output
+
+def dump_layer(l, m, packed=False):
     output = {
             'size':        dump_size(l.size),
             'tile_size':   dump_size(l.tile_size),
-            'tiles':       dump_tiles(l.tiles, m)
+            'tiles':       dump_tiles_packed(l.tiles, m) if packed else dump_tiles(l.tiles, m)
         }
 
     if not l.visible:
@@ -90,7 +172,7 @@ def dump_layer(l, m):
 
     return output
 
-def dump_map(m):
+def dump_map(m, packed=False):
     output = {
             'tilesheets': [],
             'layers': []
@@ -100,7 +182,7 @@ def dump_map(m):
         output['tilesheets'].append(dump_tilesheet(ts, m))
 
     for l in m.layers:
-        output['layers'].append(dump_layer(l, m))
+        output['layers'].append(dump_layer(l, m, packed))
 
     if len(m.properties) > 0:
         output['properties'] = dump_properties(m.properties)
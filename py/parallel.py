@@ -0,0 +1,67 @@
+import os
+import collections
+import concurrent.futures
+
+import saves
+import extract
+import tilesheets
+
+# save header (date, player) in each worker process, set by initWorker
+_save = None
+
+def initWorker(save, backend):
+    global _save
+    _save = save
+    extract.setBackend(backend)
+
+def dumpLocationXML(xml):
+    # tilesheet ids in the result are local to this location; the parent
+    # process maps them onto the shared list with remapTilesheets.
+    _save.tilesheets = tilesheets.Registry()
+    location = saves.Location(extract.backend.module.fromstring(xml))
+    location_dump = location.dump(_save)
+    return location_dump, _save.tilesheets.names, location.counts()
+
+def remapTilesheets(location_dump, mapping):
+    # instanced dumps have instances instead of features
+    for key in ['characters', 'items', 'buildings', 'features', 'instances']:
+        for obj in location_dump.get(key, []):
+            ts = obj['ts']
+            if isinstance(ts, tuple):
+                obj['ts'] = tuple(mapping[t] for t in ts)
+            else:
+                obj['ts'] = mapping[ts]
+
+def dumpLocations(save, filename, jobs=None, counts=None):
+    # yields the same location dumps, in the same order and with the same
+    # tilesheet ids, as dumping each of saves.iterLocations(filename) in turn.
+    # save should come from Save.loadHeader, since it is sent to every worker.
+    # counts, if given, is called with the Location.counts of each location.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initWorker, initargs=(save, extract.backend.name)) as executor:
+        # bound the number of locations in flight, so that memory use stays
+        # proportional to the number of workers rather than the save size
+        max_pending = 2 * (jobs or os.cpu_count() or 1)
+        pending = collections.deque()
+
+        def merge(future):
+            location_dump, tilesheets, location_counts = future.result()
+            if counts is not None:
+                counts(location_counts)
+
+            # registering local tilesheets in order of first use gives the
+            # same ids a serial run would have assigned
+            mapping = [saves.useTilesheet(ts, save) for ts in tilesheets]
+            remapTilesheets(location_dump, mapping)
+            return location_dump
+
+        for kind, el in saves.iterparseSave(filename):
+            if kind != 'location':
+                continue
+
+            pending.append(executor.submit(dumpLocationXML, extract.backend.module.tostring(el)))
+
+            if len(pending) >= max_pending:
+                yield merge(pending.popleft())
+
+        while len(pending) > 0:
+            yield merge(pending.popleft())
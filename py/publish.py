@@ -0,0 +1,134 @@
+import os
+import io
+import re
+import gzip
+import json
+import hashlib
+import argparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# maps the viewer's file names to their published, content-hashed names
+MANIFEST_FILE = 'publish.json'
+
+# hex digits of the sha256 in published names
+HASH_LENGTH = 16
+
+# names written by publish_file
+HASHED = re.compile(r'\.[0-9a-f]{%d}(\.[^./]*)?$' % HASH_LENGTH)
+
+# formats that are already compressed
+COMPRESSED = ['.png', '.jpg', '.gz', '.br']
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+def hashed_name(path, digest):
+    base, ext = os.path.splitext(path)
+    return '{:s}.{:s}{:s}'.format(base, digest, ext)
+
+def gzip_compress(data):
+    # no file name and a zero mtime, so the output only depends on data
+    f = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=f, mtime=0) as gz:
+        gz.write(data)
+    return f.getvalue()
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=11)
+
+def write_file(filename, data):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+def variants(data):
+    # precompressed copies, served by the web server instead of compressing
+    # on every request. only kept if they are smaller.
+    output = [('.gz', gzip_compress)]
+    if brotli is not None:
+        output.append(('.br', brotli_compress))
+
+    for suffix, compress in output:
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            yield suffix, compressed
+
+def publish_file(root, path, output_dir):
+    with open(os.path.join(root, path), 'rb') as f:
+        data = f.read()
+
+    published = hashed_name(path, content_hash(data))
+    filename = os.path.join(output_dir, published)
+
+    # same name means same content, so it has been published before
+    if os.path.exists(filename):
+        return published, False
+
+    write_file(filename, data)
+    if os.path.splitext(path)[1].lower() not in COMPRESSED:
+        for suffix, compressed in variants(data):
+            write_file(filename + suffix, compressed)
+
+    return published, True
+
+def find_files(root, paths, manifest_file):
+    for path in paths:
+        full = os.path.join(root, path)
+
+        if os.path.isdir(full):
+            for dirpath, dirnames, filenames in os.walk(full):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    rel = os.path.relpath(os.path.join(dirpath, filename), root)
+                    # don't publish published files again when the output
+                    # directory is root
+                    if HASHED.search(filename) or filename.endswith(('.gz', '.br', '.tmp')) or rel == manifest_file:
+                        continue
+                    yield rel.replace(os.sep, '/')
+        else:
+            yield os.path.relpath(full, root).replace(os.sep, '/')
+
+def publish(root, paths, output_dir, manifest_file=MANIFEST_FILE):
+    # entries already in the manifest are kept, so data and tilesheets can be
+    # published separately
+    manifest_filename = os.path.join(output_dir, manifest_file)
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+
+    written = 0
+    for path in find_files(root, paths, manifest_file):
+        manifest[path], new = publish_file(root, path, output_dir)
+        written += new
+
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f, separators=(',',':'), sort_keys=True)
+
+    return manifest, written
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish viewer files under content-hashed names, with gzip and brotli compressed copies.")
+    parser.add_argument('root', help="viewer directory, which the viewer's URLs are relative to")
+    parser.add_argument('paths', nargs='+', metavar='path',
+            help="file or directory to publish, relative to root")
+    parser.add_argument('--output', help="directory to publish to (default: root)")
+    parser.add_argument('--manifest', default=MANIFEST_FILE,
+            help="manifest file name in the output directory (default: %(default)s)")
+    args = parser.parse_args()
+
+    if brotli is None:
+        print("brotli is not installed, only writing gzip copies")
+
+    manifest, written = publish(args.root, args.paths, args.output or args.root, args.manifest)
+    print("Published {:d} new files, {:d} in manifest".format(written, len(manifest)))
+
+if __name__ == '__main__':
+    main()
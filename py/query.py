@@ -0,0 +1,231 @@
+import os
+import sys
+import argparse
+import concurrent.futures
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import saves
+import extract
+import json_batch
+
+# entity lists of a Location, by kind
+KINDS = ['characters', 'items', 'buildings', 'features', 'resourceclumps']
+
+# columns of the columnar export, by table. every column is an integer
+# array; attributes an entity doesn't have (e.g. treeType of grass) are -1.
+COLUMNS = {
+        'items':     ['location', 'x', 'y', 'type', 'category', 'sheetIndex', 'bigCraftable', 'whichType'],
+        'buildings': ['location', 'x', 'y', 'type', 'tilesWide', 'tilesHigh'],
+        'features':  ['location', 'x', 'y', 'type',
+            'growthStage', 'treeType', 'flipped', 'stump', 'tapped', 'hasSeed',
+            'grassType', 'numberOfWeeds', 'grassSourceOffset',
+            'whichFloor', 'whichView', 'fertilizer', 'state']
+    }
+
+# string tables that the location and type columns index into
+STRINGS = ['locations', 'types']
+
+# characters' positions are in game pixels, this many to a tile; all other
+# entities are positioned in tiles
+CHARACTER_TILE = 64
+
+def entityType(kind, obj):
+    if kind == 'resourceclumps':
+        return 'ResourceClump'
+    return obj.type
+
+def entityTile(kind, obj):
+    if kind == 'characters':
+        return obj.pos.x // CHARACTER_TILE, obj.pos.y // CHARACTER_TILE
+    return obj.pos.x, obj.pos.y
+
+class SaveIndex(object):
+    # secondary indexes over the entities of a loaded save. find returns the
+    # entities matching all given filters by intersecting the indexes, so it
+    # never walks the locations.
+    def __init__(self, save):
+        self.save       = save
+        self.entities   = []
+        self.byLocation = {}
+        self.byKind     = {}
+        self.byType     = {}
+        self.byCategory = {}
+        self.byPosition = {}
+
+        for location in save.locations:
+            for kind in KINDS:
+                for obj in getattr(location, kind):
+                    self.add(location.name, kind, obj)
+
+    def add(self, location, kind, obj):
+        i = len(self.entities)
+        self.entities.append((location, kind, obj))
+
+        self.byLocation.setdefault(location, set()).add(i)
+        self.byKind.setdefault(kind, set()).add(i)
+        self.byType.setdefault(entityType(kind, obj), set()).add(i)
+        if kind == 'items':
+            self.byCategory.setdefault(obj.category, set()).add(i)
+        self.byPosition.setdefault((location,) + entityTile(kind, obj), set()).add(i)
+
+    def ids(self, location=None, kind=None, type=None, category=None, pos=None):
+        sets = []
+        if location is not None:
+            sets.append(self.byLocation.get(location, set()))
+        if kind is not None:
+            sets.append(self.byKind.get(kind, set()))
+        if type is not None:
+            sets.append(self.byType.get(type, set()))
+        if category is not None:
+            sets.append(self.byCategory.get(category, set()))
+        if pos is not None:
+            # pos is in tiles, and needs a location as positions are per location
+            if location is None:
+                raise ValueError("Filtering by pos needs a location")
+            sets.append(self.byPosition.get((location,) + tuple(pos), set()))
+
+        if len(sets) == 0:
+            return range(len(self.entities))
+
+        sets.sort(key=len)
+        return sorted(sets[0].intersection(*sets[1:]))
+
+    def find(self, **filters):
+        # (location name, kind, entity) tuples, in save order
+        return [self.entities[i] for i in self.ids(**filters)]
+
+    def count(self, attribute, **filters):
+        # number of matching entities by the value of attribute
+        output = {}
+        for location, kind, obj in self.find(**filters):
+            value = getattr(obj, attribute, None)
+            output[value] = output.get(value, 0) + 1
+        return output
+
+def columnValue(obj, column):
+    value = getattr(obj, column, None)
+    if value is None:
+        return -1
+    return int(value)
+
+def columns(save):
+    # the items, buildings and features of save as integer column arrays,
+    # plus the string tables the location and type columns index into
+    strings = dict((name, {}) for name in STRINGS)
+
+    def code(table, s):
+        return strings[table].setdefault(s, len(strings[table]))
+
+    rows = dict((table, []) for table in COLUMNS)
+    for location in save.locations:
+        l = code('locations', location.name)
+
+        for table, objs in [('items', location.items), ('buildings', location.buildings), ('features', location.features)]:
+            for obj in objs:
+                row = [l, obj.pos.x, obj.pos.y, code('types', obj.type)]
+                row.extend(columnValue(obj, column) for column in COLUMNS[table][4:])
+                rows[table].append(row)
+
+    output = {}
+    for table, names in COLUMNS.items():
+        data = numpy.array(rows[table], dtype=numpy.int32).reshape(-1, len(names))
+        for i, name in enumerate(names):
+            output['{:s}/{:s}'.format(table, name)] = data[:, i]
+
+    for table in STRINGS:
+        output[table] = numpy.array(list(strings[table]), dtype=str)
+
+    return output
+
+def writeColumns(filename, save):
+    with open(filename, 'wb') as f:
+        numpy.savez_compressed(f, **columns(save))
+
+def loadCorpus(filenames):
+    # concatenates the exports of many saves into one set of columns, with a
+    # 'save' column indexing into the returned list of file names. location
+    # and type codes are remapped onto string tables shared by the corpus.
+    strings = dict((name, {}) for name in STRINGS)
+    parts = dict((table, dict((name, []) for name in ['save'] + COLUMNS[table])) for table in COLUMNS)
+
+    for s, filename in enumerate(filenames):
+        with numpy.load(filename) as data:
+            mapping = {}
+            for table in STRINGS:
+                mapping[table] = numpy.array([strings[table].setdefault(str(v), len(strings[table])) for v in data[table]], dtype=numpy.int32)
+
+            for table, names in COLUMNS.items():
+                n = len(data['{:s}/location'.format(table)])
+                parts[table]['save'].append(numpy.full(n, s, dtype=numpy.int32))
+                for name in names:
+                    column = data['{:s}/{:s}'.format(table, name)]
+                    if name == 'location':
+                        column = mapping['locations'][column]
+                    elif name == 'type':
+                        column = mapping['types'][column]
+                    parts[table][name].append(column)
+
+    output = {'saves': list(filenames)}
+    for table, table_parts in parts.items():
+        output[table] = dict((name, numpy.concatenate(arrays) if len(arrays) > 0 else numpy.zeros(0, dtype=numpy.int32))
+                for name, arrays in table_parts.items())
+    for table in STRINGS:
+        output[table] = list(strings[table])
+
+    return output
+
+def countBy(table, keys, mask=None):
+    # number of rows with each combination of values of the key columns,
+    # e.g. countBy(corpus['items'], ['category', 'sheetIndex'])
+    data = numpy.stack([table[key] for key in keys], axis=1)
+    if mask is not None:
+        data = data[mask]
+
+    values, counts = numpy.unique(data, axis=0, return_counts=True)
+    return dict((tuple(int(v) for v in row), int(n)) for row, n in zip(values, counts))
+
+def exportSave(filename, output_filename):
+    try:
+        writeColumns(output_filename, saves.Save.load(filename))
+    except Exception as e:
+        return '{:s}: {}'.format(type(e).__name__, e)
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the items, buildings and terrain features of Stardew Valley saves as NumPy column arrays, one .npz file per save.")
+    parser.add_argument('saves', nargs='+', metavar='save',
+            help="save file, save directory, or directory of saves")
+    parser.add_argument('output_dir')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+            help="number of worker processes (default: one per core)")
+    extract.add_arguments(parser)
+    args = parser.parse_args()
+
+    if numpy is None:
+        sys.exit("query.py requires numpy")
+
+    extract.setBackend(args.xml)
+
+    filenames = list(json_batch.findSaves(args.saves))
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_filenames = json_batch.outputFilenames(filenames, args.output_dir, '.npz')
+
+    print("Exporting {:d} saves...".format(len(filenames)))
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs or None,
+            initializer=extract.setBackend, initargs=(args.xml,)) as executor:
+        for filename, error in zip(filenames, executor.map(exportSave, filenames, output_filenames)):
+            if error is not None:
+                print("\t{:s} failed: {:s}".format(filename, error))
+                failed += 1
+
+    print("Exported {:d} of {:d} saves".format(len(filenames) - failed, len(filenames)))
+    if failed > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,57 @@
-import xml.etree.ElementTree as ET
+
+import extract
+import tilesheets
+from extract import Schema, XSI_TYPE, text, integer, boolean, element
+
+# part of the conversion cache key; bump whenever dump output changes
+VERSION = 2
+
+# imported by importNumpy when a location has enough connectables to need
+# it, since importing numpy takes longer than converting a small save.
+# None if it is not installed.
+numpy = False
+
+def importNumpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
 
 class Position(object):
+    __slots__ = ['x', 'y']
+
     @staticmethod
     def fromElement(el):
-        return Position(
-                int(el.find('X').text),
-                int(el.find('Y').text)
-            )
+        return Position(*POSITION.extract(el))
 
     def __init__(self, x, y):
         self.x = x
         self.y = y
 
+# an element with X and Y children
+def position(el):
+    return Position.fromElement(el)
+
+POSITION = Schema(
+        ('X', integer),
+        ('Y', integer)
+    )
+
+CHARACTER = Schema(
+        ('Position', position),
+        ('name',     text)
+    )
+
 class Character(object):
+    __slots__ = ['type', 'pos', 'name']
+
     def __init__(self, el):
-        self.type = el.get('{http://www.w3.org/2001/XMLSchema-instance}type')
-        self.pos  = Position.fromElement(el.find('Position'))
-        self.name = el.find('name').text
+        self.type = el.get(XSI_TYPE)
+        self.pos, self.name = CHARACTER.extract(el)
 
     def dump(self, save):
         output = {
@@ -39,17 +74,28 @@ class Character(object):
 
         return output
 
+ITEM = Schema(
+        ('Name',             text),
+        ('category',         integer),
+        ('bigCraftable',     boolean),
+        ('tileLocation',     position),
+        ('parentSheetIndex', integer)
+    )
+
+FENCE = Schema(
+        ('whichType', integer),
+    )
+
 class Item(object):
+    # whichType is only set for fences
+    __slots__ = ['name', 'type', 'category', 'bigCraftable', 'pos', 'sheetIndex', 'whichType']
+
     def __init__(self, el, connectables):
-        self.name = el.find('Name').text
-        self.type = el.get('{http://www.w3.org/2001/XMLSchema-instance}type')
-        self.category     = int(el.find('category').text)
-        self.bigCraftable = el.find('bigCraftable').text == 'true'
-        self.pos          = Position.fromElement(el.find('tileLocation'))
-        self.sheetIndex   = int(el.find('parentSheetIndex').text)
+        self.type = el.get(XSI_TYPE)
+        self.name, self.category, self.bigCraftable, self.pos, self.sheetIndex = ITEM.extract(el)
 
         if self.type == 'Fence':
-            self.whichType = int(el.find('whichType').text)
+            self.whichType, = FENCE.extract(el)
             key = 'fence%d' % self.whichType
             try:
                 position = (self.pos.x, self.pos.y)
@@ -79,16 +125,20 @@ class Item(object):
 
         return output
 
+BUILDING = Schema(
+        ('buildingType', text),
+        ('tileX',        integer),
+        ('tileY',        integer),
+        ('tilesWide',    integer),
+        ('tilesHigh',    integer)
+    )
+
 class Building(object):
-    def __init__(self, el):
-        self.type = el.find('buildingType').text
-        self.pos  = Position(
-                int(el.find('tileX').text),
-                int(el.find('tileY').text)
-            )
+    __slots__ = ['type', 'pos', 'tilesWide', 'tilesHigh']
 
-        self.tilesWide = int(el.find('tilesWide').text)
-        self.tilesHigh = int(el.find('tilesHigh').text)
+    def __init__(self, el):
+        self.type, x, y, self.tilesWide, self.tilesHigh = BUILDING.extract(el)
+        self.pos = Position(x, y)
 
     def dump(self, save):
         output = {
@@ -102,15 +152,20 @@ class Building(object):
 
         return output
 
+RESOURCE_CLUMP = Schema(
+        ('tile/X',           integer),
+        ('tile/Y',           integer),
+        ('width',            integer),
+        ('height',           integer),
+        ('parentSheetIndex', integer)
+    )
+
 class ResourceClump:
+    __slots__ = ['pos', 'tilesWide', 'tilesHigh', 'idx']
+
     def __init__(self, el):
-        self.pos = Position(
-                int(el.find('tile/X').text),
-                int(el.find('tile/Y').text)
-            )
-        self.tilesWide = int(el.find('width').text)
-        self.tilesHigh = int(el.find('height').text)
-        self.idx = int(el.find('parentSheetIndex').text)
+        x, y, self.tilesWide, self.tilesHigh, self.idx = RESOURCE_CLUMP.extract(el)
+        self.pos = Position(x, y)
 
     def dump(self, save):
         output = {
@@ -122,34 +177,63 @@ class ResourceClump:
         output['tileSize'] = [16 * self.tilesWide, 16 * self.tilesHigh]
         return output
 
-names = set()
 grassseasons = {
     "spring": 0,
     "summer": 1,
     "fall": 2,
     "winter": 3
 }
+FEATURE = Schema(
+        ('key/Vector2',          position),
+        ('value/TerrainFeature', element)
+    )
+
+TREE = Schema(
+        ('growthStage', integer),
+        ('treeType',    integer),
+        ('flipped',     boolean),
+        ('stump',       boolean),
+        ('tapped',      boolean),
+        ('hasSeed',     boolean)
+    )
+
+GRASS = Schema(
+        ('grassType',         integer),
+        ('numberOfWeeds',     integer),
+        ('grassSourceOffset', integer)
+    )
+
+FLOORING = Schema(
+        ('whichFloor', integer),
+        ('whichView',  integer)
+    )
+
+HOE_DIRT = Schema(
+        ('fertilizer', integer),
+        ('state',      integer)
+    )
+
 class Feature(object):
+    # there is one of these per tree, grass tuft, floor tile and hoe dirt, so
+    # the attributes of every feature type share one set of slots. only those
+    # of self.type are set.
+    __slots__ = ['pos', 'type',
+            'growthStage', 'treeType', 'flipped', 'stump', 'tapped', 'hasSeed',
+            'grassType', 'numberOfWeeds', 'grassSourceOffset',
+            'whichFloor', 'whichView',
+            'fertilizer', 'state']
+
     def __init__(self, el, connectables):
-        self.pos = Position.fromElement(el.find('key/Vector2'))
-        feat = el.find('value/TerrainFeature')
-        self.type = feat.get('{http://www.w3.org/2001/XMLSchema-instance}type')
+        self.pos, feat = FEATURE.extract(el)
+        self.type = feat.get(XSI_TYPE)
         if   self.type == 'Tree':
-            self.growthStage = int(feat.find('growthStage').text)
-            self.treeType    = int(feat.find('treeType').text)
-            self.flipped     = feat.find('flipped').text == 'true'
-            self.stump       = feat.find('stump'  ).text == 'true'
-            self.tapped      = feat.find('tapped' ).text == 'true'
-            self.hasSeed     = feat.find('hasSeed').text == 'true'
+            self.growthStage, self.treeType, self.flipped, self.stump, self.tapped, self.hasSeed = TREE.extract(feat)
 
         elif self.type == 'Grass':
-            self.grassType         = int(feat.find('grassType').text)
-            self.numberOfWeeds     = int(feat.find('numberOfWeeds').text)
-            self.grassSourceOffset = int(feat.find('grassSourceOffset').text)
+            self.grassType, self.numberOfWeeds, self.grassSourceOffset = GRASS.extract(feat)
 
         elif self.type == 'Flooring':
-            self.whichFloor = int(feat.find('whichFloor').text)
-            self.whichView  = int(feat.find('whichView').text)
+            self.whichFloor, self.whichView = FLOORING.extract(feat)
             key = 'floor%d' % self.whichFloor
             try:
                 position = (self.pos.x, self.pos.y)
@@ -157,8 +241,7 @@ class Feature(object):
             except:
                 connectables[key] = [position]
         elif self.type == "HoeDirt":
-            self.fertilizer = int(feat.find('fertilizer').text)
-            self.state = int(feat.find('state').text)
+            self.fertilizer, self.state = HOE_DIRT.extract(feat)
             position = tuple(dump_position(self.pos))
             # hoedirt is added to both if wet, and only the dry one if dry.
             # wet hoedirt is then overlapped with dry hoedirtposition = (self.pos.x, self.pos.y)
@@ -207,7 +290,8 @@ class Feature(object):
                 outputs.append({
                         'ts': ts,
                         'idx': 27,
-                        "pos": dump_position(self.pos)
+                        "pos": dump_position(self.pos),
+                        'isStump': True
                     })
 
         elif self.type == 'Grass':
@@ -310,8 +394,33 @@ class Location(object):
             output['features'].extend(f.dump(save, connections))
         for rc in self.resourceclumps:
             output['features'].append(rc.dump(save))
+
+        if save.instanced:
+            # buckets index the features in the order instances expand to
+            output['instances'], output['features'] = instanceFeatures(output['features'])
+
+        if save.bucketSize is not None:
+            output['buckets'] = dumpBuckets(output, save.bucketSize)
+
+        if save.instanced:
+            del output['features']
         return output
 
+    def counts(self):
+        # number of entities by type and of connectables by kind, for --stats
+        entities = {}
+        for kind, objs in [('characters', self.characters), ('items', self.items), ('buildings', self.buildings), ('features', self.features)]:
+            for obj in objs:
+                key = '{:s}/{:s}'.format(kind, obj.type)
+                entities[key] = entities.get(key, 0) + 1
+        if len(self.resourceclumps) > 0:
+            entities['resourceclumps'] = len(self.resourceclumps)
+
+        return {
+                'entities':     entities,
+                'connectables': dict((k, len(v)) for k, v in self.connectables.items())
+            }
+
 class Date(object):
     def __init__(self, year, season, day):
         self.year   = year
@@ -333,12 +442,17 @@ class Date(object):
     def dump(self):
         return str(self)
 
+PLAYER = Schema(
+        ('name',              text),
+        ('farmName',          text),
+        ('houseUpgradeLevel', integer),
+        ('hasGreenhouse',     boolean)
+    )
+
 class Player(object):
     def __init__(self, el):
-        self.name              = el.find('name').text
-        self.farmName          = el.find('farmName').text + ' Farm'
-        self.houseUpgradeLevel = int(el.find('houseUpgradeLevel').text)
-        self.hasGreenhouse     = el.find('hasGreenhouse').text == 'true'
+        self.name, farmName, self.houseUpgradeLevel, self.hasGreenhouse = PLAYER.extract(el)
+        self.farmName = farmName + ' Farm'
 
     def dump(self, save):
         return {
@@ -346,33 +460,127 @@ class Player(object):
             'farmName': self.farmName
         }
 
+SAVE = Schema(
+        ('year',          integer),
+        ('currentSeason', text),
+        ('dayOfMonth',    integer),
+        ('player',        element)
+    )
+
 class Save(object):
     @staticmethod
     def load(filename):
-        tree = ET.parse(filename)
+        tree = extract.backend.module.parse(filename)
         root = tree.getroot()
         return Save(root)
 
+    @staticmethod
+    def loadHeader(filename):
+        # everything but the locations, which are dropped as they stream past.
+        # use iterLocations to read those one at a time. this is a full pass
+        # over the file: the date comes after the locations, and dumping a
+        # location needs the season, so it can't be folded into that pass.
+        count = 0
+        for kind, el in iterparseSave(filename):
+            if kind == 'root':
+                root = el
+            else:
+                count += 1
+
+        save = Save(root)
+        save.locationCount = count
+        return save
+
     def __init__(self, el):
-        self.date     = Date(
-                int(el.find('year').text),
-                    el.find('currentSeason').text,
-                int(el.find('dayOfMonth').text)
-            )
+        year, season, day, player = SAVE.extract(el)
 
-        self.player = Player(el.find('player'))
+        self.date   = Date(year, season, day)
+        self.player = Player(player)
         self.locations = [Location(l) for l in el.findall('locations/GameLocation')]
+        self.locationCount = len(self.locations)
 
-    def dump(self):
-        self.tilesheets = []
-        print(names)
+        # chunk size of the location buckets, or None to leave them out
+        self.bucketSize = None
+
+        # write features as instances (see instanceFeatures)
+        self.instanced = False
+
+    def dump(self, location_dumps=None):
+        self.tilesheets = tilesheets.Registry()
+        if location_dumps is None:
+            location_dumps = (l.dump(self) for l in self.locations)
         return {
                 'date':      self.date.dump(),
                 'player':    self.player.dump(self),
-                'locations': [l.dump(self) for l in self.locations],
-                'tilesheets': self.tilesheets
+                'locations': list(location_dumps),
+                'tilesheets': self.tilesheets.names
             }
 
+    def dumpStream(self, writer, location_dumps=None):
+        # same document as self.dump(), but each location is written out as
+        # soon as it has been dumped. writer is an encoders.Writer.
+        self.tilesheets = tilesheets.Registry()
+        if location_dumps is None:
+            location_dumps = (l.dump(self) for l in self.locations)
+
+        writer.begin_map(4)
+        writer.key('date')
+        writer.value(self.date.dump())
+        writer.key('player')
+        writer.value(self.player.dump(self))
+        writer.key('locations')
+        writer.begin_array(self.locationCount)
+        for location_dump in location_dumps:
+            writer.value(location_dump)
+        writer.end()
+        writer.key('tilesheets')
+        writer.value(self.tilesheets.names)
+        writer.end()
+
+    def dumpShards(self, shard_writer, location_dumps=None):
+        # one shard per location; date, player and tilesheets go in the index
+        self.tilesheets = tilesheets.Registry()
+        if location_dumps is None:
+            location_dumps = (l.dump(self) for l in self.locations)
+
+        for location_dump in location_dumps:
+            shard_writer.write(location_dump['name'], location_dump)
+
+        shard_writer.write_index({
+                'date':       self.date.dump(),
+                'player':     self.player.dump(self),
+                'tilesheets': self.tilesheets.names
+            })
+
+# top-level elements that Save needs; all others are cleared while streaming.
+HEADER_TAGS = ['player', 'currentSeason', 'dayOfMonth', 'year']
+
+def iterparseSave(filename):
+    # yields ('root', el) for the SaveGame element, then ('location', el) for
+    # each locations/GameLocation as soon as it has been parsed. locations are
+    # removed from the tree once the consumer is done with them, so memory use
+    # is bounded by the largest location rather than the whole save.
+    path = []
+    for event, el in extract.backend.module.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            if len(path) == 0:
+                yield 'root', el
+            path.append(el)
+            continue
+
+        path.pop()
+        if len(path) == 2 and path[1].tag == 'locations' and el.tag == 'GameLocation':
+            yield 'location', el
+            path[1].remove(el)
+
+        elif len(path) == 1 and el.tag not in HEADER_TAGS:
+            el.clear()
+
+def iterLocations(filename):
+    for kind, el in iterparseSave(filename):
+        if kind == 'location':
+            yield Location(el)
+
 
 class SparsePositions:
     def __init__(self):
@@ -415,7 +623,89 @@ tilePositions = {
     0b1111: (2, 1)
 }
 
+def fenceIndex(hasUp, hasDown, hasLeft, hasRight):
+    if hasLeft and hasRight:
+        # surprising, game does not care about up connections in this case
+        return 7
+    elif hasUp:
+        if hasLeft:
+            return 8
+        elif hasRight:
+            return 6
+        else:
+            return 3
+    else:
+        # no up, and not both left & right
+        if hasLeft:
+            return 2
+        elif hasRight:
+            return 0
+        else:
+            return 5
+
+# sheet index for each connection state, as computed by calculateConnectables
+def fenceIndices():
+    return [fenceIndex(state & 8, state & 4, state & 2, state & 1) for state in range(16)]
+
+def floorIndices(floornum):
+    tilex = (floornum % 4) * 4
+    tiley = (floornum // 4) * 4
+    return [(tilex + dx) + (tiley + dy) * 16 for dx, dy in (tilePositions[state] for state in range(16))]
+
+def hoeDirtIndices(dirtnum):
+    tilex, tiley = 4 * dirtnum, 0
+    return [(tilex + dx) + (tiley + dy) * 8 for dx, dy in (tilePositions[state] for state in range(16))]
+
+# number of connectables in a location from which numpy is worth its overhead
+VECTORIZE_THRESHOLD = 256
+
+def connectionStates(positions):
+    # up/down/left/right state of each position, as used to index
+    # tilePositions. positions are rasterized into a padded boolean grid, and
+    # the neighbours of every cell are found by shifting that grid.
+    xy = numpy.array(positions, dtype=numpy.int64).reshape(-1, 2)
+    x  = xy[:, 0] - xy[:, 0].min() + 1
+    y  = xy[:, 1] - xy[:, 1].min() + 1
+
+    grid = numpy.zeros((y.max() + 2, x.max() + 2), dtype=numpy.uint8)
+    grid[y, x] = 1
+
+    state = numpy.zeros_like(grid)
+    state[1:-1, 1:-1] = (grid[ :-2, 1:-1] << 3) \
+                      | (grid[2:  , 1:-1] << 2) \
+                      | (grid[1:-1,  :-2] << 1) \
+                      |  grid[1:-1, 2:  ]
+
+    return state[y, x]
+
+def calculateConnectablesVectorized(connectables):
+    result = {}
+    for type_, positions in connectables.items():
+        if type_ == "fence4":
+            continue # gates are handled below.
+
+        if type_.startswith("fence"):
+            indices = fenceIndices()
+        elif type_.startswith("floor"):
+            indices = floorIndices(int(type_[5:]))
+        elif type_.startswith("hoedirt"):
+            indices = hoeDirtIndices(int(type_[7:]))
+        else:
+            print("Did not implement connections for %s yet" % type_)
+            result[type_] = dict.fromkeys(positions, 0)
+            continue
+
+        states = connectionStates(positions)
+        result[type_] = dict(zip(positions, numpy.array(indices)[states].tolist()))
+
+    # calculateConnectables always ends up drawing gates unconnected.
+    result["fence4"] = dict.fromkeys(connectables.get("fence4", []), 17)
+    return result
+
 def calculateConnectables(connectables):
+    if sum(len(p) for p in connectables.values()) >= VECTORIZE_THRESHOLD and importNumpy() is not None:
+        return calculateConnectablesVectorized(connectables)
+
     result = {}
     posdicts = {} # save for gate logic.
     for type_ in connectables:
@@ -437,24 +727,7 @@ def calculateConnectables(connectables):
 
             if type_.startswith("fence"):
                 posdicts[type_] = posdict
-                if hasLeft and hasRight:
-                    # surprising, game does not care about up connections in this case
-                    result[type_][pos] = 7
-                elif hasUp:
-                    if hasLeft:
-                        result[type_][pos] = 8
-                    elif hasRight:
-                        result[type_][pos] = 6
-                    else:
-                        result[type_][pos] = 3
-                else:
-                    # no up, and not both left & right
-                    if hasLeft:
-                        result[type_][pos] = 2
-                    elif hasRight:
-                        result[type_][pos] = 0
-                    else:
-                        result[type_][pos] = 5
+                result[type_][pos] = fenceIndex(hasUp, hasDown, hasLeft, hasRight)
             elif type_.startswith("floor"):
                 # represent state as one number for convenience
                 state = 0
@@ -516,13 +789,124 @@ def calculateConnectables(connectables):
             result[type_][pos] = 17 # because weird widths
     return result
 
+def drawKey(y, order, obj):
+    # sort key of the object dump obj, standing on row y at position order in
+    # the viewer's object list: by row, then in list order, except that each
+    # stump goes right under the tree before it. chunkObjects in render.js
+    # sorts the same way.
+    if obj.get('isStump'):
+        # between its tree, at order - 1, and the object before that
+        return (y, order - 1.5)
+    return (y, order)
+
+# object lists that buckets index into
+BUCKET_KINDS = ['items', 'buildings', 'features']
+
+def dumpBuckets(location_dump, size):
+    # objects by the size x size tile chunk they stand in, as flat
+    # [kind, index, ...] lists, kind being an index into BUCKET_KINDS. each
+    # list is in draw order (see drawKey), the row an object stands on being
+    # the bottom row of the footprint for buildings. 'order' has the rank of
+    # each object in the draw order of the whole location, so neighbouring
+    # chunks can be merged without reordering ties in y.
+    objects = []
+    order = 0
+    for kind, key in enumerate(BUCKET_KINDS):
+        for index, obj in enumerate(location_dump[key]):
+            if obj is None:
+                continue
+
+            x, y = obj['pos']
+            if key == 'buildings':
+                y += obj['size'][1] - 1
+
+            objects.append(drawKey(y, order, obj) + (x, kind, index))
+            order += 1
+
+    objects.sort()
+
+    chunks = {}
+    for rank, (y, order, x, kind, index) in enumerate(objects):
+        chunk = chunks.setdefault((y // size, x // size), ([], []))
+        chunk[0].extend([kind, index])
+        chunk[1].append(rank)
+
+    keys = sorted(chunks)
+    return {
+            'size':   size,
+            'chunks': dict(('{:d},{:d}'.format(cx, cy), chunks[cy, cx][0]) for cy, cx in keys),
+            'order':  dict(('{:d},{:d}'.format(cx, cy), chunks[cy, cx][1]) for cy, cx in keys)
+        }
+
+# feature keys that vary between the members of an instance group
+INSTANCE_KEYS = ['idx', 'pos', 'order']
+
+def instanceFeatures(features):
+    # groups features that only differ in idx and pos, in order of each
+    # group's first feature. a group has the shared keys, 'pos' as a flat
+    # [x, y, ...] list, 'idx' as a number if it is the same for every
+    # feature or a list otherwise, and 'order' as each feature's rank among
+    # the features, so they expand back into their draw order. the stump
+    # following a mature tree is left out and its idx given as the group's
+    # 'stump'.
+    #
+    # returns the groups and the features in the order the groups expand to,
+    # that of features without None.
+    def isStump(index):
+        return index < len(features) and features[index] is not None and features[index].get('isStump', False)
+
+    groups = {}
+    rank = 0
+    for index, feature in enumerate(features):
+        if feature is None or isStump(index):
+            continue
+
+        shared = dict((k, v) for k, v in feature.items() if k not in INSTANCE_KEYS)
+        stump = features[index + 1] if isStump(index + 1) else None
+        if stump is not None:
+            shared['stump'] = stump['idx']
+
+        key = repr(sorted(shared.items()))
+        if key not in groups:
+            groups[key] = (shared, [])
+        groups[key][1].append((rank, feature))
+        rank += 1
+
+    instances = []
+    for shared, members in groups.values():
+        idx = [feature['idx'] for rank, feature in members]
+        pos = []
+        for rank, feature in members:
+            pos.extend(feature['pos'])
+
+        group = dict(shared)
+        group['idx'] = idx[0] if idx.count(idx[0]) == len(idx) else idx
+        group['pos'] = pos
+        group['order'] = [rank for rank, feature in members]
+        instances.append(group)
+
+    return instances, [feature for feature in features if feature is not None]
+
+def expandInstances(instances):
+    # the features of a dump written with instanceFeatures, in the same order
+    # as the features instanceFeatures returns
+    ranked = [None] * sum(len(group['order']) for group in instances)
+    for group in instances:
+        shared = dict((k, v) for k, v in group.items() if k not in INSTANCE_KEYS and k != 'stump')
+        pos = group['pos']
+        for i, rank in enumerate(group['order']):
+            feature = dict(shared)
+            feature['idx'] = group['idx'][i] if isinstance(group['idx'], list) else group['idx']
+            feature['pos'] = pos[2 * i:2 * i + 2]
+            ranked[rank] = [feature]
+
+            if 'stump' in group:
+                ranked[rank].append({'ts': group['ts'], 'idx': group['stump'], 'pos': feature['pos'], 'isStump': True})
+
+    return [feature for members in ranked for feature in members]
+
 def dump_position(pos):
     return [ pos.x, pos.y ]
 
 def useTilesheet(filename, save):
-    for idx, ts in enumerate(save.tilesheets):
-        if ts == filename:
-            return idx
-    else:
-        save.tilesheets.append(filename)
-        return len(save.tilesheets)-1
\ No newline at end of file
+    return save.tilesheets.use(filename)
\ No newline at end of file
@@ -0,0 +1,435 @@
+import os
+import io
+import json
+import time
+import asyncio
+import argparse
+import urllib.parse
+import multiprocessing
+import concurrent.futures
+
+import saves
+import extract
+import tilesheets
+import encoders
+import shards
+import cache
+
+CONTENT_TYPES = {
+        'json':    'application/json',
+        'msgpack': 'application/msgpack'
+    }
+
+REASONS = {
+        200: 'OK',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        411: 'Length Required',
+        413: 'Payload Too Large',
+        500: 'Internal Server Error',
+        503: 'Service Unavailable'
+    }
+
+# longest request line plus headers
+MAX_HEADER = 16 * 1024
+
+# refused uploads are read in pieces of DISCARD_CHUNK and dropped, for at
+# most DISCARD_SECONDS, and at most DISCARD_BYTES of those refused before
+# their Content-Length could be trusted
+DISCARD_CHUNK   = 64 * 1024
+DISCARD_SECONDS = 10
+DISCARD_BYTES   = 16 * 1024 * 1024
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=None):
+        Exception.__init__(self, message)
+        self.status  = status
+        self.headers = headers or {}
+
+# set in each worker process by init_worker
+_bucket_size = None
+
+def init_worker(backend, bucket_size):
+    global _bucket_size
+    _bucket_size = bucket_size
+    extract.setBackend(backend)
+
+def convert_save(data, format):
+    # runs in a worker; returns the encoded dump and the tilesheets it uses
+    save_file = saves.Save.load(io.BytesIO(data))
+    save_file.bucketSize = _bucket_size
+    return encoders.dumps(format, save_file.dump()), save_file.tilesheets.names
+
+def load_maps(filename):
+    # map dumps as written by json_map.py, to a file or as shards
+    if not os.path.isdir(filename):
+        return encoders.load(filename)
+
+    for name in sorted(os.listdir(filename)):
+        if os.path.splitext(name)[0] == shards.INDEX_NAME:
+            index = encoders.load(os.path.join(filename, name))
+            break
+    else:
+        raise FileNotFoundError("No shard index in {:s}".format(filename))
+
+    return dict((name, encoders.load(os.path.join(filename, shard))) for name, shard in index['shards'].items())
+
+class Request(object):
+    # the body is only read when the handler asks for it, so that uploads
+    # can be refused before they take up any memory
+    def __init__(self, method, path, query, headers, reader, writer, length):
+        self.method  = method
+        self.path    = path
+        self.query   = query
+        self.headers = headers
+        self.reader  = reader
+        self.writer  = writer
+        self.length  = length
+        self.body_read = False
+
+    def expects_continue(self):
+        return self.headers.get('expect', '').lower() == '100-continue'
+
+    async def read_body(self):
+        # a client that sent Expect: 100-continue waits for this before
+        # sending the body
+        if self.expects_continue():
+            self.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        self.body_read = True
+        return await self.reader.readexactly(self.length)
+
+    async def discard_body(self):
+        if self.body_read or self.expects_continue():
+            return
+        await discard(self.reader, self.length)
+
+    def format(self):
+        # ?format=msgpack, or by Accept header
+        formats = self.query.get('format')
+        if formats is not None:
+            if formats[0] not in encoders.WRITERS:
+                raise HTTPError(400, "Unknown format '{:s}'".format(formats[0]))
+            return formats[0]
+
+        if CONTENT_TYPES['msgpack'] in self.headers.get('accept', ''):
+            return 'msgpack'
+        return 'json'
+
+async def discard(reader, n):
+    # reads and drops up to n bytes of a refused upload, a piece at a time.
+    # closing the connection with them unread would reset the connection,
+    # and the client might never see the response.
+    while n > 0:
+        data = await reader.read(min(n, DISCARD_CHUNK))
+        if not data:
+            break
+        n -= len(data)
+
+async def read_request(reader, writer, max_body):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError:
+        raise HTTPError(400, "Request header too large")
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+    length = 0
+    if method == 'POST':
+        if 'content-length' not in headers:
+            raise HTTPError(411, "Content-Length required")
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise HTTPError(400, "Malformed Content-Length")
+        if length > max_body:
+            raise HTTPError(413, "Upload larger than {:d} bytes".format(max_body))
+
+    url = urllib.parse.urlsplit(target)
+    return Request(method, urllib.parse.unquote(url.path), urllib.parse.parse_qs(url.query), headers, reader, writer, length)
+
+class Server(object):
+    # converts uploaded saves in a pool of worker processes, and serves map
+    # dumps and tilesheet metadata from memory. at most jobs conversions run
+    # at once and queue_size more wait for a worker; requests beyond that get
+    # a 503 straight away instead of piling up. uploads are admitted before
+    # their body is read, so at most jobs + queue_size of them are in memory.
+    def __init__(self, args):
+        self.args       = args
+        self.jobs       = args.jobs or os.cpu_count() or 1
+        self.max_queued = self.jobs + args.queue
+        self.pending    = 0
+        self.executor   = None
+        self.started    = time.time()
+
+        self.maps     = {}
+        self.encoded  = {}
+        self.metadata = {}
+
+        if args.cache is not None:
+            # evicted in a thread instead, see evict_cache
+            self.cache = cache.ConversionCache(args.cache, args.cache_size * 1024 * 1024, evict_on_put=False)
+        else:
+            self.cache = None
+        self.cache_added = 0
+        self.evicting    = None
+
+        self.metrics = {
+                'requests':    {},
+                'conversions': {'ok': 0, 'failed': 0, 'cached': 0, 'rejected': 0},
+                'convert_seconds': 0.0,
+                'bytes_in':    0,
+                'bytes_out':   0
+            }
+
+    def start_pool(self):
+        # workers are started as they are needed. forked from this process,
+        # they would inherit the sockets of open connections and keep them
+        # open after the server has closed them, so they come from a fork
+        # server instead.
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=init_worker, initargs=(extract.backend.name, self.args.buckets))
+
+    def load(self):
+        if self.args.maps is not None:
+            print("Loading maps...")
+            self.maps = load_maps(self.args.maps)
+            print("\t{:d} maps".format(len(self.maps)))
+
+        # warms the metadata of every tilesheet the maps use
+        for map_dump in self.maps.values():
+            for ts in map_dump['tilesheets']:
+                self.tilesheet(ts)
+
+    def tilesheet(self, name):
+        # None if there is no metadata for the tilesheet
+        if name not in self.metadata:
+            try:
+                self.metadata[name] = tilesheets.load_metadata(name, self.args.tilesheet_dir)
+            except FileNotFoundError:
+                self.metadata[name] = None
+        return self.metadata[name]
+
+    def count(self, section, key):
+        counts = self.metrics[section]
+        counts[key] = counts.get(key, 0) + 1
+
+    async def handle(self, reader, writer):
+        path = None
+        request = None
+        try:
+            try:
+                request = await read_request(reader, writer, self.args.max_upload * 1024 * 1024)
+                path = request.path
+                status, headers, body = await self.route(request)
+            except HTTPError as e:
+                status, headers, body = e.status, e.headers, json_bytes({'error': str(e)})
+            except asyncio.IncompleteReadError:
+                return
+
+            self.count('requests', '{:d}'.format(status))
+            self.metrics['bytes_out'] += len(body)
+
+            headers.setdefault('Content-Type', CONTENT_TYPES['json'])
+            lines = ['HTTP/1.1 {:d} {:s}'.format(status, REASONS[status])]
+            lines += ['{:s}: {:s}'.format(k, v) for k, v in headers.items()]
+            lines += ['Content-Length: {:d}'.format(len(body)), 'Connection: close', '', '']
+            writer.write('\r\n'.join(lines).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+
+            if request is None or not request.body_read:
+                # the response is complete; the client may still be sending
+                if writer.can_write_eof():
+                    writer.write_eof()
+                try:
+                    if request is not None:
+                        await asyncio.wait_for(request.discard_body(), DISCARD_SECONDS)
+                    else:
+                        await asyncio.wait_for(discard(reader, DISCARD_BYTES), DISCARD_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+        except Exception as e:
+            print("Error handling {}: {}".format(path, e))
+        finally:
+            writer.close()
+
+    async def route(self, request):
+        parts = request.path.strip('/').split('/', 1)
+
+        if parts[0] == 'convert':
+            if request.method != 'POST':
+                raise HTTPError(405, "Use POST to upload a save")
+            return await self.convert(request)
+
+        if request.method != 'GET':
+            raise HTTPError(405, "Only GET is supported here")
+
+        if parts[0] == 'health':
+            return 200, {}, json_bytes({'status': 'ok', 'pending': self.pending, 'workers': self.jobs})
+
+        if parts[0] == 'metrics':
+            metrics = dict(self.metrics)
+            metrics.update({
+                    'uptime_seconds': time.time() - self.started,
+                    'pending':        self.pending,
+                    'max_pending':    self.max_queued,
+                    'workers':        self.jobs,
+                    'maps':           len(self.maps),
+                    'tilesheets':     len(self.metadata)
+                })
+            return 200, {}, json_bytes(metrics)
+
+        if parts[0] == 'maps':
+            if len(parts) == 1:
+                return 200, {}, json_bytes(sorted(self.maps))
+            return self.map(parts[1], request.format())
+
+        if parts[0] == 'tilesheets':
+            names = request.query.get('names', [''])[0].split(',')
+            manifest = dict((name, self.tilesheet(name)) for name in names if name)
+            return 200, {}, json_bytes(dict((k, v) for k, v in manifest.items() if v is not None))
+
+        raise HTTPError(404, "No such endpoint")
+
+    def map(self, name, format):
+        if name not in self.maps:
+            raise HTTPError(404, "No map named '{:s}'".format(name))
+
+        # each map is encoded once per format
+        key = (name, format)
+        if key not in self.encoded:
+            self.encoded[key] = encoders.dumps(format, self.maps[name])
+        return 200, {'Content-Type': CONTENT_TYPES[format]}, self.encoded[key]
+
+    async def convert(self, request):
+        format = request.format()
+
+        if self.pending >= self.max_queued:
+            self.metrics['conversions']['rejected'] += 1
+            raise HTTPError(503, "Too many conversions queued, try again later", {'Retry-After': '1'})
+
+        self.pending += 1
+        try:
+            return await self.convert_admitted(request, format)
+        finally:
+            self.pending -= 1
+
+    async def convert_admitted(self, request, format):
+        data = await request.read_body()
+        self.metrics['bytes_in'] += len(data)
+
+        # the upload is hashed and cache entries are read and written in
+        # threads, to keep the event loop free
+        loop = asyncio.get_running_loop()
+        if self.cache is not None:
+            key = await loop.run_in_executor(None, self.cache.key, data, saves.VERSION, format, self.args.buckets)
+            body = await loop.run_in_executor(None, self.cache.get, key)
+            if body is not None:
+                self.metrics['conversions']['cached'] += 1
+                return 200, {'Content-Type': CONTENT_TYPES[format]}, body
+
+        start = time.perf_counter()
+        executor = self.executor
+        try:
+            body, names = await loop.run_in_executor(executor, convert_save, data, format)
+        except extract.backend.ParseError as e:
+            self.metrics['conversions']['failed'] += 1
+            raise HTTPError(400, "Save is not valid XML: {}".format(e))
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker died, e.g. out of memory, and took the pool with it.
+            # every conversion in flight fails, but only the first restarts it.
+            self.metrics['conversions']['failed'] += 1
+            if executor is self.executor:
+                print("Worker pool broke, restarting it")
+                executor.shutdown(wait=False)
+                self.start_pool()
+            raise HTTPError(500, "Worker process died during conversion")
+        except Exception as e:
+            self.metrics['conversions']['failed'] += 1
+            raise HTTPError(500, "Conversion failed: {:s}: {}".format(type(e).__name__, e))
+        finally:
+            self.metrics['convert_seconds'] += time.perf_counter() - start
+
+        self.metrics['conversions']['ok'] += 1
+        for name in names:
+            self.tilesheet(name)
+
+        if self.cache is not None:
+            await loop.run_in_executor(None, self.cache.put, key, body)
+            self.cache_added += len(body)
+            if self.cache_added >= cache.EVICT_FRACTION * self.cache.max_bytes:
+                self.evict_cache()
+
+        return 200, {'Content-Type': CONTENT_TYPES[format]}, body
+
+    def evict_cache(self):
+        # walks the whole cache directory, so only one runs at a time
+        if self.evicting is not None and not self.evicting.done():
+            return
+        self.cache_added = 0
+        self.evicting = asyncio.get_running_loop().run_in_executor(None, self.cache.evict)
+
+def json_bytes(obj):
+    return json.dumps(obj, separators=(',',':')).encode('utf-8')
+
+async def serve(server, host, port):
+    server.start_pool()
+    if server.cache is not None:
+        server.evict_cache()
+    listener = await asyncio.start_server(server.handle, host, port, limit=MAX_HEADER)
+    print("Listening on {:s}:{:d}".format(host, port))
+    async with listener:
+        await listener.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert Stardew Valley saves over HTTP, serving map dumps and tilesheet metadata from memory.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--maps', help="map dumps written by json_map.py, as a file or a shard directory")
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+            help="number of conversion worker processes (default: one per core)")
+    parser.add_argument('--queue', type=int, default=8,
+            help="conversions that may wait for a worker before uploads are refused with 503 (default: %(default)s)")
+    parser.add_argument('--max-upload', type=int, default=64,
+            help="largest save upload in megabytes; larger ones are refused by their Content-Length, before they are read (default: %(default)s)")
+    parser.add_argument('--buckets', type=int, nargs='?', const=32, metavar='SIZE',
+            help="also index each location's objects by SIZE x SIZE tile chunks, as with json_save.py")
+    parser.add_argument('--cache',
+            help="directory to cache converted saves in, keyed by the contents of the upload and the converter version")
+    parser.add_argument('--cache-size', type=int, default=256,
+            help="maximum size of the cache in megabytes (default: %(default)s)")
+    parser.add_argument('--tilesheet-dir', default=tilesheets.DEFAULT_DIR,
+            help="directory containing the tilesheet metadata files (default: %(default)s)")
+    extract.add_arguments(parser)
+    args = parser.parse_args()
+
+    extract.setBackend(args.xml)
+
+    server = Server(args)
+    server.load()
+
+    try:
+        asyncio.run(serve(server, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server.executor is not None:
+            server.executor.shutdown()
+
+if __name__ == '__main__':
+    main()
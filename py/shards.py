@@ -0,0 +1,47 @@
+import os
+import re
+
+import encoders
+
+# the index is INDEX_NAME plus the extension of the output format
+INDEX_NAME = 'index'
+
+class ShardWriter(object):
+    # writes one file per location plus an index mapping location names to
+    # their files, so a viewer only has to fetch the location it shows
+    def __init__(self, directory, format='json'):
+        self.directory  = directory
+        self.format     = format
+        self.extension  = encoders.EXTENSIONS[format]
+        self.index_file = INDEX_NAME + self.extension
+        self.shards     = {}
+        self.filenames  = set()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def shard_filename(self, name):
+        base = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        filename = base + self.extension
+
+        n = 1
+        while filename in self.filenames or filename == self.index_file:
+            filename = '{:s}-{:d}{:s}'.format(base, n, self.extension)
+            n += 1
+
+        self.filenames.add(filename)
+        return filename
+
+    def write(self, name, obj):
+        filename = self.shard_filename(name)
+        with open(os.path.join(self.directory, filename), 'wb') as f:
+            encoders.dump(self.format, obj, f)
+
+        self.shards[name] = filename
+        return filename
+
+    def write_index(self, index=None):
+        index = dict(index) if index is not None else {}
+        index['shards'] = self.shards
+
+        with open(os.path.join(self.directory, self.index_file), 'wb') as f:
+            encoders.dump(self.format, index, f)
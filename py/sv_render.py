@@ -0,0 +1,26 @@
+import argparse
+import importlib
+
+# module implementing each subcommand, with a main(argv, prog). modules are
+# only imported when their subcommand runs, so that e.g. converting a save
+# never loads the XNB reader.
+COMMANDS = {
+        'save':   ('json_save', "convert a save file"),
+        'maps':   ('json_map',  "convert XTile maps"),
+        'bundle': ('bundle',    "convert a save and the maps of its locations for the viewer")
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert Stardew Valley saves and maps for the viewer.",
+            epilog='\n'.join('{:8s} {:s}'.format(name, COMMANDS[name][1]) for name in sorted(COMMANDS)),
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+            help="arguments of the command; see %(prog)s COMMAND --help")
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    module.main(args.args, '{:s} {:s}'.format(parser.prog, args.command))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import random
+from xml.sax.saxutils import escape
+
+XSI = 'http://www.w3.org/2001/XMLSchema-instance'
+
+SEASONS = ['spring', 'summer', 'fall', 'winter']
+
+# default number of entities per location
+DEFAULT_COUNTS = {
+        'fences':    400,
+        'floors':    2000,
+        'hoedirt':   2000,
+        'trees':     300,
+        'grass':     1500,
+        'objects':   300,
+        'buildings': 8,
+        'clumps':    20
+    }
+
+# GameLocation subclass of the synthetic locations that have one
+LOCATION_TYPES = {
+        'Farm': 'Farm'
+    }
+
+class Grid(object):
+    # hands out free tiles in a location, in connected patches so that fences,
+    # floors and hoe dirt have realistic neighbours
+    def __init__(self, rnd, width, height):
+        self.rnd    = rnd
+        self.width  = width
+        self.height = height
+        self.used   = set()
+
+    def free(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height and (x, y) not in self.used
+
+    def take(self, x, y):
+        self.used.add((x, y))
+        return (x, y)
+
+    def scatter(self, n):
+        out = []
+        while len(out) < n and len(self.used) < self.width * self.height:
+            x, y = self.rnd.randrange(self.width), self.rnd.randrange(self.height)
+            if self.free(x, y):
+                out.append(self.take(x, y))
+        return out
+
+    def patches(self, n, size):
+        # filled rectangles of up to size x size tiles
+        out = []
+        while len(out) < n and len(self.used) < self.width * self.height:
+            x0, y0 = self.rnd.randrange(self.width), self.rnd.randrange(self.height)
+            w,  h  = self.rnd.randint(1, size), self.rnd.randint(1, size)
+            for y in range(y0, y0 + h):
+                for x in range(x0, x0 + w):
+                    if len(out) < n and self.free(x, y):
+                        out.append(self.take(x, y))
+        return out
+
+    def outlines(self, n, size):
+        # rectangle outlines, like fenced pens
+        out = []
+        while len(out) < n and len(self.used) < self.width * self.height:
+            x0, y0 = self.rnd.randrange(self.width), self.rnd.randrange(self.height)
+            w,  h  = self.rnd.randint(2, size), self.rnd.randint(2, size)
+            for y in range(y0, y0 + h):
+                for x in range(x0, x0 + w):
+                    edge = x in (x0, x0 + w - 1) or y in (y0, y0 + h - 1)
+                    if edge and len(out) < n and self.free(x, y):
+                        out.append(self.take(x, y))
+        return out
+
+def vector2(x, y):
+    return '<Vector2><X>{:d}</X><Y>{:d}</Y></Vector2>'.format(x, y)
+
+def bool_text(b):
+    return 'true' if b else 'false'
+
+def write_object(f, rnd, pos, type_, name, extra=''):
+    x, y = pos
+    f.write('<item><key>{:s}</key><value><Object xsi:type="{:s}">'.format(vector2(x, y), type_))
+    f.write('<Name>{:s}</Name><category>{:d}</category><bigCraftable>{:s}</bigCraftable>'.format(
+        escape(name), rnd.choice([-2, -5, -8, -16, -74]), bool_text(type_ == 'Object' and rnd.random() < 0.3)))
+    f.write('<tileLocation><X>{:d}</X><Y>{:d}</Y></tileLocation><parentSheetIndex>{:d}</parentSheetIndex>'.format(
+        x, y, rnd.randrange(800)))
+    # fields the converter ignores, as in real saves
+    f.write('<stack>1</stack><quality>0</quality><price>0</price><edibility>-300</edibility>')
+    f.write(extra)
+    f.write('</Object></value></item>')
+
+def write_feature(f, pos, type_, fields):
+    x, y = pos
+    f.write('<item><key>{:s}</key><value><TerrainFeature xsi:type="{:s}">'.format(vector2(x, y), type_))
+    for tag, value in fields:
+        f.write('<{0:s}>{1:s}</{0:s}>'.format(tag, value))
+    f.write('</TerrainFeature></value></item>')
+
+def write_location(f, rnd, name, counts, width, height):
+    grid = Grid(rnd, width, height)
+
+    # the game only writes xsi:type for subclasses of GameLocation
+    if name in LOCATION_TYPES:
+        f.write('<GameLocation xsi:type="{:s}">'.format(LOCATION_TYPES[name]))
+    else:
+        f.write('<GameLocation>')
+    f.write('<name>{:s}</name>'.format(escape(name)))
+
+    f.write('<characters>')
+    for x, y in grid.scatter(3):
+        type_, npc = rnd.choice([('Cat', 'Cat'), ('Horse', 'Horse'), ('NPC', 'Abigail'), ('NPC', 'Lewis')])
+        f.write('<NPC xsi:type="{:s}"><Position><X>{:d}</X><Y>{:d}</Y></Position><name>{:s}</name></NPC>'.format(
+            type_, x * 64, y * 64, npc))
+    f.write('</characters>')
+
+    f.write('<objects>')
+    for pos in grid.outlines(counts['fences'], 12):
+        which = rnd.choice([1, 1, 2, 3, 5, 4])
+        write_object(f, rnd, pos, 'Fence', 'Fence', '<whichType>{:d}</whichType>'.format(which))
+    for idx, pos in enumerate(grid.scatter(counts['objects'])):
+        write_object(f, rnd, pos, 'Object', 'Object {:d}'.format(idx))
+    f.write('</objects>')
+
+    f.write('<buildings>')
+    for x, y in grid.scatter(counts['buildings']):
+        type_, w, h = rnd.choice([('Barn', 7, 4), ('Coop', 6, 3), ('Silo', 3, 3), ('Stable', 4, 2)])
+        f.write('<Building><buildingType>{:s}</buildingType><tileX>{:d}</tileX><tileY>{:d}</tileY>'
+                '<tilesWide>{:d}</tilesWide><tilesHigh>{:d}</tilesHigh></Building>'.format(type_, x, y, w, h))
+    f.write('</buildings>')
+
+    f.write('<resourceClumps>')
+    for x, y in grid.scatter(counts['clumps']):
+        f.write('<ResourceClump><tile><X>{:d}</X><Y>{:d}</Y></tile><width>2</width><height>2</height>'
+                '<parentSheetIndex>{:d}</parentSheetIndex></ResourceClump>'.format(x, y, rnd.choice([600, 602, 672])))
+    f.write('</resourceClumps>')
+
+    f.write('<terrainFeatures>')
+    for pos in grid.patches(counts['floors'], 10):
+        write_feature(f, pos, 'Flooring', [
+                ('whichFloor', str(rnd.randrange(10))),
+                ('whichView',  '0')
+            ])
+    for pos in grid.patches(counts['hoedirt'], 15):
+        write_feature(f, pos, 'HoeDirt', [
+                ('fertilizer', '0'),
+                ('state',      str(rnd.choice([0, 1])))
+            ])
+    for pos in grid.scatter(counts['trees']):
+        write_feature(f, pos, 'Tree', [
+                ('growthStage', str(rnd.choice([0, 1, 2, 3, 4, 5, 5, 5]))),
+                ('treeType',    str(rnd.choice([1, 2, 3]))),
+                ('flipped',     bool_text(rnd.random() < 0.5)),
+                ('stump',       bool_text(rnd.random() < 0.1)),
+                ('tapped',      bool_text(rnd.random() < 0.2)),
+                ('hasSeed',     bool_text(rnd.random() < 0.5))
+            ])
+    for pos in grid.patches(counts['grass'], 6):
+        write_feature(f, pos, 'Grass', [
+                ('grassType',         '1'),
+                ('numberOfWeeds',     str(rnd.randint(1, 4))),
+                ('grassSourceOffset', '0')
+            ])
+    f.write('</terrainFeatures>')
+
+    f.write('</GameLocation>')
+
+def write_save(f, locations=4, counts=None, width=160, height=160, seed=0):
+    # writes a Stardew Valley shaped save to the text file f. counts overrides
+    # DEFAULT_COUNTS, per location.
+    rnd = random.Random(seed)
+    counts = dict(DEFAULT_COUNTS, **(counts or {}))
+
+    f.write('<?xml version="1.0" encoding="utf-8"?>')
+    f.write('<SaveGame xmlns:xsi="{:s}" xmlns:xsd="http://www.w3.org/2001/XMLSchema">'.format(XSI))
+    f.write('<player><name>Bench</name><farmName>Synthetic</farmName>'
+            '<houseUpgradeLevel>{:d}</houseUpgradeLevel><hasGreenhouse>{:s}</hasGreenhouse></player>'.format(
+            rnd.randrange(3), bool_text(rnd.random() < 0.5)))
+
+    f.write('<locations>')
+    for idx in range(locations):
+        name = 'Farm' if idx == 0 else 'Location{:d}'.format(idx)
+        write_location(f, rnd, name, counts, width, height)
+    f.write('</locations>')
+
+    f.write('<currentSeason>{:s}</currentSeason><dayOfMonth>{:d}</dayOfMonth><year>{:d}</year>'.format(
+        rnd.choice(SEASONS[:3]), rnd.randint(1, 28), rnd.randint(1, 5)))
+    f.write('</SaveGame>')
+
+class Size(object):
+    def __init__(self, width, height):
+        self.width  = width
+        self.height = height
+
+class TileSheet(object):
+    def __init__(self, image_source):
+        self.image_source = image_source
+        self.properties   = {}
+
+class Layer(object):
+    def __init__(self, layer_id, size, tiles, visible=True):
+        self.layer_id   = layer_id
+        self.size       = size
+        self.tile_size  = Size(16, 16)
+        self.tiles      = tiles
+        self.visible    = visible
+        self.properties = {}
+
+class Map(object):
+    # has the attributes of xnb.xtile.Map that maps.dump_map uses
+    def __init__(self, tilesheets, layers):
+        self.tilesheets = tilesheets
+        self.layers     = layers
+        self.properties = {'Outdoors': 'T'}
+
+def static_tile(tilesheet, index):
+    import xnb.xtile
+
+    # bypass the XNB reader's constructor; dump_map only needs these attributes
+    tile = xnb.xtile.StaticTile.__new__(xnb.xtile.StaticTile)
+    tile.tilesheet  = tilesheet
+    tile.index      = index
+    tile.properties = {}
+    return tile
+
+LAYER_IDS = ['Back', 'Buildings', 'Paths', 'Front', 'AlwaysFront']
+
+def make_map(width=150, height=150, layers=5, seed=0):
+    # a tile map with long runs of repeated tiles and empty regions, like the
+    # game's outdoor maps. needs xnb for the tile class.
+    rnd = random.Random(seed)
+    tilesheets = [TileSheet('spring_outdoorsTileSheet'), TileSheet('paths')]
+
+    output_layers = []
+    for layer_num in range(layers):
+        layer_id = LAYER_IDS[layer_num % len(LAYER_IDS)]
+        density  = 1.0 if layer_id == 'Back' else 0.2
+
+        palette = [static_tile(rnd.choice(tilesheets), rnd.randrange(1500)) for _ in range(64)]
+
+        rows = []
+        for y in range(height):
+            row = []
+            tile = None
+            for x in range(width):
+                if x == 0 or rnd.random() < 0.3:
+                    tile = rnd.choice(palette) if rnd.random() < density else None
+                row.append(tile)
+            rows.append(row)
+
+        output_layers.append(Layer(layer_id, Size(width, height), rows, layer_id != 'Paths'))
+
+    return Map(tilesheets, output_layers)
@@ -0,0 +1,264 @@
+import io
+import os
+import json
+import base64
+import xml.etree.ElementTree
+
+import pytest
+
+import saves
+import extract
+import parallel
+import shards
+import encoders
+import synthetic
+import watch
+
+# small enough to convert in well under a second, with enough connectables
+# in each location for the NumPy path
+COUNTS = {
+        'fences':    150,
+        'floors':    150,
+        'hoedirt':   100,
+        'trees':     30,
+        'grass':     60,
+        'objects':   20,
+        'buildings': 2,
+        'clumps':    3
+    }
+
+def write_save(filename, locations=3, seed=0):
+    with open(filename, 'w', encoding='utf-8') as f:
+        synthetic.write_save(f, locations, COUNTS, width=48, height=48, seed=seed)
+
+def json_bytes(obj):
+    return json.dumps(obj, separators=(',',':')).encode('utf-8')
+
+def dump_serial(filename):
+    return json_bytes(saves.Save.load(filename).dump())
+
+def dump_stream(filename, format):
+    save = saves.Save.loadHeader(filename)
+    f = io.BytesIO()
+    save.dumpStream(encoders.writer(format, f), (l.dump(save) for l in saves.iterLocations(filename)))
+    return f.getvalue()
+
+@pytest.fixture(scope='module')
+def save_file(tmp_path_factory):
+    filename = str(tmp_path_factory.mktemp('save') / 'save.xml')
+    write_save(filename)
+    return filename
+
+@pytest.fixture(scope='module')
+def serial(save_file):
+    return dump_serial(save_file)
+
+def test_stream(save_file, serial):
+    assert dump_stream(save_file, 'json') == serial
+
+def test_stream_msgpack(save_file, serial):
+    assert dump_stream(save_file, 'msgpack') == encoders.dumps('msgpack', json.loads(serial))
+
+def test_parallel(save_file, serial):
+    save = saves.Save.loadHeader(save_file)
+    assert json_bytes(save.dump(parallel.dumpLocations(save, save_file, 2))) == serial
+
+def test_shards(save_file, serial, tmp_path):
+    save = saves.Save.loadHeader(save_file)
+    writer = shards.ShardWriter(str(tmp_path))
+    save.dumpShards(writer, (l.dump(save) for l in saves.iterLocations(save_file)))
+
+    save_dump = json.loads(serial)
+    with open(os.path.join(writer.directory, writer.index_file)) as f:
+        index = json.load(f)
+    assert index['tilesheets'] == save_dump['tilesheets']
+
+    for location in save_dump['locations']:
+        with open(os.path.join(writer.directory, writer.shards[location['name']]), 'rb') as f:
+            assert f.read() == json_bytes(location)
+
+def test_lxml(save_file, serial):
+    pytest.importorskip('lxml')
+    extract.setBackend('lxml')
+    try:
+        assert dump_serial(save_file) == serial
+    finally:
+        extract.setBackend('etree')
+
+def test_scalar_connectables(save_file, serial, monkeypatch):
+    if saves.importNumpy() is None:
+        pytest.skip("numpy is not installed")
+    monkeypatch.setattr(saves, 'numpy', None)
+    assert dump_serial(save_file) == serial
+
+def test_instanced(save_file, serial):
+    save = saves.Save.load(save_file)
+    save.instanced = True
+    instanced = save.dump()
+
+    for a, b in zip(instanced['locations'], json.loads(serial)['locations']):
+        assert 'features' not in a
+        # same features in the same draw order, not just the same multiset
+        assert saves.expandInstances(a['instances']) == [f for f in b['features'] if f is not None]
+
+def test_buckets(save_file):
+    save = saves.Save.load(save_file)
+    save.bucketSize = 8
+    for location in save.dump()['locations']:
+        ranked = {}
+        for key, bucket in location['buckets']['chunks'].items():
+            for i, rank in enumerate(location['buckets']['order'][key]):
+                ranked[rank] = (saves.BUCKET_KINDS[bucket[2 * i]], bucket[2 * i + 1])
+        assert sorted(ranked) == list(range(len(ranked)))
+
+        def row(kind, index):
+            obj = location[kind][index]
+            return obj['pos'][1] + (obj['size'][1] - 1 if kind == 'buildings' else 0)
+        rows = [row(*ranked[rank]) for rank in range(len(ranked))]
+        assert rows == sorted(rows)
+
+        # stumps of mature trees come right before their tree
+        rank_of = dict((v, k) for k, v in ranked.items())
+        for index, feature in enumerate(location['features']):
+            if feature is not None and feature.get('isStump'):
+                assert rank_of['features', index] + 1 == rank_of['features', index - 1]
+
+def test_buckets_match_compose(save_file):
+    # the viewer draws the same order with and without buckets
+    import compose
+    save = saves.Save.load(save_file)
+    save.bucketSize = 8
+    save_dump = save.dump()
+    for location in save_dump['locations']:
+        ranked = {}
+        for key, bucket in location['buckets']['chunks'].items():
+            for i, rank in enumerate(location['buckets']['order'][key]):
+                ranked[rank] = location[saves.BUCKET_KINDS[bucket[2 * i]]][bucket[2 * i + 1]]
+
+        bucketed = [(ranked[rank]['idx'], ranked[rank]['pos'][0]) for rank in range(len(ranked))]
+        assert bucketed == [(obj['idx'], obj['pos'][0]) for obj in compose.location_objects(save_dump, location)]
+
+def test_query_positions(save_file):
+    import query
+    index = query.SaveIndex(saves.Save.load(save_file))
+
+    for location, kind, obj in index.find(kind='characters'):
+        tile = (obj.pos.x // 64, obj.pos.y // 64)
+        assert (location, kind, obj) in index.find(location=location, pos=tile)
+
+    with pytest.raises(ValueError):
+        index.find(pos=(0, 0))
+
+def test_expand_instances():
+    tree  = {'ts': 0, 'idx': 3, 'pos': [1, 2], 'type': 'Tree'}
+    stump = {'ts': 0, 'idx': 9, 'pos': [1, 2], 'isStump': True}
+    features = [
+            {'ts': 1, 'idx': 5, 'pos': [0, 0]},
+            tree,
+            stump,
+            {'ts': 1, 'idx': 6, 'pos': [4, 0]},
+            None,
+            {'ts': 1, 'idx': 5, 'pos': [8, 0], 'flip': True}
+        ]
+
+    instances, expanded = saves.instanceFeatures(features)
+    assert len(instances) == 3
+    assert instances[0]['idx'] == [5, 6]
+    assert instances[0]['pos'] == [0, 0, 4, 0]
+    assert instances[1]['stump'] == 9
+    assert instances[0]['order'] == [0, 2]
+    assert expanded == [f for f in features if f is not None]
+    assert saves.expandInstances(instances) == expanded
+
+def test_apply_delta(tmp_path):
+    xml.etree.ElementTree.register_namespace('xsi', synthetic.XSI)
+    save_file  = str(tmp_path / 'save.xml')
+    output_dir = str(tmp_path / 'output')
+    os.makedirs(output_dir)
+
+    write_save(save_file, locations=4)
+    assert watch.export(save_file, output_dir) == watch.BASE_FILE
+    assert watch.export(save_file, output_dir) is None
+
+    # change one location, rename another and drop a third
+    tree = xml.etree.ElementTree.parse(save_file)
+    locations = tree.getroot().find('locations')
+    gamelocations = locations.findall('GameLocation')
+    gamelocations[1].find('terrainFeatures').clear()
+    gamelocations[2].find('name').text = 'Renamed'
+    locations.remove(gamelocations[3])
+    tree.write(save_file, encoding='utf-8', xml_declaration=True)
+
+    delta_filename = watch.export(save_file, output_dir)
+    assert delta_filename == watch.DELTA_FILE.format(1)
+
+    with open(os.path.join(output_dir, watch.BASE_FILE)) as f:
+        base = json.load(f)
+    with open(os.path.join(output_dir, delta_filename)) as f:
+        delta = json.load(f)
+    assert sorted(l['name'] for l in delta['locations']) == ['Location1', 'Renamed']
+    assert sorted(delta['removed']) == ['Location2', 'Location3']
+
+    # tilesheet ids carry over between exports, so compare by name
+    def resolve(save_dump):
+        names = save_dump['tilesheets']
+        for location in save_dump['locations']:
+            for key in ['characters', 'items', 'buildings', 'features']:
+                for obj in location[key]:
+                    if obj is not None:
+                        obj['ts'] = [names[t] for t in obj['ts']] if isinstance(obj['ts'], list) else names[obj['ts']]
+        del save_dump['tilesheets']
+        return save_dump
+
+    assert resolve(watch.applyDelta(base, delta)) == resolve(json.loads(dump_serial(save_file)))
+
+SAMPLE = {
+        'name':  'Farm',
+        'ints':  [0, 1, -1, -33, 127, 128, 255, 256, 65535, 65536, 2 ** 32, -2 ** 31 - 1],
+        'float': 0.5,
+        'flags': [True, False, None],
+        'text':  ['', 'a' * 31, 'b' * 32, 'c' * 300, 'ü'],
+        'list':  [[], [1] * 16, {}],
+        'map':   dict(('k{:d}'.format(i), i) for i in range(20)),
+        'bytes': b'\x00\x01\xff' * 100
+    }
+
+def test_json_writer():
+    data = encoders.dumps('json', SAMPLE)
+    assert data == json.dumps(SAMPLE, separators=(',',':'), default=encoders.json_default).encode('utf-8')
+
+    # bytes come back as base64
+    output = json.loads(data)
+    assert base64.b64decode(output.pop('bytes')) == SAMPLE['bytes']
+    assert output == dict((k, v) for k, v in SAMPLE.items() if k != 'bytes')
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip('msgpack')
+    data = encoders.dumps('msgpack', SAMPLE)
+    assert encoders.packb(SAMPLE) == data
+    assert msgpack.unpackb(data, raw=False) == SAMPLE
+
+def test_stream_writers():
+    # the streaming calls must produce the same document as a whole dump
+    for format in sorted(encoders.WRITERS):
+        f = io.BytesIO()
+        writer = encoders.writer(format, f)
+        writer.begin_map(2)
+        writer.key('name')
+        writer.value(SAMPLE['name'])
+        writer.key('list')
+        writer.begin_array(len(SAMPLE['list']))
+        for item in SAMPLE['list']:
+            writer.value(item)
+        writer.end()
+        writer.end()
+        assert f.getvalue() == encoders.dumps(format, {'name': SAMPLE['name'], 'list': SAMPLE['list']})
+
+def test_load(tmp_path):
+    for format in sorted(encoders.WRITERS):
+        if format == 'msgpack' and encoders.msgpack is None:
+            continue
+        filename = str(tmp_path / ('sample' + encoders.EXTENSIONS[format]))
+        with open(filename, 'wb') as f:
+            encoders.dump(format, SAMPLE['map'], f)
+        assert encoders.load(filename) == SAMPLE['map']
@@ -0,0 +1,234 @@
+import re
+import sys
+import array
+import argparse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import encoders
+import tilesheets
+import layers
+
+# tilesheet property keys, e.g. @TileIndex@1229@Water
+TILE_PROPERTY = re.compile(r'^@TileIndex@(\d+)@(.+)$')
+
+def parse_properties(properties):
+    # {'@TileIndex@1229@Water': 'T'} -> {'Water': {1229: 'T'}}
+    output = {}
+    for k, value in properties.items():
+        match = TILE_PROPERTY.match(k)
+        if match is None:
+            continue
+        output.setdefault(match.group(2), {})[int(match.group(1))] = value
+    return output
+
+def value_key(value):
+    # property values may be strings, bools or numbers; True must not be
+    # taken for 1
+    return (type(value).__name__, value)
+
+def tile_count(metadata, parsed):
+    if 'sprites' in metadata:
+        n = len(metadata['sprites'])
+    elif 'sheet_size' in metadata:
+        n = metadata['sheet_size'][0] * metadata['sheet_size'][1]
+    else:
+        n = 0
+
+    # properties of tiles past the end of the sheet are kept anyway
+    for by_index in parsed.values():
+        n = max(n, max(by_index) + 1)
+    return n
+
+def build_table(metadata):
+    # each property becomes a list of its distinct values and one code per
+    # tile in the sheet: 0 where the tile does not have the property, i where
+    # it has values[i - 1]. codes are uint8, or little-endian uint16 for
+    # properties with 255 values or more.
+    parsed = parse_properties(metadata.get('properties', {}))
+    if len(parsed) == 0:
+        return None
+
+    n = tile_count(metadata, parsed)
+    output = {'size': n, 'properties': {}}
+
+    for key in sorted(parsed):
+        by_index = parsed[key]
+        values = [value for name, value in sorted(set(value_key(v) for v in by_index.values()))]
+        code = dict((value_key(value), i + 1) for i, value in enumerate(values))
+
+        typecode = 'B' if len(values) < 0xff else 'H'
+        codes = array.array(typecode, [0]) * n
+        for idx, value in by_index.items():
+            codes[idx] = code[value_key(value)]
+
+        if typecode == 'H' and sys.byteorder == 'big':
+            codes.byteswap()
+
+        output['properties'][key] = {
+                'values': values,
+                'type':   typecode,
+                'codes':  codes.tobytes()
+            }
+
+    return output
+
+def build_tables(names, directory=tilesheets.DEFAULT_DIR):
+    # tables of the tilesheets that have tile properties
+    output = {}
+    for name in names:
+        try:
+            table = build_table(tilesheets.load_file(name, directory))
+        except FileNotFoundError:
+            print("No metadata for tilesheet '{:s}'".format(name))
+            continue
+
+        if table is not None:
+            output[name] = table
+    return output
+
+def write_tables(filename, names, directory=tilesheets.DEFAULT_DIR, format=None):
+    if format is None:
+        format = encoders.format_for(filename)
+
+    with open(filename, 'wb') as f:
+        encoders.dump(format, build_tables(names, directory), f)
+
+class TileProperties(object):
+    # answers property queries over whole dumped layers with array lookups.
+    # values are merged across tilesheets, so a code means the same value
+    # whichever sheet a tile comes from.
+    def __init__(self, tables):
+        self.values = {}
+        self.code   = {}
+        self.codes  = {}
+
+        for name, table in tables.items():
+            for key, prop in table['properties'].items():
+                values = self.values.setdefault(key, [None])
+                code = self.code.setdefault(key, {})
+                dtype = numpy.uint8 if prop['type'] == 'B' else numpy.dtype('<u2')
+                local = numpy.frombuffer(layers.tile_bytes(prop['codes']), dtype=dtype)
+
+                mapping = numpy.zeros(len(prop['values']) + 1, dtype=numpy.uint16)
+                for i, value in enumerate(prop['values']):
+                    if value_key(value) not in code:
+                        code[value_key(value)] = len(values)
+                        values.append(value)
+                    mapping[i + 1] = code[value_key(value)]
+
+                self.codes.setdefault(key, {})[name] = mapping[local]
+
+    @staticmethod
+    def load(filename):
+        return TileProperties(encoders.load(filename))
+
+    def keys(self):
+        return sorted(self.values)
+
+    def lookup(self, key, names):
+        # code of every (tilesheet id, tile index) of a map with the given
+        # tilesheets, as an array with one extra column of zeros that out of
+        # range and empty tiles are clipped to
+        by_sheet = self.codes.get(key, {})
+        size = max([len(by_sheet[name]) for name in names if name in by_sheet] + [0])
+
+        lut = numpy.zeros((max(len(names), 1), size + 1), dtype=numpy.uint16)
+        for ts, name in enumerate(names):
+            if name in by_sheet:
+                lut[ts, :len(by_sheet[name])] = by_sheet[name]
+        return lut
+
+    def layer(self, map_dump, layer):
+        # layer is an index into the map's layers, or the layer dump itself
+        if isinstance(layer, int):
+            layer = map_dump['layers'][layer]
+        return LayerProperties(self, map_dump['tilesheets'], layer)
+
+class LayerProperties(object):
+    # property queries over one layer; x and y are in tiles
+    def __init__(self, properties, names, layer):
+        self.properties = properties
+        self.names      = names
+        self.idx, self.ts = layers.decode_tiles(layer['tiles'], layer['size'])
+        self.luts       = {}
+
+    def codes(self, key):
+        # array of the layer's shape, with 0 where the tile does not have key
+        if key not in self.luts:
+            self.luts[key] = self.properties.lookup(key, self.names)
+        lut = self.luts[key]
+
+        return lut[self.ts, numpy.minimum(self.idx, lut.shape[1] - 1)]
+
+    def mask(self, key, value=None):
+        # tiles with key, or with key set to value
+        codes = self.codes(key)
+        if value is None:
+            return codes != 0
+
+        code = self.properties.code.get(key, {}).get(value_key(value))
+        if code is None:
+            return numpy.zeros(codes.shape, dtype=bool)
+        return codes == code
+
+    def values(self, key):
+        # values of key, indexed by code
+        return self.properties.values.get(key, [None])
+
+    def cell(self, x, y):
+        # looks the one tile up in each key's codes for its sheet, rather
+        # than building whole layers of codes
+        idx = int(self.idx[y, x])
+        if idx == layers.EMPTY_TILE:
+            return {}
+        name = self.names[self.ts[y, x]]
+
+        output = {}
+        for key in self.properties.keys():
+            codes = self.properties.codes[key].get(name)
+            if codes is not None and idx < len(codes) and codes[idx] != 0:
+                output[key] = self.properties.values[key][codes[idx]]
+        return output
+
+    def region(self, key, x0, y0, x1, y1):
+        # number of tiles with each value of key in [x0, x1) x [y0, y1)
+        codes = self.codes(key)[y0:y1, x0:x1]
+        counts = numpy.bincount(codes.ravel(), minlength=len(self.values(key)))
+        return dict((self.values(key)[code], int(n)) for code, n in enumerate(counts) if code != 0 and n > 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="Count tile properties over the layers of converted maps.")
+    parser.add_argument('tables', help="property tables written by json_map.py --properties")
+    parser.add_argument('maps_file', help="maps written by json_map.py")
+    parser.add_argument('maps', nargs='*', metavar='map', help="maps to count (default: all)")
+    parser.add_argument('--layer', type=int, default=0, help="layer index (default: %(default)s)")
+    parser.add_argument('--region', type=int, nargs=4, metavar=('X0', 'Y0', 'X1', 'Y1'),
+            help="only count tiles in this region")
+    args = parser.parse_args()
+
+    if numpy is None:
+        sys.exit("tileprops.py requires numpy")
+
+    properties = TileProperties.load(args.tables)
+    maps_dump = encoders.load(args.maps_file)
+
+    for name in args.maps or sorted(maps_dump):
+        if maps_dump[name] is None:
+            continue
+
+        layer = properties.layer(maps_dump[name], args.layer)
+        height, width = layer.idx.shape
+        x0, y0, x1, y1 = args.region or (0, 0, width, height)
+
+        print(name)
+        for key in properties.keys():
+            counts = layer.region(key, x0, y0, x1, y1)
+            if len(counts) > 0:
+                print("\t{:s}: {:s}".format(key, ', '.join('{}={:d}'.format(v, n) for v, n in sorted(counts.items(), key=lambda item: value_key(item[0])))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import json
+
+# tilesheet metadata files shipped with the viewer
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'www', 'tilesheets')
+
+# metadata the viewer needs; everything else (e.g. properties) is left out of the manifest
+MANIFEST_KEYS = ['src', 'img_src', 'sheet_size', 'tile_size', 'sprites']
+
+class Registry(object):
+    # assigns ids to tilesheets in order of first use. key maps a tilesheet to
+    # the value it is looked up by, e.g. id for objects that are not hashable.
+    def __init__(self, tilesheets=(), key=None):
+        self.key   = key
+        self.names = []
+        self.ids   = {}
+
+        for ts in tilesheets:
+            self.use(ts)
+
+    def use(self, ts):
+        k = ts if self.key is None else self.key(ts)
+
+        try:
+            return self.ids[k]
+        except KeyError:
+            idx = self.ids[k] = len(self.names)
+            self.names.append(ts)
+            return idx
+
+    def __len__(self):
+        return len(self.names)
+
+def load_file(name, directory=DEFAULT_DIR):
+    with open(os.path.join(directory, name + '.json')) as f:
+        return json.load(f)
+
+def load_metadata(name, directory=DEFAULT_DIR):
+    metadata = load_file(name, directory)
+    return dict((k, metadata[k]) for k in MANIFEST_KEYS if k in metadata)
+
+def write_manifest(filename, names, directory=DEFAULT_DIR):
+    # entries already in the manifest are kept, so the map and save exports
+    # can add to the same file
+    if os.path.exists(filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {}
+
+    for name in names:
+        if name in manifest:
+            continue
+
+        try:
+            manifest[name] = load_metadata(name, directory)
+        except FileNotFoundError:
+            print("No metadata for tilesheet '{:s}'".format(name))
+
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, separators=(',',':'))
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import saves
+import extract
+import tilesheets
+
+# files in the output directory
+STATE_FILE = 'state.json'
+BASE_FILE  = 'save.json'
+DELTA_FILE = 'delta-{:04d}.json'
+
+def saveFilename(path):
+    # a save directory contains the save file under the directory's own name
+    if os.path.isdir(path):
+        return os.path.join(path, os.path.basename(os.path.normpath(path)))
+    return path
+
+def headerFingerprint(save):
+    # parts of the save header that affect location dumps
+    return repr((save.date.season, save.player.houseUpgradeLevel, save.player.hasGreenhouse))
+
+def loadState(output_dir):
+    try:
+        with open(os.path.join(output_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def writeJSON(filename, obj):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f, separators=(',',':'))
+    os.replace(tmp_filename, filename)
+
+def export(filename, output_dir):
+    # writes a full dump on the first run, and a delta containing only the
+    # locations whose XML (or relevant header fields) changed after that.
+    # returns the name of the file written, or None if nothing changed.
+    state = loadState(output_dir)
+
+    save = saves.Save.loadHeader(filename)
+    save.tilesheets = tilesheets.Registry(state['tilesheets'] if state is not None else [])
+
+    header = headerFingerprint(save)
+
+    fingerprints = {}
+    changed = []
+    for kind, el in saves.iterparseSave(filename):
+        if kind != 'location':
+            continue
+
+        name = el.find('name').text
+
+        h = hashlib.sha1(header.encode('utf-8'))
+        h.update(extract.backend.module.tostring(el))
+        fingerprints[name] = h.hexdigest()
+
+        if state is None or state['fingerprints'].get(name) != fingerprints[name]:
+            changed.append(saves.Location(el).dump(save))
+
+    date   = save.date.dump()
+    player = save.player.dump(save)
+
+    if state is None:
+        sequence = 0
+        output_filename = BASE_FILE
+        output = {
+                'date':       date,
+                'player':     player,
+                'locations':  changed,
+                'tilesheets': save.tilesheets.names
+            }
+
+    else:
+        removed = [name for name in state['fingerprints'] if name not in fingerprints]
+
+        if len(changed) == 0 and len(removed) == 0 and [date, player] == state['header']:
+            return None
+
+        sequence = state['sequence'] + 1
+        output_filename = DELTA_FILE.format(sequence)
+        output = {
+                'sequence':   sequence,
+                'date':       date,
+                'player':     player,
+                'locations':  changed,
+                'removed':    removed,
+                'tilesheets': save.tilesheets.names
+            }
+
+    writeJSON(os.path.join(output_dir, output_filename), output)
+
+    # only recorded once the output exists, so a failed run is retried in full
+    writeJSON(os.path.join(output_dir, STATE_FILE), {
+            'sequence':     sequence,
+            'header':       [date, player],
+            'fingerprints': fingerprints,
+            'tilesheets':   save.tilesheets.names
+        })
+
+    return output_filename
+
+def applyDelta(save_dump, delta):
+    # patches a full dump (as written to BASE_FILE, or by json_save.py) in place
+    changed = dict((l['name'], l) for l in delta['locations'])
+
+    locations = []
+    for l in save_dump['locations']:
+        if l['name'] in delta['removed']:
+            continue
+        locations.append(changed.pop(l['name'], l))
+
+    # new locations, in save order
+    locations.extend(l for l in delta['locations'] if l['name'] in changed)
+
+    save_dump['date']       = delta['date']
+    save_dump['player']     = delta['player']
+    save_dump['locations']  = locations
+    save_dump['tilesheets'] = delta['tilesheets']
+    return save_dump
+
+def runExport(filename, output_dir):
+    print("Exporting save...")
+    output_filename = export(filename, output_dir)
+
+    if output_filename is None:
+        print("\tno changes")
+    else:
+        print("\twrote {:s}".format(output_filename))
+
+def watch(filename, output_dir, interval):
+    last_stamp = None
+
+    while True:
+        try:
+            st = os.stat(filename)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+
+        if stamp is not None and stamp != last_stamp:
+            try:
+                runExport(filename, output_dir)
+                last_stamp = stamp
+            except extract.backend.ParseError:
+                # the game is still writing the save; try again next time
+                print("\tsave is incomplete, retrying")
+            except Exception as e:
+                # e.g. a save cut short at a point that still parses, or one
+                # that can't be read yet; the game's next write changes it
+                print("\texport failed, retrying on the next change: {:s}: {}".format(type(e).__name__, e))
+                last_stamp = stamp
+
+        time.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch a Stardew Valley save and export only the locations that changed.")
+    parser.add_argument('save', help="save file, or save directory containing it")
+    parser.add_argument('output_dir')
+    parser.add_argument('--interval', type=float, default=5,
+            help="seconds between checks for a new save (default: %(default)s)")
+    parser.add_argument('--once', action='store_true',
+            help="export once and exit instead of watching")
+    extract.add_arguments(parser)
+    args = parser.parse_args()
+
+    extract.setBackend(args.xml)
+
+    filename = saveFilename(args.save)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.once:
+        runExport(filename, args.output_dir)
+    else:
+        watch(filename, args.output_dir, args.interval)
+
+if __name__ == '__main__':
+    main()
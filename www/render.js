@@ -8,6 +8,22 @@ const TILE_WIDTH  = 16,
 
 const ZOOM_FACTOR = 1.05;
 
+// tile index of empty cells in layer.idx
+const EMPTY_TILE = 0xffff;
+
+// layers and objects are drawn into square chunk canvases of CHUNK_TILES
+// tiles, as they come into view. the chunks drawn in the last frame are
+// kept, plus up to SPARE_CHUNKS that have scrolled out of view.
+const CHUNK_TILES = 32,
+      CHUNK_WIDTH  = CHUNK_TILES * TILE_WIDTH,
+      CHUNK_HEIGHT = CHUNK_TILES * TILE_HEIGHT,
+      SPARE_CHUNKS = 128;
+
+// how far tiles and objects can be drawn outside their own cell, in tiles
+// and chunks. tall tiles and objects extend upwards.
+const LAYER_MARGIN  = 2,
+      OBJECT_MARGIN = 1;
+
 var renderer = null;
 
 var viewport = {
@@ -16,15 +32,115 @@ var viewport = {
 		'zoom': 1,
 	};
 
+function resolve(url) {
+	// published files have content-hashed names, listed in the manifest
+	if(renderer.published.hasOwnProperty(url))
+		return renderer.published[url];
+	return url;
+}
+
 function xhr(url, callback) {
 	var oReq = new XMLHttpRequest();
 	oReq.addEventListener("load", callback);
-	oReq.open("GET", url);
+	oReq.open("GET", resolve(url));
 	oReq.send();
 }
 
+function xhrData(url, callback) {
+	// save and map files are JSON, or MessagePack if the URL ends in .msgpack
+	var oReq = new XMLHttpRequest();
+	let msgpack = url.endsWith('.msgpack');
+
+	oReq.addEventListener("load", function() {
+		if(msgpack)
+			callback(decodeMsgpack(new Uint8Array(this.response)));
+		else
+			callback(JSON.parse(this.responseText));
+	});
+	oReq.open("GET", resolve(url));
+	if(msgpack)
+		oReq.responseType = "arraybuffer";
+	oReq.send();
+}
+
+function decodeMsgpack(bytes) {
+	let view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+	let text = new TextDecoder();
+	let pos  = 0;
+
+	function str(n) {
+		let s = text.decode(bytes.subarray(pos, pos + n));
+		pos += n;
+		return s;
+	}
+
+	function bin(n) {
+		let b = bytes.subarray(pos, pos + n);
+		pos += n;
+		return b;
+	}
+
+	function array(n) {
+		let a = new Array(n);
+		for(let i = 0; i < n; i++)
+			a[i] = value();
+		return a;
+	}
+
+	function map(n) {
+		let m = {};
+		for(let i = 0; i < n; i++) {
+			let k = value();
+			m[k] = value();
+		}
+		return m;
+	}
+
+	function value() {
+		let b = bytes[pos++];
+		let v;
+
+		if(b < 0x80) return b;
+		if(b < 0x90) return map(b & 0x0f);
+		if(b < 0xa0) return array(b & 0x0f);
+		if(b < 0xc0) return str(b & 0x1f);
+		if(b >= 0xe0) return b - 0x100;
+
+		switch(b) {
+			case 0xc0: return null;
+			case 0xc2: return false;
+			case 0xc3: return true;
+			case 0xc4: v = bytes[pos];               pos += 1; return bin(v);
+			case 0xc5: v = view.getUint16(pos);      pos += 2; return bin(v);
+			case 0xc6: v = view.getUint32(pos);      pos += 4; return bin(v);
+			case 0xca: v = view.getFloat32(pos);     pos += 4; return v;
+			case 0xcb: v = view.getFloat64(pos);     pos += 8; return v;
+			case 0xcc: v = bytes[pos];               pos += 1; return v;
+			case 0xcd: v = view.getUint16(pos);      pos += 2; return v;
+			case 0xce: v = view.getUint32(pos);      pos += 4; return v;
+			case 0xcf: v = Number(view.getBigUint64(pos)); pos += 8; return v;
+			case 0xd0: v = view.getInt8(pos);        pos += 1; return v;
+			case 0xd1: v = view.getInt16(pos);       pos += 2; return v;
+			case 0xd2: v = view.getInt32(pos);       pos += 4; return v;
+			case 0xd3: v = Number(view.getBigInt64(pos)); pos += 8; return v;
+			case 0xd9: v = bytes[pos];               pos += 1; return str(v);
+			case 0xda: v = view.getUint16(pos);      pos += 2; return str(v);
+			case 0xdb: v = view.getUint32(pos);      pos += 4; return str(v);
+			case 0xdc: v = view.getUint16(pos);      pos += 2; return array(v);
+			case 0xdd: v = view.getUint32(pos);      pos += 4; return array(v);
+			case 0xde: v = view.getUint16(pos);      pos += 2; return map(v);
+			case 0xdf: v = view.getUint32(pos);      pos += 4; return map(v);
+		}
+
+		throw new Error("Unsupported MessagePack type 0x" + b.toString(16));
+	}
+
+	return value();
+}
+
 function tilesheetsLoaded() {
 	console.log("All tilesheets loaded!");
+	clearChunks();
 	request_redraw();
 }
 
@@ -44,6 +160,15 @@ function checkLoaded() {
 	renderer.has_loaded = true;
 }
 
+function hashRandom(x, y, n) {
+	// deterministic stand-in for Math.random(), so chunks look the same each
+	// time they are drawn. same as hash_random in compose.py.
+	let h = (Math.imul(x, 374761393) + Math.imul(y, 668265263) + Math.imul(n, 2246822519|0)) >>> 0;
+	h = Math.imul(h ^ (h >>> 13), 1274126177) >>> 0;
+	h = (h ^ (h >>> 16)) >>> 0;
+	return h / 4294967296;
+}
+
 const GRASSTABLE = [[-TILE_WIDTH/2, 0],
 				  [0,-TILE_HEIGHT/2],
 				  [TILE_WIDTH/2,  0],
@@ -64,21 +189,29 @@ function drawTile(ctx, tile, col, row) {
 		let scol =            tile.idx % ts.sheet_size[0],
 		    srow = Math.floor(tile.idx / ts.sheet_size[0]);
 
-	    if ("tileSize" in tile) {
-	    	w = tile.tileSize[0];
-	    	h = tile.tileSize[1];
-	    } else {
-			w  = ts.tile_size[0];
-			h  = ts.tile_size[1];
-	    }
-
-	    if ("offset" in tile) {
-	    	offsetX = tile.offset[0];
-	    	offsetY = tile.offset[1];
-	    }
+		w  = ts.tile_size[0];
+		h  = ts.tile_size[1];
 
 		sx = scol*ts.tile_size[0];
 		sy = srow*ts.tile_size[1];
+
+		// grid sheets packed into an atlas are offset within it
+		if(ts.offset) {
+			sx += ts.offset[0];
+			sy += ts.offset[1];
+		}
+	}
+
+	// atlased tilesheets keep their layout, so sizes spanning several
+	// sprites work the same for both
+	if ("tileSize" in tile) {
+		w = tile.tileSize[0];
+		h = tile.tileSize[1];
+	}
+
+	if ("offset" in tile) {
+		offsetX = tile.offset[0];
+		offsetY = tile.offset[1];
 	}
 
 	let dx = col*TILE_WIDTH,
@@ -88,9 +221,9 @@ function drawTile(ctx, tile, col, row) {
 	if (tile.isGrass) {
 		// draw four more sprites in randomly perturbed area nearby.
 		for (let i = 0; i < 4; i++) {
-			let new_sx = sx + Math.floor(Math.random() * 3) * ts.tile_size[0];
-			let offsetX2 = GRASSTABLE[i][0] + Math.floor(Math.random() * TILE_WIDTH/2 - TILE_WIDTH/4);
-			let offsetY2 = GRASSTABLE[i][1] + Math.floor(Math.random() * TILE_WIDTH/2 - TILE_WIDTH/4);
+			let new_sx = sx + Math.floor(hashRandom(col, row, i*3) * 3) * ts.tile_size[0];
+			let offsetX2 = GRASSTABLE[i][0] + Math.floor(hashRandom(col, row, i*3+1) * TILE_WIDTH/2 - TILE_WIDTH/4);
+			let offsetY2 = GRASSTABLE[i][1] + Math.floor(hashRandom(col, row, i*3+2) * TILE_WIDTH/2 - TILE_WIDTH/4);
 			ctx.drawImage(ts.img, new_sx, sy, w, h
 				, dx + offsetX + offsetX2
 				, dy + offsetY + offsetY2
@@ -99,65 +232,202 @@ function drawTile(ctx, tile, col, row) {
 	}
 }
 
-function redrawLayer(layer) {
-	layer.tiles.forEach(function(line, row) {
-		line.forEach(function(tile, col) {
-			if(tile === null)
-				return;
-			else
-				drawTile(layer.ctx, tile, col, row);
-		});
-	});
-	layer.dirty = false;
+function chunkCanvas(key, draw) {
+	// the cached canvas of chunk key, drawn by draw(ctx) if it is not cached.
+	// null if draw found nothing to draw.
+	let chunks = renderer.chunks;
+	renderer.frame_chunks++;
+
+	if(chunks.has(key)) {
+		// Map keeps insertion order, so re-inserting marks it as most recent
+		let canvas = chunks.get(key);
+		chunks.delete(key);
+		chunks.set(key, canvas);
+		return canvas;
+	}
+
+	let canvas = document.createElement('canvas');
+	canvas.width  = CHUNK_WIDTH;
+	canvas.height = CHUNK_HEIGHT;
+
+	if(!draw(canvas.getContext('2d'))) {
+		canvas.width = canvas.height = 0;
+		canvas = null;
+	}
+
+	chunks.set(key, canvas);
+	return canvas;
+}
+
+function pruneChunks() {
+	// every chunk used this frame was moved to the end of renderer.chunks,
+	// so evicting from the front never drops a visible one
+	let chunks = renderer.chunks;
+
+	while(chunks.size > renderer.frame_chunks + SPARE_CHUNKS) {
+		let oldest = chunks.keys().next().value;
+		let old_canvas = chunks.get(oldest);
+		if(old_canvas !== null)
+			old_canvas.width = old_canvas.height = 0;
+		chunks.delete(oldest);
+	}
+}
+
+function clearChunks(prefix) {
+	for(let key of Array.from(renderer.chunks.keys())) {
+		if(prefix !== undefined && !key.startsWith(prefix))
+			continue;
+		let canvas = renderer.chunks.get(key);
+		if(canvas !== null)
+			canvas.width = canvas.height = 0;
+		renderer.chunks.delete(key);
+	}
+}
+
+function visibleChunks(cols, rows, callback) {
+	// calls callback(cx, cy, dx, dy, dw, dh) for each chunk of a cols x rows
+	// tile area that is in the viewport
+	let zoom = viewport.zoom;
+	let dw = CHUNK_WIDTH  * zoom,
+	    dh = CHUNK_HEIGHT * zoom;
+
+	let cx0 = Math.max(0, Math.floor(-viewport.tx / dw)),
+	    cy0 = Math.max(0, Math.floor(-viewport.ty / dh));
+	let cx1 = Math.min(Math.ceil(cols / CHUNK_TILES), Math.ceil((VIEWPORT_WIDTH  - viewport.tx) / dw)),
+	    cy1 = Math.min(Math.ceil(rows / CHUNK_TILES), Math.ceil((VIEWPORT_HEIGHT - viewport.ty) / dh));
+
+	for(let cy = cy0; cy < cy1; cy++)
+		for(let cx = cx0; cx < cx1; cx++)
+			callback(cx, cy, viewport.tx + cx * dw, viewport.ty + cy * dh, dw, dh);
+}
+
+function drawLayerChunk(ctx, layer, cx, cy) {
+	let tile  = new Object();
+	let width = layer.size[0];
+	let drawn = false;
+
+	ctx.translate(-cx * CHUNK_WIDTH, -cy * CHUNK_HEIGHT);
+
+	// tiles near the chunk can reach into it
+	let col0 = Math.max(0, cx * CHUNK_TILES - LAYER_MARGIN),
+	    row0 = Math.max(0, cy * CHUNK_TILES - LAYER_MARGIN);
+	let col1 = Math.min(width,         (cx + 1) * CHUNK_TILES + LAYER_MARGIN),
+	    row1 = Math.min(layer.size[1], (cy + 1) * CHUNK_TILES + LAYER_MARGIN);
+
+	for(let row = row0; row < row1; row++) {
+		for(let col = col0; col < col1; col++) {
+			let i = row * width + col;
+			if(layer.idx[i] === EMPTY_TILE)
+				continue;
+
+			tile.ts  = layer.tilesheets[layer.ts[i]];
+			tile.idx = layer.idx[i];
+			drawTile(ctx, tile, col, row);
+			drawn = true;
+		}
+	}
+
+	return drawn;
 }
 
 function drawLayer(ctx, layer) {
 	if(!layer.vis) return;
-	if(layer.dirty) redrawLayer(layer);
+	if(layer.dirty) {
+		clearChunks(layer.key + ':');
+		layer.dirty = false;
+	}
 
-	let sx = 0,
-	    sy = 0;
+	visibleChunks(layer.size[0], layer.size[1], function(cx, cy, dx, dy, dw, dh) {
+		let canvas = chunkCanvas(layer.key + ':' + cx + ',' + cy, function(chunk_ctx) {
+			return drawLayerChunk(chunk_ctx, layer, cx, cy);
+		});
 
-	let sw = layer.canvas.width,
-	    sh = layer.canvas.height;
+		if(canvas !== null)
+			ctx.drawImage(canvas, 0, 0, CHUNK_WIDTH, CHUNK_HEIGHT, dx, dy, dw, dh);
+	});
+}
+
+function chunkObjects(objs) {
+	// objects by the chunk they stand in, each list in draw order: by row,
+	// then in list order, except that each stump goes right under the tree
+	// before it (as drawKey in saves.py). order breaks ties in y between
+	// chunks. objs itself is left in list order.
+	objs.forEach(function(o, i) { o.order = o.isStump ? i - 1.5 : i; });
+	let sorted = objs.slice().sort(function(a,b) { return (a.pos[1]-b.pos[1]) || (a.order-b.order); });
+
+	let chunks = new Map();
+	for(let o of sorted) {
+		let key = Math.floor(o.pos[0] / CHUNK_TILES) + ',' + Math.floor(o.pos[1] / CHUNK_TILES);
+		if(!chunks.has(key))
+			chunks.set(key, []);
+		chunks.get(key).push(o);
+	}
+	return chunks;
+}
 
-	let dx = viewport.tx,
-	    dy = viewport.ty;
+function bucketObjects(buckets, kinds) {
+	// chunkObjects, from the buckets of Location.dump. order is each
+	// object's rank in the draw order of the whole location.
+	let chunks = new Map();
 
-	let dw = layer.canvas.width  * viewport.zoom,
-	    dh = layer.canvas.height * viewport.zoom;
+	for(let key in buckets.chunks) {
+		let bucket = buckets.chunks[key];
+		let order  = buckets.order[key];
+		let objs = [];
 
-	ctx.drawImage(layer.canvas, sx, sy, sw, sh, dx, dy, dw, dh);
+		for(let i = 0; i < bucket.length; i += 2) {
+			let o = kinds[bucket[i]][bucket[i+1]];
+			o.order = order[i/2];
+			objs.push(o);
+		}
+		chunks.set(key, objs);
+	}
+	return chunks;
 }
 
-function drawObjects(ctx, objs) {
-	if(renderer.objs_dirty) {
-		renderer.map.objects.sort(function(a,b) { return a.pos[1]-b.pos[1]; });
-
-		renderer.obj_ctx.clearRect(0,0,renderer.obj_canvas.width,renderer.obj_canvas.height);
-		for(let o of objs) {
-			drawTile(renderer.obj_ctx, o, o.pos[0], o.pos[1]);
+function drawObjectChunk(ctx, cx, cy) {
+	// objects standing in nearby chunks can reach into this one
+	let objs = [];
+	for(let ny = cy - OBJECT_MARGIN; ny <= cy + OBJECT_MARGIN; ny++) {
+		for(let nx = cx - OBJECT_MARGIN; nx <= cx + OBJECT_MARGIN; nx++) {
+			let chunk = renderer.obj_chunks.get(nx + ',' + ny);
+			if(chunk !== undefined)
+				objs = objs.concat(chunk);
 		}
-		renderer.objs_dirty = false;
 	}
 
-	let sx = 0,
-	    sy = 0;
+	if(objs.length == 0)
+		return false;
+
+	objs.sort(function(a,b) { return (a.pos[1]-b.pos[1]) || (a.order-b.order); });
 
-	let sw = renderer.obj_canvas.width,
-	    sh = renderer.obj_canvas.height;
+	ctx.translate(-cx * CHUNK_WIDTH, -cy * CHUNK_HEIGHT);
+	for(let o of objs)
+		drawTile(ctx, o, o.pos[0], o.pos[1]);
+
+	return true;
+}
 
-	let dx = viewport.tx,
-	    dy = viewport.ty;
+function drawObjects(ctx, objs) {
+	if(renderer.objs_dirty) {
+		renderer.obj_chunks = renderer.map.obj_buckets || chunkObjects(objs);
+		clearChunks('objects:');
+		renderer.objs_dirty = false;
+	}
 
-	let dw = renderer.obj_canvas.width  * viewport.zoom,
-	    dh = renderer.obj_canvas.height * viewport.zoom;
+	visibleChunks(renderer.map.width, renderer.map.height, function(cx, cy, dx, dy, dw, dh) {
+		let canvas = chunkCanvas('objects:' + cx + ',' + cy, function(chunk_ctx) {
+			return drawObjectChunk(chunk_ctx, cx, cy);
+		});
 
-	ctx.drawImage(renderer.obj_canvas, sx, sy, sw, sh, dx, dy, dw, dh);
+		if(canvas !== null)
+			ctx.drawImage(canvas, 0, 0, CHUNK_WIDTH, CHUNK_HEIGHT, dx, dy, dw, dh);
+	});
 }
 
 function drawMap(ctx, map) {
 	ctx.clearRect(0,0,renderer.canvas.width,renderer.canvas.height);
+	renderer.frame_chunks = 0;
 
 	for(let layer of renderer.map.layers)
 		if(layer.depth <= 0)
@@ -168,6 +438,8 @@ function drawMap(ctx, map) {
 	for(let layer of renderer.map.layers)
 		if(layer.depth > 0)
 			drawLayer(ctx, layer);
+
+	pruneChunks();
 }
 
 var redraw_pending = false;
@@ -186,27 +458,46 @@ function request_redraw() {
 	}
 }
 
+function setTilesheetMeta(ts, r_ts) {
+	ts.sprites    = r_ts.sprites;
+	ts.tile_size  = r_ts.tile_size;
+	ts.sheet_size = r_ts.sheet_size;
+	ts.offset     = r_ts.offset;
+
+	ts.img = loadImage(r_ts.img_src);
+	if(ts.img.complete && ts.img.naturalWidth > 0)
+		tilesheetImgLoaded(ts);
+	else
+		ts.img.addEventListener('load', function() { tilesheetImgLoaded(ts); });
+}
+
+function loadImage(src) {
+	// tilesheets packed into the same atlas share one image
+	if(!renderer.images.hasOwnProperty(src)) {
+		let img = new Image();
+		img.src = resolve("assets/"+src);
+		renderer.images[src] = img;
+	}
+	return renderer.images[src];
+}
+
 function tilesheetMetaLoaded(ts) {
 	return function() {
 		if(!(this.status >= 200 && this.status < 300))
 			return;
-		let r_ts = JSON.parse(this.responseText);
-
-		if(r_ts.sprites) {
-			ts.sprites    = r_ts.sprites;
-		} else {
-			ts.tile_size  = r_ts.tile_size;
-			ts.sheet_size = r_ts.sheet_size;
-		}
-
-		ts.img = new Image();
-		ts.img.addEventListener('load', function() { tilesheetImgLoaded(ts); });
-		ts.img.src = "assets/"+r_ts.img_src;
+		setTilesheetMeta(ts, JSON.parse(this.responseText));
 	}
 }
 
 function tilesheetImgLoaded(ts) {
 	ts.loaded = true;
+
+	// chunks drawn before the image arrived are missing its tiles
+	if(renderer.has_loaded) {
+		clearChunks();
+		request_redraw();
+	}
+
 	checkLoaded();
 }
 
@@ -222,16 +513,116 @@ function loadTilesheet(src) {
 
 	renderer.tilesheets[ts.src] = ts;
 
+	if(renderer.manifest.hasOwnProperty(src)) {
+		setTilesheetMeta(ts, renderer.manifest[src]);
+		return;
+	}
+
 	let json_name = 'tilesheets/'+src+'.json';
 	xhr(json_name, tilesheetMetaLoaded(ts));
 }
 
-function mapsLoaded() {
-	let r_maps = JSON.parse(this.responseText);
+function publishedLoaded() {
+	if(this.status >= 200 && this.status < 300)
+		renderer.published = JSON.parse(this.responseText);
 
-	let r_map = r_maps[renderer.el.dataset.loc];
+	loadManifest();
+}
 
-	renderer.map = new Object();
+function loadManifest() {
+	if(renderer.el.dataset.tilesheets)
+		xhr(renderer.el.dataset.tilesheets, manifestLoaded);
+	else
+		loadData();
+}
+
+function manifestLoaded() {
+	// without a manifest, tilesheet metadata is fetched per tilesheet
+	if(this.status >= 200 && this.status < 300)
+		renderer.manifest = JSON.parse(this.responseText);
+
+	loadData();
+}
+
+function decodeBase64(str) {
+	let bin   = atob(str);
+	let bytes = new Uint8Array(bin.length);
+	for(let i = 0; i < bin.length; i++)
+		bytes[i] = bin.charCodeAt(i);
+	return bytes;
+}
+
+function tileBytes(data) {
+	// base64 in JSON, bin in MessagePack. bin is a view into the whole file,
+	// so it is copied to get an aligned buffer of its own.
+	if(typeof data === 'string')
+		return decodeBase64(data);
+	return data.slice();
+}
+
+function unpackTiles(layer, r_tiles) {
+	// packed little-endian arrays, one entry per run of equal cells
+	let idx = new Uint16Array(tileBytes(r_tiles.idx).buffer),
+	    ts  = tileBytes(r_tiles.ts),
+	    run = new Uint16Array(tileBytes(r_tiles.run).buffer);
+
+	layer.idx = new Uint16Array(layer.size[0] * layer.size[1]);
+	layer.ts  = new Uint8Array(layer.size[0] * layer.size[1]);
+
+	let i = 0;
+	for(let r = 0; r < run.length; r++) {
+		layer.idx.fill(idx[r], i, i + run[r]);
+		layer.ts.fill(ts[r], i, i + run[r]);
+		i += run[r];
+	}
+}
+
+function expandTiles(layer, r_tiles) {
+	// run-length encoded rows of indices, {ts} switches and {rep} runs
+	let width = layer.size[0];
+
+	layer.idx = new Uint16Array(width * layer.size[1]).fill(EMPTY_TILE);
+	layer.ts  = new Uint8Array(width * layer.size[1]);
+
+	let ts = 0;
+	r_tiles.forEach(function(r_row, row) {
+		let i        = row * width;
+		let prev_idx = EMPTY_TILE,
+		    prev_ts  = 0;
+
+		for(let item of r_row) {
+			if(typeof item === 'number') {
+				prev_idx = (item == -1) ? EMPTY_TILE : item;
+				prev_ts  = ts;
+				layer.idx[i] = prev_idx;
+				layer.ts[i]  = prev_ts;
+				i++;
+			} else if(item.rep !== undefined) {
+				layer.idx.fill(prev_idx, i, i + item.rep);
+				layer.ts.fill(prev_ts, i, i + item.rep);
+				i += item.rep;
+			} else if(item.ts  !== undefined) {
+				ts = item.ts;
+			}
+		}
+	});
+}
+
+function shardURL(index_url, filename) {
+	// shard file names are relative to their index
+	return index_url.substring(0, index_url.lastIndexOf('/')+1) + filename;
+}
+
+function mapsLoaded(r_maps) {
+	if(r_maps.shards) {
+		let url = shardURL(renderer.el.dataset.maps, r_maps.shards[renderer.el.dataset.loc]);
+		xhrData(url, mapLoaded);
+	} else {
+		mapLoaded(r_maps[renderer.el.dataset.loc]);
+	}
+}
+
+function mapLoaded(r_map) {
 	renderer.can_be_loaded = false;
 	renderer.has_loaded = false;
 
@@ -241,8 +632,10 @@ function mapsLoaded() {
 	renderer.map.properties = r_map.properties;
 	renderer.map.layers = new Array();
 
-	let max_layerwidth  = 0,
-	    max_layerheight = 0;
+	clearChunks();
+
+	renderer.map.width  = 0;
+	renderer.map.height = 0;
 
 	for(let r_layer of r_map.layers) {
 		let layer = new Object();
@@ -251,66 +644,36 @@ function mapsLoaded() {
 		layer.vis       = (r_layer.vis === undefined) ? true : r_layer.vis;
 		layer.depth     = r_layer.depth;
 
-		layer.tiles = new Array(r_layer.size[1]);
-		let row = 0;
-		let ts  = undefined;
-		for(let r_row of r_layer.tiles) {
-			layer.tiles[row] = new Array();
-
-			let col       = 0;
-			let prev_tile = undefined;
-
-			for(let item of r_row) {
-				if(typeof item === 'number') {
-					if(item == -1)
-						prev_tile = null;
-					else
-						prev_tile = { 'idx': item, 'ts': r_map.tilesheets[ts] };
-					layer.tiles[row][col++] = prev_tile;
-				} else if(item.rep !== undefined) {
-					for(let i = 0; i < (item.rep); i++) {
-						layer.tiles[row][col++] = prev_tile;
-					}
-				} else if(item.ts  !== undefined) {
-					ts = item.ts;
-				}
-			}
-			row += 1;
-		}
-
-		layer.dirty = true;
-
-		layer.canvas = document.createElement('canvas');
+		layer.tilesheets = r_map.tilesheets;
 
-		layer.canvas.width  = layer.size[0] * layer.tile_size[0];
-		layer.canvas.height = layer.size[1] * layer.tile_size[1];
+		if(Array.isArray(r_layer.tiles))
+			expandTiles(layer, r_layer.tiles);
+		else
+			unpackTiles(layer, r_layer.tiles);
 
-		if(layer.canvas.width  >= max_layerwidth)  max_layerwidth  = layer.canvas.width;
-		if(layer.canvas.height >= max_layerheight) max_layerheight = layer.canvas.height;
+		layer.key   = 'layer' + renderer.map.layers.length;
+		layer.dirty = true;
 
-		layer.ctx = layer.canvas.getContext('2d');
+		// objects are drawn over the area of the largest layer, in tiles
+		renderer.map.width  = Math.max(renderer.map.width,  layer.size[0]);
+		renderer.map.height = Math.max(renderer.map.height, layer.size[1]);
 
 		renderer.map.layers.push(layer);
 	}
 
-	renderer.obj_canvas = document.createElement('canvas');
-
-	renderer.obj_canvas.width  = max_layerwidth;
-	renderer.obj_canvas.height = max_layerheight;
-
-	renderer.obj_ctx = renderer.obj_canvas.getContext('2d');
 	renderer.objs_dirty = true;
 
 	renderer.can_be_loaded = true;
 	checkLoaded();
 }
 
-function saveLoaded() {
-	let r_save = JSON.parse(this.responseText);
+function saveLoaded(r_save) {
 	console.log(r_save);
 
-	for(let ts of r_save.tilesheets) {
-		loadTilesheet(ts);
+	if(r_save.shards) {
+		let url = shardURL(renderer.el.dataset.save, r_save.shards[renderer.el.dataset.loc]);
+		xhrData(url, function(r_loc) { locationLoaded(r_save, r_loc); });
+		return;
 	}
 
 	let r_loc = undefined;
@@ -319,6 +682,17 @@ function saveLoaded() {
 			r_loc = loc;
 	}
 
+	locationLoaded(r_save, r_loc);
+}
+
+function locationLoaded(r_save, r_loc) {
+	for(let ts of r_save.tilesheets) {
+		loadTilesheet(ts);
+	}
+
+	// objects by their kind and index in r_loc, for r_loc.buckets
+	let kinds = [[], [], []];
+
 	renderer.map.objects = [];
 	for(let item of r_loc.items) {
 		let obj = new Object();
@@ -327,6 +701,7 @@ function saveLoaded() {
 		obj.pos = item.pos;
 
 		renderer.map.objects.push(obj);
+		kinds[0].push(obj);
 	}
 
 	for(let building of r_loc.buildings) {
@@ -339,9 +714,11 @@ function saveLoaded() {
 			];
 
 		renderer.map.objects.push(obj);
+		kinds[1].push(obj);
 	}
 
-	for(let feature of r_loc.features) {
+	for(let feature of r_loc.features || []) {
+		kinds[2].push(null);
 		if(feature === null)
 			continue;
 
@@ -358,10 +735,65 @@ function saveLoaded() {
 		if ("isGrass" in feature) {
 			obj.isGrass = true;
 		}
+		if ("isStump" in feature) {
+			obj.isStump = true;
+		}
 
 		renderer.map.objects.push(obj);
+		kinds[2][kinds[2].length - 1] = obj;
 	}
 
+	// instanced features only get their own idx and pos; the rest comes
+	// from one prototype per group. they are added in their order among the
+	// features, as in the plain dump.
+	let instanced = [];
+	for(let group of r_loc.instances || []) {
+		let proto = new Object();
+		proto.ts = r_save.tilesheets[group.ts];
+		if ("tileSize" in group) {
+			proto.tileSize = group.tileSize;
+		}
+		if ("offset" in group) {
+			proto.offset = group.offset;
+		}
+		if ("isGrass" in group) {
+			proto.isGrass = true;
+		}
+
+		let stump = null;
+		if ("stump" in group) {
+			stump = new Object();
+			stump.ts  = proto.ts;
+			stump.idx = group.stump;
+			stump.isStump = true;
+		}
+
+		for(let i = 0; i < group.pos.length / 2; i++) {
+			let obj = Object.create(proto);
+			obj.idx = Array.isArray(group.idx) ? group.idx[i] : group.idx;
+			obj.pos = [group.pos[2*i], group.pos[2*i+1]];
+			instanced[group.order[i]] = [obj];
+
+			if(stump !== null) {
+				let s = Object.create(stump);
+				s.pos = obj.pos;
+				instanced[group.order[i]].push(s);
+			}
+		}
+	}
+
+	for(let members of instanced) {
+		for(let obj of members) {
+			renderer.map.objects.push(obj);
+			kinds[2].push(obj);
+		}
+	}
+
+	// saves exported with buckets of our chunk size are already in order
+	renderer.map.obj_buckets = null;
+	if(r_loc.buckets && r_loc.buckets.size == CHUNK_TILES && r_loc.buckets.order)
+		renderer.map.obj_buckets = bucketObjects(r_loc.buckets, kinds);
+
 	renderer.objs_dirty = true;
 }
 
@@ -423,10 +855,33 @@ function load_renderer() {
 
 	renderer.el.appendChild(renderer.canvas);
 
+	// the map and save are loaded independently, into the same object
+	renderer.map = new Object();
+	renderer.map.objects = [];
+	renderer.map.layers  = [];
+	renderer.map.width   = 0;
+	renderer.map.height  = 0;
+
+	renderer.chunks       = new Map();
+	renderer.frame_chunks = 0;
+	renderer.obj_chunks   = new Map();
+
 	renderer.tilesheets = {};
+	renderer.manifest   = {};
+	renderer.images     = {};
+	renderer.published  = {};
+
+	// the publish manifest is fetched by its own name, with a short cache
+	// lifetime; everything else goes through resolve
+	if(renderer.el.dataset.manifest)
+		xhr(renderer.el.dataset.manifest, publishedLoaded);
+	else
+		loadManifest();
+}
 
-	xhr(renderer.el.dataset.maps, mapsLoaded);
-	xhr(renderer.el.dataset.save, saveLoaded);
+function loadData() {
+	xhrData(renderer.el.dataset.maps, mapsLoaded);
+	xhrData(renderer.el.dataset.save, saveLoaded);
 }
 
 window.addEventListener("load", load_renderer);